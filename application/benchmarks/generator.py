@@ -0,0 +1,243 @@
+import sys
+import random
+import inspect
+import argparse
+import datetime
+
+from lxml import etree
+
+
+SOCCER_STATS = ['mins_played', 'touches', 'total_pass', 'accurate_pass', 'fwd_pass', 'backward_pass',
+                'total_tackle', 'won_tackle', 'duel_won', 'duel_lost', 'poss_lost_all', 'ball_recovery']
+RUGBY_STATS = ['carries_metres', 'carries_crossed_gain_line', 'tackles', 'missed_tackles', 'turnovers_won',
+               'passes', 'offloads', 'penalties_conceded', 'metres', 'runs', 'points', 'tries']
+POSITIONS = ['Goalkeeper', 'Defender', 'Midfielder', 'Forward']
+START = datetime.datetime(2020, 8, 21, 19, 45)
+
+
+def _stat_names(names, count):
+    return [names[i] if i < len(names) else f'stat_{i}' for i in range(count)]
+
+
+def _sub(parent, tag, text=None, **attrib):
+    node = etree.SubElement(parent, tag, {k: str(v) for k, v in attrib.items() if v is not None})
+    if text is not None:
+        node.text = str(text)
+    return node
+
+
+def _person(parent, tag, first, last):
+    name = _sub(parent, tag)
+    _sub(name, 'First', first)
+    _sub(name, 'Last', last)
+    return name
+
+
+def _dump(root):
+    return etree.tostring(root, xml_declaration=True, encoding='utf-8')
+
+
+def _pairings(teams, fixtures):
+    for i in range(fixtures):
+        home = i % teams + 1
+        away = (home + i // teams) % teams + 1
+        yield home, away if away != home else home % teams + 1
+
+
+def generate_f1(teams=20, fixtures=380):
+    feed = etree.Element('SoccerFeed')
+    doc = _sub(feed, 'SoccerDocument', Type='RESULTS Latest', competition_id=24, competition_name='Competition 24',
+               season_id=2020, season_name='Season 2020/2021')
+
+    for i, (home, away) in enumerate(_pairings(teams, fixtures)):
+        match = _sub(doc, 'MatchData', uID=f'g{100000 + i}')
+        info = _sub(match, 'MatchInfo', MatchDay=i // max(teams // 2, 1) + 1, MatchType='Regular', Period='FullTime')
+        _sub(info, 'Date', (START + datetime.timedelta(hours=i)).strftime('%Y-%m-%d %H:%M:%S'))
+        _sub(match, 'TeamData', Side='Home', TeamRef=f't{home}', Score=i % 4)
+        _sub(match, 'TeamData', Side='Away', TeamRef=f't{away}', Score=i % 3)
+
+    for t in range(1, teams + 1):
+        team = _sub(doc, 'Team', uID=f't{t}')
+        _sub(team, 'Name', f'Team {t}')
+
+    return _dump(feed)
+
+
+def generate_f9(players=18, stats=60, events=10, period='FullTime', seed=0):
+    rnd = random.Random(seed)
+    names = _stat_names(SOCCER_STATS, stats)
+
+    feed = etree.Element('SoccerFeed')
+    doc = _sub(feed, 'SoccerDocument', Type='Result', uID='f900000')
+
+    competition = _sub(doc, 'Competition', uID='c24')
+    _sub(competition, 'Country', 'France')
+    _sub(competition, 'Name', 'Competition 24')
+    for k, v in (('season_id', 2020), ('season_name', 'Season 2020/2021'), ('symid', 'C24'), ('matchday', 1)):
+        _sub(competition, 'Stat', v, Type=k)
+    round_ = _sub(competition, 'Round')
+    _sub(round_, 'Name', 'Round')
+    _sub(round_, 'RoundNumber', 1)
+
+    match = _sub(doc, 'MatchData')
+    info = _sub(match, 'MatchInfo', MatchType='Regular', Period=period, Weather='Sunny')
+    _sub(info, 'Attendance', 20000)
+    _sub(info, 'Date', START.strftime('%Y%m%dT%H%M%S+0100'))
+    _sub(info, 'Result', Type='NormalResult', Winner='t1')
+    _person(_sub(match, 'MatchOfficial', uID='o1'), 'OfficialName', 'Referee', 'One')
+
+    event_id = 0
+    for t, side in ((1, 'Home'), (2, 'Away')):
+        data = _sub(match, 'TeamData', Score=events // 3, Side=side, TeamRef=f't{t}')
+        ids = [f'p{t}{p:03d}' for p in range(players)]
+
+        for e in range(events):
+            event_id += 1
+            minute = rnd.randint(1, 90)
+            if e % 3 == 0:
+                goal = _sub(data, 'Goal', EventID=event_id, PlayerRef=rnd.choice(ids), Time=minute, Type='Goal')
+                _sub(goal, 'Assist', rnd.choice(ids))
+            elif e % 3 == 1:
+                _sub(data, 'Booking', EventID=event_id, PlayerRef=rnd.choice(ids), Time=minute, Card='Yellow',
+                     CardType='Yellow', Reason='Foul')
+            else:
+                _sub(data, 'Substitution', EventID=event_id, SubOff=rnd.choice(ids), SubOn=rnd.choice(ids),
+                     Time=minute, Reason='Tactical')
+
+        _sub(data, 'Stat', '4-4-2', Type='formation_used')
+        for name in names:
+            _sub(data, 'Stat', rnd.randint(0, 500), Type=name, FH=rnd.randint(0, 250), SH=rnd.randint(0, 250))
+
+        lineup = _sub(data, 'PlayerLineUp')
+        for p, player_id in enumerate(ids):
+            player = _sub(lineup, 'MatchPlayer', PlayerRef=player_id, Position=POSITIONS[p % 4],
+                          ShirtNumber=p + 1, Status='Start' if p < 11 else 'Sub', Captain='1' if p == 0 else None)
+            _sub(player, 'Stat', p + 1, Type='formation_place')
+            for name in names:
+                _sub(player, 'Stat', 90 if name == 'mins_played' else rnd.randint(0, 100), Type=name)
+
+    for t in (1, 2):
+        team = _sub(doc, 'Team', uID=f't{t}')
+        _sub(team, 'Country', 'France')
+        _sub(team, 'Name', f'Team {t}')
+        for p in range(players):
+            player = _sub(team, 'Player', uID=f'p{t}{p:03d}', Position=POSITIONS[p % 4])
+            _person(player, 'PersonName', f'First{p}', f'Last{t}{p}')
+        _person(_sub(team, 'TeamOfficial', Type='Manager', uID=f'man{t}'), 'PersonName', 'Manager', f'Team{t}')
+
+    venue = _sub(doc, 'Venue', uID='v1')
+    _sub(venue, 'Country', 'France')
+    _sub(venue, 'Name', 'Stadium 1')
+
+    return _dump(feed)
+
+
+def generate_f40(teams=20, players=30, stats=12):
+    feed = etree.Element('SoccerFeed')
+    doc = _sub(feed, 'SoccerDocument', Type='SQUADS Latest', competition_id=24, competition_name='Competition 24',
+               season_id=2020, season_name='Season 2020/2021')
+    extra = max(stats - 8, 0)
+
+    for t in range(1, teams + 1):
+        team = _sub(doc, 'Team', uID=f't{t}', country='France', country_id=8, country_iso='FR', region_id=17,
+                    region_name='Europe', short_club_name=f'T{t}')
+        _sub(team, 'Name', f'Team {t}')
+        _sub(team, 'SYMID', f'T{t:02d}')
+        _sub(_sub(team, 'Stadium', uID=t), 'Name', f'Stadium {t}')
+        kits = _sub(team, 'TeamKits')
+        _sub(kits, 'Kit', type='home', colour1='#FFFFFF', colour2='#000000')
+        _sub(kits, 'Kit', type='away', colour1='#000000', colour2='#FFFFFF')
+
+        official = _sub(team, 'TeamOfficial', Type='Manager', uID=f'man{t}', country='France')
+        _person(official, 'PersonName', 'Manager', f'Team{t}')
+
+        for p in range(players):
+            player = _sub(team, 'Player', uID=f'p{t}{p:03d}')
+            _sub(player, 'Name', f'First{p} Last{t}{p}')
+            _sub(player, 'Position', POSITIONS[p % 4])
+            for k, v in (('first_name', f'First{p}'), ('last_name', f'Last{t}{p}'), ('birth_date', '1995-01-01'),
+                         ('birth_place', 'Unknown'), ('first_nationality', 'France'), ('weight', 75),
+                         ('height', 180), ('join_date', '2019-07-01')):
+                _sub(player, 'Stat', v, Type=k)
+            for i in range(extra):
+                _sub(player, 'Stat', i, Type=f'stat_{i}')
+
+    return _dump(feed)
+
+
+def generate_ru1(teams=14, fixtures=182):
+    root = etree.Element('fixtures')
+
+    for i, (home, away) in enumerate(_pairings(teams, fixtures)):
+        date = START + datetime.timedelta(hours=i)
+        fixture = _sub(root, 'fixture', id=300000 + i, comp_id=203, comp_name='Competition 203', season_id=2020,
+                       datetime=date.strftime('%Y-%m-%dT%H:%M:%S+0000'), group=1, group_name=1,
+                       round=i // max(teams // 2, 1) + 1, status='Result', venue=f'Stadium {home}', venue_id=home)
+        _sub(fixture, 'team', home_or_away='home', team_id=home, score=i % 40)
+        _sub(fixture, 'team', home_or_away='away', team_id=away, score=i % 30)
+
+    teams_node = _sub(root, 'teams')
+    for t in range(1, teams + 1):
+        _sub(teams_node, 'team', id=t, name=f'Team {t}')
+
+    return _dump(root)
+
+
+def generate_ru7(players=23, stats=150, events=60, status='Result', seed=0):
+    rnd = random.Random(seed)
+    names = _stat_names(RUGBY_STATS, stats)
+
+    root = etree.Element('RRML', id=str(300000), attendance='15000', away_ht_score='9', away_score='23',
+                         home_ht_score='10', home_score='23', status=status, comp_id='203', season_id='2020')
+
+    events_node = _sub(root, 'Events')
+    for e in range(events):
+        _sub(events_node, 'Event', minute=f'{e * 80 // max(events, 1)}', second=rnd.randint(0, 59),
+             player_id=f'{1 + e % 2}{rnd.randrange(players):03d}', team_id=1 + e % 2, type='Tackle',
+             temporary='0')
+
+    officials = _sub(root, 'Officials')
+    _sub(officials, 'Official', id=1, country='France', official_name='Referee One', role='referee')
+
+    detail = _sub(root, 'TeamDetail')
+    for t, side in ((1, 'home'), (2, 'away')):
+        team = _sub(detail, 'Team', home_or_away=side, team_id=t, team_name=f'Team {t}')
+        for p in range(players):
+            player = _sub(team, 'Player', id=f'{t}{p:03d}', player_name=f'Player {t}{p}',
+                          position=f'Position {p}', position_id=p + 1)
+            _sub(_sub(player, 'PlayerStats'), 'PlayerStat', game_id=300000, team_id=t, player_id=f'{t}{p:03d}',
+                 **{n: rnd.randint(0, 20) for n in names})
+        _sub(_sub(team, 'TeamStats'), 'TeamStat', game_id=300000, team_id=t,
+             **{n: rnd.randint(0, 200) for n in names})
+
+    return _dump(root)
+
+
+GENERATORS = {
+    'F1': generate_f1,
+    'F9': generate_f9,
+    'F40': generate_f40,
+    'RU1': generate_ru1,
+    'RU7': generate_ru7
+}
+
+
+def generate(feed_type, **scale):
+    fn = GENERATORS[feed_type]
+    accepted = inspect.signature(fn).parameters
+    return fn(**{k: v for k, v in scale.items() if k in accepted and v is not None})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic Opta document to stdout.')
+    parser.add_argument('feed_type', choices=sorted(GENERATORS), type=str.upper)
+    for name in ('teams', 'players', 'stats', 'fixtures', 'events', 'seed'):
+        parser.add_argument(f'--{name}', type=int)
+    args = parser.parse_args(argv)
+
+    scale = {k: v for k, v in vars(args).items() if k != 'feed_type'}
+    sys.stdout.buffer.write(generate(args.feed_type, **scale))
+
+
+if __name__ == '__main__':
+    main()
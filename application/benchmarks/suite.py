@@ -0,0 +1,186 @@
+import re
+import sys
+import json
+import time
+import inspect
+import argparse
+import statistics
+import tracemalloc
+import collections
+
+from application.benchmarks import generator
+from application.dependencies import opta
+from application.profile_feed import PARSERS, count_records, find_fixture
+from application.services.opta_collector import OptaCollectorService
+
+
+Benchmark = collections.namedtuple('Benchmark', ['name', 'fn', 'setup', 'size'])
+
+
+def _parser_benchmarks(feed_type, content):
+    cls = PARSERS[feed_type]
+    yield Benchmark(f'{feed_type}.parse_xml', cls, lambda: (content,), len(content))
+
+    parser = cls(content)
+    for name in sorted(n for n in vars(cls) if n.startswith('get_')):
+        method = getattr(parser, name)
+        if 'wide' in inspect.signature(method).parameters:
+            yield Benchmark(f'{feed_type}.{name}[long]', method, lambda: (False,), None)
+            yield Benchmark(f'{feed_type}.{name}[wide]', method, lambda: (True,), None)
+        else:
+            yield Benchmark(f'{feed_type}.{name}', method, tuple, None)
+
+
+def _transform_benchmarks(documents):
+    service = OptaCollectorService
+    layouts = {layout: opta.OptaWebService('', '', '', stats_layout=layout) for layout in ('long', 'wide')}
+    calendar = opta.OptaRU1Parser(documents['RU1']).get_calendar()
+
+    def f9_datastore(game):
+        return service._build_f9_datastore(game['match_info']['id'][1:], game, [])
+
+    def ru7_datastore(game, ru1):
+        return service._build_ru7_datastore(game['rrml']['id'], game, ru1, [])
+
+    def with_fixture(game):
+        return game, find_fixture(calendar, game['rrml']['id'])
+
+    f9 = opta.OptaF9Parser(documents['F9'])
+    yield Benchmark('F9._compute_soccer_events', layouts['long']._compute_soccer_events, lambda: (f9,), None)
+
+    # The builders coerce records in place, so every run gets a freshly parsed game
+    for layout, webservice in layouts.items():
+        def soccer_game(webservice=webservice):
+            return webservice.parse_soccer_game(documents['F9'], final_only=False)
+
+        def rugby_game(webservice=webservice):
+            return webservice.parse_rugby_game(documents['RU7'], final_only=False)
+
+        yield Benchmark(f'transform.f9._checksum[{layout}]', service._checksum, lambda g=soccer_game: (g(),), None)
+        yield Benchmark(f'transform.f9._build_f9_datastore[{layout}]', f9_datastore,
+                        lambda g=soccer_game: (g(),), None)
+        yield Benchmark(f'transform.ru7._checksum[{layout}]', service._checksum, lambda g=rugby_game: (g(),), None)
+        yield Benchmark(f'transform.ru7._build_ru7_datastore[{layout}]', ru7_datastore,
+                        lambda g=rugby_game: with_fixture(g()), None)
+
+    yield Benchmark('transform.f9._extract_referential_from_soccer_game',
+                    service._extract_referential_from_soccer_game,
+                    lambda: (layouts['long'].parse_soccer_game(documents['F9'], final_only=False),), None)
+    yield Benchmark('transform.ru7._extract_referential_from_rugby_game',
+                    lambda game, ru1: service._extract_referential_from_rugby_game(ru1, game),
+                    lambda: with_fixture(layouts['long'].parse_rugby_game(documents['RU7'], final_only=False)), None)
+
+    def squads():
+        return (opta.OptaF40Parser(documents['F40']).get_squads(),)
+
+    yield Benchmark('transform.f40._squads_checksum', service._squads_checksum, squads, None)
+    yield Benchmark('transform.f40._build_f40_datastore', service._build_f40_datastore, squads, None)
+
+
+def build_benchmarks(**scale):
+    documents = {feed_type: generator.generate(feed_type, **scale) for feed_type in generator.GENERATORS}
+
+    benchmarks = []
+    for feed_type, content in documents.items():
+        benchmarks.extend(_parser_benchmarks(feed_type, content))
+    benchmarks.extend(_transform_benchmarks(documents))
+    return benchmarks
+
+
+def measure(benchmark, min_time=0.2, min_runs=3, max_runs=1000):
+    times = []
+    while len(times) < min_runs or (sum(times) < min_time and len(times) < max_runs):
+        args = benchmark.setup()
+        start = time.perf_counter()
+        result = benchmark.fn(*args)
+        times.append(time.perf_counter() - start)
+
+    args = benchmark.setup()
+    tracemalloc.start()
+    try:
+        benchmark.fn(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    median = statistics.median(times)
+    records = count_records(result)
+    return {
+        'runs': len(times),
+        'median': median,
+        'min': min(times),
+        'ops': 1 / median if median else None,
+        'records': records,
+        'records_per_second': records / median if records and median else None,
+        'mb_per_second': benchmark.size / median / 2 ** 20 if benchmark.size and median else None,
+        'peak_bytes': peak
+    }
+
+
+def run(benchmarks, pattern=None, min_time=0.2):
+    results = collections.OrderedDict()
+    for benchmark in benchmarks:
+        if pattern and not re.search(pattern, benchmark.name):
+            continue
+        results[benchmark.name] = measure(benchmark, min_time)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous and result['median'] > previous['median'] * (1 + tolerance):
+            regressions.append(name)
+        result['change'] = result['median'] / previous['median'] - 1 if previous else None
+    return regressions
+
+
+def report(results, out=None):
+    out = out or sys.stdout
+    out.write(f'{"benchmark":<58} {"median ms":>10} {"ops/s":>10} {"records/s":>12} {"MB/s":>8} '
+              f'{"peak KiB":>10} {"change":>8}\n')
+
+    def fmt(value, spec):
+        return '' if value is None else format(value, spec)
+
+    for name, r in results.items():
+        out.write(f'{name:<58} {r["median"] * 1000:>10.3f} {fmt(r["ops"], ".1f"):>10} '
+                  f'{fmt(r["records_per_second"], ".0f"):>12} {fmt(r["mb_per_second"], ".1f"):>8} '
+                  f'{r["peak_bytes"] / 1024:>10.1f} {fmt(r.get("change"), "+.1%"):>8}\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Opta parsers and collector transforms '
+                                                 'on synthetic documents.')
+    for name in ('teams', 'players', 'stats', 'fixtures', 'events'):
+        parser.add_argument(f'--{name}', type=int, help='scale of the generated documents')
+    parser.add_argument('--filter', help='only run benchmarks whose name matches this regex')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds spent per benchmark')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='median slowdown tolerated against the baseline before failing')
+    args = parser.parse_args(argv)
+
+    scale = {k: getattr(args, k) for k in ('teams', 'players', 'stats', 'fixtures', 'events')}
+    results = run(build_benchmarks(**scale), args.filter, args.min_time)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != scale:
+            sys.stderr.write(f'Baseline was measured at scale {baseline.get("scale")}, not {scale}\n')
+        regressions = compare(results, baseline['results'], args.tolerance)
+
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'scale': scale, 'results': results}, f, indent=2)
+
+    if regressions:
+        sys.stderr.write(f'{len(regressions)} regression(s) above {args.tolerance:.0%}: {", ".join(regressions)}\n')
+        return 1
+    return 0
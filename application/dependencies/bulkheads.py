@@ -0,0 +1,138 @@
+import time
+import logging
+import functools
+
+import eventlet
+import eventlet.semaphore
+from nameko.extensions import DependencyProvider
+
+from application.dependencies.metrics import COUNTER, GAUGE
+from application.dependencies.profiling import Profiler
+
+
+_log = logging.getLogger(__name__)
+
+FAMILIES = {
+    'soccer': {'size': 4, 'queue': 500},
+    'rugby': {'size': 2, 'queue': 200},
+    'squads': {'size': 1, 'queue': 50}
+}
+
+
+# Result of a task that raised, so that callers can tell it from a task that returned nothing
+FAILED = 'FAILED'
+
+
+class BulkheadFullError(Exception):
+    pass
+
+
+class Bulkhead(object):
+    def __init__(self, name, size, queue, spawn=None, hooks=()):
+        self.name = name
+        self.size = size
+        self.queue = queue
+        self.spawn = spawn or (lambda fn, identifier=None: eventlet.spawn(fn))
+        self.hooks = hooks
+        self.semaphore = eventlet.semaphore.Semaphore(size)
+        self.created = time.monotonic()
+        self.waiting = 0
+        self.running = 0
+        self.max_running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.busy = 0.
+
+    def _run(self, entrypoint, fn, *args):
+        try:
+            self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        start = time.monotonic()
+        for hook in self.hooks:
+            hook.task_setup(entrypoint)
+        try:
+            return fn(*args)
+        except Exception:
+            _log.exception(f'Task {fn.__name__}{args} of {entrypoint} failed in {self.name} bulkhead')
+            self.failed += 1
+            return FAILED
+        finally:
+            for hook in self.hooks:
+                hook.task_result(entrypoint)
+            self.busy += time.monotonic() - start
+            self.running -= 1
+            self.completed += 1
+            self.semaphore.release()
+
+    def submit(self, fn, *args, entrypoint=None):
+        if self.waiting >= self.queue:
+            self.rejected += 1
+            raise BulkheadFullError(f'{self.name} bulkhead is full ({self.waiting} waiting)')
+
+        self.waiting += 1
+        return self.spawn(functools.partial(self._run, entrypoint, fn, *args),
+                          identifier=f'{self.name} bulkhead task of {entrypoint}')
+
+    def stats(self):
+        elapsed = time.monotonic() - self.created
+        return {
+            'size': self.size,
+            'queue': self.queue,
+            'running': self.running,
+            'waiting': self.waiting,
+            'max_running': self.max_running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'utilization': self.busy / (self.size * elapsed) if elapsed else 0.
+        }
+
+
+class WorkerBulkhead(object):
+    # What a worker sees of a bulkhead: its tasks carry the worker's entrypoint
+    def __init__(self, bulkhead, entrypoint):
+        self.bulkhead = bulkhead
+        self.entrypoint = entrypoint
+
+    def submit(self, fn, *args):
+        return self.bulkhead.submit(fn, *args, entrypoint=self.entrypoint)
+
+    def stats(self):
+        return self.bulkhead.stats()
+
+
+def create_bulkheads(config=None, spawn=None, hooks=()):
+    config = config or {}
+    return {name: Bulkhead(name, **{**defaults, **(config.get(name) or {})}, spawn=spawn, hooks=hooks)
+            for name, defaults in FAMILIES.items()}
+
+
+class Bulkheads(DependencyProvider):
+    COUNTERS = frozenset(['completed', 'failed', 'rejected'])
+
+    def setup(self):
+        # Tasks run as managed threads, so that stopping or killing the container kills them too
+        self.bulkheads = create_bulkheads(self.container.config.get('BULKHEADS'),
+                                          spawn=self.container.spawn_managed_thread,
+                                          hooks=[d for d in self.container.dependencies if isinstance(d, Profiler)])
+
+    def get_dependency(self, worker_ctx):
+        return {name: WorkerBulkhead(b, worker_ctx.entrypoint.method_name) for name, b in self.bulkheads.items()}
+
+    def collect_metrics(self):
+        for name, bulkhead in self.bulkheads.items():
+            for k, v in bulkhead.stats().items():
+                yield f'bulkhead_{k}', {'pool': name}, v, COUNTER if k in self.COUNTERS else GAUGE
+
+    def stop(self):
+        self.bulkheads = None
+        del self.bulkheads
+
+    def kill(self):
+        self.bulkheads = None
+        del self.bulkheads
@@ -0,0 +1,141 @@
+import time
+import bisect
+import datetime
+
+import pytz
+from nameko.extensions import DependencyProvider
+from nameko_mongodb.database import MongoDatabase
+
+
+def _to_key(date):
+    if date.tzinfo is not None:
+        date = date.astimezone(pytz.utc).replace(tzinfo=None)
+    return date
+
+
+class CalendarIndex(object):
+    # Rows written by another replica are picked up on the next refresh, give or take this much clock skew
+    SKEW = 60
+
+    def __init__(self, database, refresh=None, days=None, clock=time.monotonic):
+        self.database = database
+        self.refresh_interval = refresh
+        self.days = days
+        self.clock = clock
+        self.calendars = dict()
+
+    def _horizon(self):
+        if not self.days:
+            return None
+        return datetime.datetime.utcnow() - datetime.timedelta(days=self.days)
+
+    def load(self, name):
+        horizon = self._horizon()
+        synced = datetime.datetime.utcnow()
+        query = {'date': {'$gte': horizon}} if horizon is not None else {}
+
+        rows = dict()
+        for row in self.database[name].find(query, {'_id': 0}):
+            rows[row['id']] = row
+
+        dates = sorted((_to_key(r['date']), i) for i, r in rows.items() if r.get('date') is not None)
+        self.calendars[name] = {'rows': rows, 'dates': dates, 'horizon': horizon, 'synced': synced,
+                                'refreshed': self.clock()}
+
+    def refresh(self, name):
+        calendar = self.calendars.get(name)
+        if calendar is None:
+            self.load(name)
+            return
+
+        synced = datetime.datetime.utcnow()
+        since = calendar['synced'] - datetime.timedelta(seconds=self.SKEW)
+        self.upsert(name, list(self.database[name].find({'updated': {'$gte': since}}, {'_id': 0})))
+
+        horizon = self._horizon()
+        if horizon is not None:
+            dates = calendar['dates']
+            pos = bisect.bisect_left(dates, (horizon,))
+            for _, i in dates[:pos]:
+                calendar['rows'].pop(i, None)
+            del dates[:pos]
+
+        calendar.update({'horizon': horizon, 'synced': synced, 'refreshed': self.clock()})
+
+    def _get_calendar(self, name):
+        calendar = self.calendars.get(name)
+        if calendar is None:
+            self.load(name)
+        elif self.refresh_interval and self.clock() - calendar['refreshed'] > self.refresh_interval:
+            self.refresh(name)
+        return self.calendars[name]
+
+    def invalidate(self, name=None):
+        if name is None:
+            self.calendars.clear()
+        else:
+            self.calendars.pop(name, None)
+
+    def upsert(self, name, rows):
+        calendar = self.calendars.get(name)
+        if calendar is None:
+            return
+
+        for row in rows:
+            current = calendar['rows'].get(row['id'])
+            if current is not None and current.get('date') is not None:
+                entry = (_to_key(current['date']), row['id'])
+                pos = bisect.bisect_left(calendar['dates'], entry)
+                if pos < len(calendar['dates']) and calendar['dates'][pos] == entry:
+                    del calendar['dates'][pos]
+                current.update(row)
+            else:
+                current = dict(row)
+                calendar['rows'][row['id']] = current
+
+            if current.get('date') is not None:
+                bisect.insort(calendar['dates'], (_to_key(current['date']), row['id']))
+
+    def get(self, name, id_):
+        calendar = self._get_calendar(name)
+        row = calendar['rows'].get(id_)
+        if row is None and calendar['horizon'] is not None:
+            return self.database[name].find_one({'id': id_}, {'_id': 0})
+        return dict(row) if row is not None else None
+
+    def between(self, name, start, end):
+        calendar = self._get_calendar(name)
+        if calendar['horizon'] is not None and _to_key(start) < calendar['horizon']:
+            return list(self.database[name].find({'date': {'$gte': _to_key(start), '$lt': _to_key(end)}},
+                                                 {'_id': 0}).sort([('date', 1), ('id', 1)]))
+
+        dates = calendar['dates']
+
+        lo = bisect.bisect_left(dates, (_to_key(start),))
+        hi = bisect.bisect_left(dates, (_to_key(end),))
+
+        return [dict(calendar['rows'][i]) for _, i in dates[lo:hi]]
+
+
+class Calendar(DependencyProvider):
+    def start(self):
+        database = [d for d in self.container.dependencies if isinstance(d, MongoDatabase)][0].database
+        # Only the recent rows are held: older games go to the database, and rows written by another replica
+        # (add_f1/add_ru1, update_all_*) show up on the next incremental refresh
+        config = self.container.config
+        self.index = CalendarIndex(database, refresh=float(config.get('CALENDAR_INDEX_REFRESH') or 60),
+                                   days=float(config.get('CALENDAR_INDEX_DAYS') or 30))
+
+        for name in ('f1', 'ru1'):
+            self.index.load(name)
+
+    def get_dependency(self, worker_ctx):
+        return self.index
+
+    def stop(self):
+        self.index = None
+        del self.index
+
+    def kill(self):
+        self.index = None
+        del self.index
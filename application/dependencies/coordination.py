@@ -0,0 +1,113 @@
+import os
+import uuid
+import bisect
+import socket
+import hashlib
+import logging
+import datetime
+
+import eventlet
+from pymongo.errors import PyMongoError
+from nameko.extensions import DependencyProvider
+from nameko_mongodb.database import MongoDatabase
+
+
+_log = logging.getLogger(__name__)
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    def __init__(self, members, vnodes=64):
+        self.members = sorted(members)
+        self.ring = sorted((_hash(f'{m}#{i}'), m) for m in self.members for i in range(vnodes))
+        self.hashes = [h for h, _ in self.ring]
+
+    def get(self, key):
+        if not self.ring:
+            return None
+        pos = bisect.bisect(self.hashes, _hash(key)) % len(self.ring)
+        return self.ring[pos][1]
+
+
+class Coordinator(object):
+    def __init__(self, database, instance_id, ttl=30, vnodes=64, replica=None):
+        self.database = database
+        self.instance_id = instance_id
+        # Unlike the instance id, the replica name survives restarts: resumable state is kept under it
+        self.replica = replica or instance_id
+        self.ttl = ttl
+        self.vnodes = vnodes
+        self.ring = HashRing([instance_id], vnodes)
+
+    def heartbeat(self):
+        now = datetime.datetime.utcnow()
+        self.database.instances.update_one(
+            {'id': self.instance_id},
+            {'$set': {'heartbeat': now, 'expires': now + datetime.timedelta(seconds=self.ttl)}},
+            upsert=True)
+        self.refresh(now)
+
+    def refresh(self, now=None):
+        now = now or datetime.datetime.utcnow()
+        members = set(r['id'] for r in self.database.instances.find(
+            {'expires': {'$gt': now}}, {'id': 1, '_id': 0}))
+        members.add(self.instance_id)
+
+        if members != set(self.ring.members):
+            _log.info(f'Rebalancing work across {len(members)} instances: {sorted(members)}')
+            self.ring = HashRing(members, self.vnodes)
+
+    def leave(self):
+        self.database.instances.delete_one({'id': self.instance_id})
+
+    def owns(self, key):
+        return self.ring.get(key) == self.instance_id
+
+    def members(self):
+        return list(self.ring.members)
+
+
+class Coordination(DependencyProvider):
+    def start(self):
+        config = self.container.config
+        database = [d for d in self.container.dependencies if isinstance(d, MongoDatabase)][0].database
+
+        instance_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.interval = config.get('COORDINATION_HEARTBEAT', 10)
+        self.coordinator = Coordinator(database, instance_id,
+                                       ttl=config.get('COORDINATION_TTL', 30),
+                                       vnodes=config.get('COORDINATION_VNODES', 64),
+                                       replica=config.get('COORDINATION_REPLICA') or socket.gethostname())
+        self._beat()
+        self.gt = self.container.spawn_managed_thread(self._run)
+
+    def _beat(self):
+        try:
+            self.coordinator.heartbeat()
+        except PyMongoError as e:
+            _log.error(f'Heartbeat of {self.coordinator.instance_id} failed: {str(e)}')
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.interval)
+            self._beat()
+
+    def get_dependency(self, worker_ctx):
+        return self.coordinator
+
+    def stop(self):
+        self.gt.kill()
+        try:
+            self.coordinator.leave()
+        except PyMongoError:
+            pass
+        self.coordinator = None
+        del self.coordinator
+
+    def kill(self):
+        self.gt.kill()
+        self.coordinator = None
+        del self.coordinator
@@ -0,0 +1,157 @@
+import os
+import time
+import socket
+import logging
+import datetime
+import contextlib
+
+from pymongo.errors import DuplicateKeyError
+from nameko.extensions import DependencyProvider
+from nameko_mongodb.database import MongoDatabase
+
+from application.dependencies.metrics import COUNTER, GAUGE
+
+
+_log = logging.getLogger(__name__)
+
+
+class Cycle(object):
+    def __init__(self, registry, name, budget=None, scope=None):
+        self.registry = registry
+        self.name = name
+        self.budget = budget
+        self.scope = scope
+        self.started = time.monotonic()
+        self.completed = False
+        self.lost = False
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def exceeded(self):
+        return self.budget is not None and self.elapsed() > self.budget
+
+    def stopped(self):
+        return self.lost or self.exceeded()
+
+    def cursor(self):
+        doc = self.registry.database.cycles.find_one({'name': self.name, 'scope': self.scope},
+                                                     {'cursor': 1, '_id': 0})
+        return doc.get('cursor') if doc else None
+
+    def advance(self, cursor):
+        if self.lost:
+            return False
+
+        if not self.registry._lock(self.name, self.scope):
+            _log.warning(f'Cycle {self.name} lost its lock, stopping after {cursor}')
+            self.lost = True
+            return False
+
+        self.registry.database.cycles.update_one(
+            {'name': self.name, 'scope': self.scope},
+            {'$set': {'cursor': cursor, 'updated': datetime.datetime.utcnow()}},
+            upsert=True)
+        return True
+
+    def complete(self):
+        if self.lost:
+            return
+        self.registry.database.cycles.delete_one({'name': self.name, 'scope': self.scope})
+        self.completed = True
+
+
+class CycleRegistry(object):
+    def __init__(self, database, owner=None, lock_ttl=None):
+        self.database = database
+        self.owner = owner or f'{socket.gethostname()}-{os.getpid()}'
+        self.lock_ttl = lock_ttl
+        self.running = dict()
+        self.stats = dict()
+
+    def _get_stats(self, name):
+        return self.stats.setdefault(name, {
+            'runs': 0, 'completed': 0, 'overlaps': 0, 'skipped_ticks': 0, 'budget_exceeded': 0,
+            'last_duration': None, 'max_duration': 0., 'total_duration': 0.
+        })
+
+    def _lock(self, name, scope=None):
+        if not self.lock_ttl:
+            return True
+
+        now = datetime.datetime.utcnow()
+        try:
+            self.database.locks.update_one(
+                {'name': name, 'scope': scope, '$or': [{'expires': {'$lt': now}}, {'owner': self.owner}]},
+                {'$set': {'owner': self.owner, 'expires': now + datetime.timedelta(seconds=self.lock_ttl)}},
+                upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def _unlock(self, name, scope=None):
+        if self.lock_ttl:
+            self.database.locks.delete_one({'name': name, 'scope': scope, 'owner': self.owner})
+
+    @contextlib.contextmanager
+    def guard(self, name, interval=None, scope=None):
+        # Cursors and locks are kept per scope (the replica owning a partition of the keys), so that replicas
+        # neither resume from each other's cursor nor block each other, while a restarted replica resumes its own
+        stats = self._get_stats(name)
+
+        if name in self.running or not self._lock(name, scope):
+            stats['overlaps'] += 1
+            stats['skipped_ticks'] += 1
+            _log.warning(f'Cycle {name} is already running, skipping this tick')
+            yield None
+            return
+
+        cycle = Cycle(self, name, budget=interval, scope=scope)
+        self.running[name] = cycle
+        stats['runs'] += 1
+
+        try:
+            yield cycle
+        finally:
+            del self.running[name]
+            self._unlock(name, scope)
+
+            duration = cycle.elapsed()
+            stats['last_duration'] = duration
+            stats['max_duration'] = max(stats['max_duration'], duration)
+            stats['total_duration'] += duration
+
+            if cycle.completed:
+                stats['completed'] += 1
+            if cycle.exceeded():
+                stats['budget_exceeded'] += 1
+                _log.warning(f'Cycle {name} took {duration:.1f}s, longer than its {interval}s interval')
+            if interval:
+                stats['skipped_ticks'] += int(duration // interval)
+
+    def get_stats(self):
+        return {name: {**s, 'running': name in self.running} for name, s in self.stats.items()}
+
+
+class Cycles(DependencyProvider):
+    COUNTERS = frozenset(['runs', 'completed', 'overlaps', 'skipped_ticks', 'budget_exceeded', 'total_duration'])
+
+    def start(self):
+        database = [d for d in self.container.dependencies if isinstance(d, MongoDatabase)][0].database
+        self.registry = CycleRegistry(database, lock_ttl=self.container.config.get('CYCLE_LOCK_TTL'))
+
+    def get_dependency(self, worker_ctx):
+        return self.registry
+
+    def collect_metrics(self):
+        for name, stats in self.registry.get_stats().items():
+            for k, v in stats.items():
+                yield f'cycle_{k}', {'cycle': name}, v, COUNTER if k in self.COUNTERS else GAUGE
+
+    def stop(self):
+        self.registry = None
+        del self.registry
+
+    def kill(self):
+        self.registry = None
+        del self.registry
@@ -0,0 +1,212 @@
+import os
+import time
+import bisect
+import logging
+import tempfile
+import contextlib
+
+import eventlet
+from nameko.extensions import DependencyProvider
+
+
+_log = logging.getLogger(__name__)
+
+PREFIX = 'opta_collector_'
+
+# Collectors yield (name, labels, value) for gauges, and (name, labels, value, COUNTER) for monotonic values
+GAUGE = 'gauge'
+COUNTER = 'counter'
+
+# 1ms to ~2mn and 256B to ~256MB
+TIME_BOUNDS = [0.001 * 2 ** (i / 2) for i in range(35)]
+SIZE_BOUNDS = [256 * 4 ** i for i in range(11)]
+
+
+def _get_bounds(name):
+    return SIZE_BOUNDS if name.endswith('_bytes') else TIME_BOUNDS
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + (list(extra.items()) if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= q * self.count:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95), 'p99': self.percentile(0.99)}
+
+
+class Stopwatch(object):
+    # Adds up the time spent in several blocks, to time a stage interleaved with others
+    def __init__(self):
+        self.elapsed = 0.
+
+    @contextlib.contextmanager
+    def running(self):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.elapsed += time.monotonic() - start
+
+
+class Registry(object):
+    def __init__(self):
+        self.histograms = dict()
+        self.counters = dict()
+        self.collectors = []
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(_get_bounds(name))
+        histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def register(self, collector):
+        self.collectors.append(collector)
+
+    def unregister(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def _collect(self):
+        collected = dict()
+        for collector in self.collectors:
+            try:
+                for name, labels, value, *kind in collector():
+                    collected[(name, tuple(sorted(labels.items())))] = (value, kind[0] if kind else GAUGE)
+            except Exception as e:
+                _log.warning(f'Metrics collector {collector} failed: {str(e)}')
+        return collected
+
+    def snapshot(self):
+        def group(items, value):
+            results = dict()
+            for (name, labels), v in sorted(items.items()):
+                results.setdefault(name, []).append({'labels': dict(labels), **value(v)})
+            return results
+
+        collected = self._collect()
+        counters = {**self.counters, **{k: v for k, (v, kind) in collected.items() if kind == COUNTER}}
+
+        return {
+            'counters': group(counters, lambda v: {'value': v}),
+            'histograms': group(self.histograms, lambda h: h.snapshot()),
+            'gauges': group({k: v for k, (v, kind) in collected.items() if kind == GAUGE}, lambda v: {'value': v})
+        }
+
+    def to_prometheus(self):
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {PREFIX}{name} {kind}')
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, 'counter')
+            lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value}')
+
+        for (name, labels), h in sorted(self.histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, c in zip(h.bounds, h.counts):
+                cumulative += c
+                lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, {"le": f"{bound:g}"})} {cumulative}')
+            lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, {"le": "+Inf"})} {h.count}')
+            lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {h.sum}')
+            lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {h.count}')
+
+        for (name, labels), (value, kind) in sorted(self._collect().items()):
+            if value is None:
+                continue
+            declare(name, kind)
+            lines.append(f'{PREFIX}{name}{_format_labels(labels)} {float(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.to_prometheus())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+
+
+REGISTRY = Registry()
+
+
+class Metrics(DependencyProvider):
+    def start(self):
+        config = self.container.config
+        self.collectors = [d.collect_metrics for d in self.container.dependencies if hasattr(d, 'collect_metrics')]
+        for c in self.collectors:
+            REGISTRY.register(c)
+
+        self.path = config.get('METRICS_TEXTFILE')
+        self.interval = config.get('METRICS_INTERVAL', 15)
+        if self.path:
+            self.container.spawn_managed_thread(self._run)
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.interval)
+            try:
+                REGISTRY.write_textfile(self.path)
+            except OSError as e:
+                _log.error(f'Could not write metrics to {self.path}: {str(e)}')
+
+    def get_dependency(self, worker_ctx):
+        return REGISTRY
+
+    def stop(self):
+        for c in self.collectors:
+            REGISTRY.unregister(c)
+
+    def kill(self):
+        for c in self.collectors:
+            REGISTRY.unregister(c)
@@ -1,12 +1,22 @@
+import re
+import copy
 import datetime
+import collections
 import pytz
 import hashlib
+import time
 
+import eventlet
+import eventlet.event
+import eventlet.corolocal
 import requests
 from lxml import etree
 import dateutil.parser
 from nameko.dependency_providers import DependencyProvider
 
+from application.dependencies import resilience
+from application.dependencies.metrics import REGISTRY, COUNTER, GAUGE
+
 
 class OptaParser(object):
     def _compute_fingerprint(self, fields):
@@ -563,7 +573,7 @@ class OptaF9Parser(OptaParser):
 
         return results
 
-    def get_player_stats(self):
+    def get_player_stats(self, wide=False):
         results = []
 
         node = self.tree.xpath('SoccerDocument')[0]
@@ -618,6 +628,28 @@ class OptaF9Parser(OptaParser):
 
                 stats = p.xpath('Stat')
 
+                if wide:
+                    results.append({
+                        **{s.get('Type'): s.text for s in stats if s.get('Type') != 'formation_place'},
+                        'player_id': player_id,
+                        'competition_id': competition_id,
+                        'season_id': season_id,
+                        'match_id': match_id,
+                        'team_id': team_id,
+                        'score': score,
+                        'shootout_score': sh_score,
+                        'side': side,
+                        'formation_used': formation_used,
+                        'official_id': official_id,
+                        'main_position': position,
+                        'sub_position': sub_position,
+                        'shirt_number': shirt_number,
+                        'status': status,
+                        'captain': captain,
+                        'formation_place': formation_place
+                    })
+                    continue
+
                 for s in stats:
                     # Stat level data
                     _type = s.get('Type')
@@ -888,7 +920,7 @@ class OptaRU7Parser(OptaParser):
             })
         return players
 
-    def get_team_stats(self):
+    def get_team_stats(self, wide=False):
         teamstats = list()
 
         match_id = self.tree.get('id')
@@ -897,6 +929,16 @@ class OptaRU7Parser(OptaParser):
             team_id = team.get('team_id')
             side = team.get('home_or_away')
 
+            if wide:
+                teamstats.append({
+                    **{k: self._handle_stat(v) for stat in team.xpath('TeamStats/TeamStat')
+                       for k, v in stat.attrib.items() if k not in ('id', 'game_id', 'team_id')},
+                    'team_id': team_id,
+                    'side': side,
+                    'match_id': match_id
+                })
+                continue
+
             for stat in team.xpath('TeamStats/TeamStat'):
                 for k, v in stat.attrib.items():
                     if k not in ('id', 'game_id', 'team_id'):
@@ -910,7 +952,7 @@ class OptaRU7Parser(OptaParser):
 
         return teamstats
 
-    def get_player_stats(self):
+    def get_player_stats(self, wide=False):
         playerstats = list()
 
         match_id = self.tree.get('id')
@@ -924,6 +966,19 @@ class OptaRU7Parser(OptaParser):
                 position = player.get('position')
                 position_id = player.get('position_id')
 
+                if wide:
+                    playerstats.append({
+                        **{k: self._handle_stat(v) for stat in player.xpath('PlayerStats/PlayerStat')
+                           for k, v in stat.items() if k not in ('game_id', 'team_id', 'player_id', 'id',)},
+                        'match_id': match_id,
+                        'team_id': team_id,
+                        'side': side,
+                        'player_id': player_id,
+                        'position_name': position,
+                        'position_id': position_id
+                    })
+                    continue
+
                 for stat in player.xpath('PlayerStats/PlayerStat'):
                     for k, v in stat.items():
                         if k not in ('game_id', 'team_id', 'player_id', 'id',):
@@ -945,18 +1000,177 @@ class OptaWebServiceError(Exception):
     pass
 
 
+class TTLCache(object):
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        if self.ttl > 0:
+            self.entries[key] = (time.monotonic(), value)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        return {'ttl': self.ttl, 'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self.calls = dict()
+        self.upstream = 0
+        self.saved = 0
+
+    def do(self, key, fn):
+        call = self.calls.get(key)
+        if call is not None:
+            self.saved += 1
+            return copy.deepcopy(call.wait())
+
+        call = eventlet.event.Event()
+        self.calls[key] = call
+        self.upstream += 1
+        try:
+            result = fn()
+        except Exception as e:
+            call.send_exception(e)
+            raise
+        except BaseException:
+            # Timeout or GreenletExit are meant for the leader only, waiters must not hang on it
+            call.send_exception(OptaWebServiceError(f'Call to {key} was interrupted'))
+            raise
+        else:
+            call.send(result)
+            return result
+        finally:
+            if self.calls.get(key) is call:
+                del self.calls[key]
+
+    def stats(self):
+        return {'in_flight': len(self.calls), 'upstream_calls': self.upstream, 'saved_calls': self.saved}
+
+
 class OptaWebService(object):
-    def __init__(self, url, user, password):
+    HEDGED_FEEDS = ('F9', 'RU7')
+    UNHEALTHY_STATUSES = frozenset([429, *range(500, 600)])
+    ERROR_ENVELOPE = re.compile(rb'\s*(<\?xml[^>]*\?>\s*)?<response[\s>/]')
+    ENVELOPE_ERROR = re.compile(rb'<(error|code)[\s>]|\scode=', re.I)
+    # A game that is scheduled but not played yet is answered with a <response> too
+    NO_DATA = re.compile(rb'no data|not (yet )?(available|found|played)|does not exist|no (such )?(game|match|feed)',
+                         re.I)
+
+    def __init__(self, url, user, password, squads_ttl=0, stats_layout='long', timeout=30, hedge=False,
+                 rate_limit=0, rate_limits=None, rate_burst=5, breaker_threshold=5, breaker_reset=30):
         self.f9_url = url
         self.f1_url = url + '/competition.php'
         self.user = user
         self.password = password
+        self.squads_cache = TTLCache(squads_ttl)
+        self.wide = stats_layout == 'wide'
+        self.flights = SingleFlight()
+        self.latencies = resilience.LatencyTracker(timeout=timeout)
+        self.hedge = hedge
+
+        rate_limits = resilience.parse_rates(rate_limits)
+        self.limiters = collections.defaultdict(
+            lambda: resilience.TokenBucket(rate_limit, rate_burst))
+        for feed, rate in rate_limits.items():
+            self.limiters[feed] = resilience.TokenBucket(rate, rate_burst)
+        self.breakers = collections.defaultdict(
+            lambda: resilience.CircuitBreaker(breaker_threshold, breaker_reset))
+        self.local = eventlet.corolocal.local()
+
+    def _request(self, feed, url, params, timeout):
+        self.limiters[feed].acquire()
+
+        start = time.monotonic()
+        timer = eventlet.Timeout(timeout)
+        try:
+            r = requests.get(url, params=params, timeout=timeout)
+        except eventlet.Timeout as t:
+            if t is not timer:
+                raise
+            r = None
+        except requests.Timeout:
+            r = None
+        except requests.RequestException as e:
+            self.breakers[feed].failure()
+            raise OptaWebServiceError(f'{feed} request failed: {str(e)}')
+        finally:
+            timer.cancel()
+
+        if r is None:
+            self.latencies.record(feed, timeout)
+            self.latencies.timeouts[feed] += 1
+            self.breakers[feed].failure()
+            raise OptaWebServiceError(f'{feed} request timed out after {timeout:.2f}s')
+
+        elapsed = time.monotonic() - start
+        self.latencies.record(feed, elapsed)
+        REGISTRY.observe('fetch_seconds', elapsed, feed=feed)
+        REGISTRY.observe('response_bytes', len(r.content), feed=feed)
+
+        if r.status_code in self.UNHEALTHY_STATUSES:
+            self.breakers[feed].failure()
+            raise OptaWebServiceError(f'{feed} request failed with status {r.status_code}')
+
+        # Opta answers some errors with a 200 and a <response> error document
+        if self._is_error_envelope(r.content):
+            self.breakers[feed].failure()
+        else:
+            self.breakers[feed].success()
+        return r
+
+    def _is_error_envelope(self, content):
+        return bool(self.ERROR_ENVELOPE.match(content) and self.ENVELOPE_ERROR.search(content)
+                    and not self.NO_DATA.search(content))
+
+    def _get(self, feed, url, params=None):
+        try:
+            self.breakers[feed].allow()
+        except resilience.CircuitOpenError as e:
+            raise OptaWebServiceError(f'{feed} requests are suspended: {str(e)}')
+
+        timeout = self.latencies.timeout(feed)
+        delay = self.latencies.hedge_after(feed) if self.hedge and feed in self.HEDGED_FEEDS else None
+
+        def on_hedge():
+            self.latencies.hedges[feed] += 1
+
+        start = time.monotonic()
+        r = resilience.hedged(lambda: self._request(feed, url, params, timeout), delay, on_hedge)
+        self.local.fetched = time.monotonic() - start
+        return r
+
+    def _timed(self, feed, fn, *args):
+        self.local.fetched = 0.
+        start = time.monotonic()
+        result = fn(*args)
+        REGISTRY.observe('parse_seconds', time.monotonic() - start - self.local.fetched, feed=feed)
+        return result
 
     def get_soccer_calendar(self, season_id, competition_id):
+        return self.flights.do(('F1', season_id, competition_id), lambda: self._timed('F1', self._fetch_soccer_calendar, season_id, competition_id))
+
+    def _fetch_soccer_calendar(self, season_id, competition_id):
         params = {'feed_type': 'F1', 'user': self.user, 'psw': self.password, 'competition': competition_id,
                   'season_id': season_id}
 
-        r = requests.get(self.f1_url, params=params)
+        r = self._get('F1', self.f1_url, params)
 
         parser = OptaF1Parser(r.content)
 
@@ -970,10 +1184,13 @@ class OptaWebService(object):
         return calendar
 
     def get_rugby_calendar(self, season_id, competition_id):
+        return self.flights.do(('RU1', season_id, competition_id), lambda: self._timed('RU1', self._fetch_rugby_calendar, season_id, competition_id))
+
+    def _fetch_rugby_calendar(self, season_id, competition_id):
         params = {'feed_type': 'RU1', 'user': self.user, 'psw': self.password, 'competition': competition_id,
                   'season_id': season_id}
 
-        r = requests.get(self.f1_url, params=params)
+        r = self._get('RU1', self.f1_url, params)
 
         parser = OptaRU1Parser(r.content)
 
@@ -1101,91 +1318,156 @@ class OptaWebService(object):
 
     def _check_mins_played(self, player_stats):
         for s in player_stats:
-            if s['type'] == 'mins_played':
+            if s.get('type') == 'mins_played' or 'mins_played' in s:
                 return True
         return False
 
     def get_soccer_game(self, game_id):
+        return self.flights.do(('F9', game_id), lambda: self._timed('F9', self._fetch_soccer_game, game_id))
+
+    def parse_soccer_game(self, content, final_only=True):
+        parser = OptaF9Parser(content)
+
+        match_info = parser.get_match_info()
+        player_stats = parser.get_player_stats(wide=self.wide)
+        if final_only and not (match_info['period'] == 'FullTime' and self._check_mins_played(player_stats)):
+            return None
+
+        return {
+            'season': parser.get_season(),
+            'competition': parser.get_competition(),
+            'venue': parser.get_venue(),
+            'teams': parser.get_teams(),
+            'persons': parser.get_persons(),
+            'match_info': match_info,
+            'events': self._compute_soccer_events(parser),
+            'team_stats': parser.get_team_stats(),
+            'player_stats': player_stats,
+            'stats_layout': 'wide' if self.wide else 'long'
+        }
+
+    def _fetch_soccer_game(self, game_id):
         game = None
         params = {'feed_type': 'F9', 'game_id': game_id, 'user': self.user, 'psw': self.password}
         url = self.f9_url + "/?feed_type={feed_type}&game_id={game_id}&user={user}&psw={psw}".format(**params)
-        r = requests.get(url)
+        r = self._get('F9', url)
 
         if 'response' in r.text:
             return game
 
         try:
-            parser = OptaF9Parser(r.content)
-
-            match_info = parser.get_match_info()
-            player_stats = parser.get_player_stats()
-            if match_info['period'] == 'FullTime' and self._check_mins_played(player_stats):
-                events = self._compute_soccer_events(parser)
-
-                game = {
-                    'season': parser.get_season(),
-                    'competition': parser.get_competition(),
-                    'venue': parser.get_venue(),
-                    'teams': parser.get_teams(),
-                    'persons': parser.get_persons(),
-                    'match_info': match_info,
-                    'events': events,
-                    'team_stats': parser.get_team_stats(),
-                    'player_stats': player_stats
-                }
+            game = self.parse_soccer_game(r.content)
         except Exception:
             raise OptaWebServiceError('Error while parsing F9 with params: {game}'.format(game=game_id))
 
         return game
 
     def get_rugby_game(self, game_id):
+        return self.flights.do(('RU7', game_id), lambda: self._timed('RU7', self._fetch_rugby_game, game_id))
+
+    def parse_rugby_game(self, content, final_only=True):
+        parser = OptaRU7Parser(content)
+
+        rrml = parser.get_rrml()
+        if final_only and rrml['status'] != 'Result':
+            return None
+
+        return {
+            'rrml': rrml,
+            'events': parser.get_events(),
+            'official': parser.get_official(),
+            'teams': parser.get_teams(),
+            'players': parser.get_players(),
+            'team_stats': parser.get_team_stats(wide=self.wide),
+            'player_stats': parser.get_player_stats(wide=self.wide),
+            'stats_layout': 'wide' if self.wide else 'long'
+        }
+
+    def _fetch_rugby_game(self, game_id):
         game = None
         params = {'feed_type': 'RU7', 'game_id': game_id, 'user': self.user, 'psw': self.password}
 
-        r = requests.get(self.f9_url, params=params)
+        r = self._get('RU7', self.f9_url, params)
 
         if 'response' in r.text:
             return game
 
         try:
-            parser = OptaRU7Parser(r.content)
-            rrml = parser.get_rrml()
-            if rrml['status'] == 'Result':
-                game = {
-                    'rrml': rrml,
-                    'events': parser.get_events(),
-                    'official': parser.get_official(),
-                    'teams': parser.get_teams(),
-                    'players': parser.get_players(),
-                    'team_stats': parser.get_team_stats(),
-                    'player_stats': parser.get_player_stats()
-                }
+            game = self.parse_rugby_game(r.content)
         except Exception:
             raise OptaWebServiceError('Error while parsing RU7 with params: {game}'.format(game=game_id))
 
         return game
 
-    def get_soccer_squads(self, season_id, competition_id):
+    def get_soccer_squads(self, season_id, competition_id, force=False):
+        key = (season_id, competition_id)
+
+        if force:
+            self.squads_cache.invalidate(key)
+        else:
+            squads = self.squads_cache.get(key)
+            if squads is not None:
+                return squads
+
+        return self.flights.do(('F40', season_id, competition_id),
+                               lambda: self._timed('F40', self._fetch_soccer_squads, season_id, competition_id))
+
+    def _fetch_soccer_squads(self, season_id, competition_id):
         params = {'feed_type': 'F40', 'user': self.user, 'psw': self.password, 'competition': competition_id,
                   'season_id': season_id}
 
-        r = requests.get(self.f1_url, params=params)
+        r = self._get('F40', self.f1_url, params)
 
         parser = OptaF40Parser(r.content)
 
         try:
-            return parser.get_squads()
+            squads = parser.get_squads()
         except Exception as e:
             raise OptaWebServiceError(
                 f'Error while parsing F40 with params {season_id} {competition_id}: {str(e)}')
 
+        self.squads_cache.set((season_id, competition_id), squads)
+        return squads
+
 
 class OptaDependency(DependencyProvider):
+    def setup(self):
+        config = self.container.config
+        self.opta_webservice = OptaWebService(config['OPTA_URL'], config['OPTA_USER'], config['OPTA_PASSWORD'],
+                                              squads_ttl=config.get('OPTA_F40_TTL', 6*60*60),
+                                              stats_layout=config.get('OPTA_STATS_LAYOUT', 'long'),
+                                              timeout=config.get('OPTA_TIMEOUT', 30),
+                                              hedge=config.get('OPTA_HEDGE', False),
+                                              rate_limit=config.get('OPTA_RATE_LIMIT', 0),
+                                              rate_limits=config.get('OPTA_RATE_LIMITS'),
+                                              rate_burst=config.get('OPTA_RATE_BURST', 5),
+                                              breaker_threshold=config.get('OPTA_BREAKER_THRESHOLD', 5),
+                                              breaker_reset=config.get('OPTA_BREAKER_RESET', 30))
+
     def get_dependency(self, worker_ctx):
-        self.opta_webservice = OptaWebService(self.container.config['OPTA_URL'], self.container.config['OPTA_USER'],
-                                              self.container.config['OPTA_PASSWORD'])
         return self.opta_webservice
 
+    def collect_metrics(self):
+        webservice = self.opta_webservice
+        states = {resilience.CircuitBreaker.CLOSED: 0, resilience.CircuitBreaker.HALF_OPEN: 1,
+                  resilience.CircuitBreaker.OPEN: 2}
+
+        for feed, stats in webservice.latencies.stats().items():
+            yield 'request_timeout_seconds', {'feed': feed}, stats['timeout']
+            yield 'request_timeouts', {'feed': feed}, stats['timeouts'], COUNTER
+            yield 'request_hedges', {'feed': feed}, stats['hedges'], COUNTER
+        for feed, limiter in webservice.limiters.items():
+            yield 'rate_limit_waits', {'feed': feed}, limiter.waits, COUNTER
+            yield 'rate_limit_waited_seconds', {'feed': feed}, limiter.waited, COUNTER
+        for feed, breaker in webservice.breakers.items():
+            yield 'breaker_state', {'feed': feed}, states[breaker.state]
+            yield 'breaker_opened', {'feed': feed}, breaker.opened, COUNTER
+            yield 'breaker_rejected', {'feed': feed}, breaker.rejected, COUNTER
+        for k, v in webservice.flights.stats().items():
+            yield f'coalescing_{k}', {}, v, GAUGE if k == 'in_flight' else COUNTER
+        for k, v in webservice.squads_cache.stats().items():
+            yield f'squads_cache_{k}', {}, v, COUNTER if k in ('hits', 'misses') else GAUGE
+
     def stop(self):
         self.opta_webservice = None
         del self.opta_webservice
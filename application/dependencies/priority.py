@@ -0,0 +1,78 @@
+import time
+import heapq
+import itertools
+
+import eventlet.event
+from nameko.extensions import DependencyProvider
+
+
+class FetchRequest(object):
+    def __init__(self, sport, game_id, priority):
+        self.sport = sport
+        self.game_id = game_id
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.event = eventlet.event.Event()
+
+    def done(self, status):
+        self.event.send({
+            'sport': self.sport,
+            'id': self.game_id,
+            'status': status,
+            'published': status not in (None, 'UNCHANGED'),
+            'time_to_publish': time.monotonic() - self.enqueued
+        })
+
+    def wait(self, timeout=None):
+        with eventlet.Timeout(timeout, False):
+            return self.event.wait()
+        return {'sport': self.sport, 'id': self.game_id, 'status': 'PENDING', 'published': False,
+                'time_to_publish': None}
+
+
+class PriorityQueue(object):
+    def __init__(self):
+        self.heap = []
+        self.queued = dict()
+        self.counter = itertools.count()
+
+    def push(self, sport, game_id, priority=0):
+        request = self.queued.get((sport, game_id))
+        if request is not None:
+            if priority < request.priority:
+                # The entry already in the heap goes stale and is skipped when popped
+                request.priority = priority
+                heapq.heappush(self.heap, (priority, next(self.counter), request))
+            return request
+
+        request = FetchRequest(sport, game_id, priority)
+        self.queued[(sport, game_id)] = request
+        heapq.heappush(self.heap, (priority, next(self.counter), request))
+        return request
+
+    def drain(self):
+        while self.heap:
+            priority, _, request = heapq.heappop(self.heap)
+            if priority != request.priority:
+                continue
+            del self.queued[(request.sport, request.game_id)]
+            yield request
+
+    def __len__(self):
+        return len(self.queued)
+
+
+class FetchQueue(DependencyProvider):
+    def setup(self):
+        self.queue = PriorityQueue()
+
+    def get_dependency(self, worker_ctx):
+        return self.queue
+
+    def stop(self):
+        self.queue = None
+        del self.queue
+
+    def kill(self):
+        self.queue = None
+        del self.queue
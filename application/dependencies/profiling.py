@@ -0,0 +1,254 @@
+import io
+import os
+import time
+import signal
+import pstats
+import cProfile
+import logging
+import collections
+
+import eventlet
+import eventlet.hubs
+import greenlet
+from nameko.extensions import DependencyProvider
+
+
+_log = logging.getLogger(__name__)
+
+CPROFILE = 'cprofile'
+SAMPLING = 'sampling'
+
+# Profiling entrypoints are never profiled themselves
+IGNORED = frozenset(['start_profiling', 'stop_profiling', 'get_profile'])
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class ProfilingSession(object):
+    def __init__(self, mode, seconds=None, cycles=None, entrypoints=None, interval=0.005):
+        if mode not in (CPROFILE, SAMPLING):
+            raise ValueError(f'Unknown profiling mode {mode}')
+
+        self.mode = mode
+        self.seconds = seconds
+        self.cycles = cycles
+        self.entrypoints = frozenset(entrypoints) if entrypoints else None
+        self.interval = interval
+        self.started = time.monotonic()
+        self.stopped = None
+        self.cycles_done = 0
+        self.workers = dict()
+        self.stats = dict()
+        self.samples = collections.Counter()
+        self.previous_trace = None
+        self.previous_handler = None
+        self.files = []
+
+    def wants(self, entrypoint):
+        return entrypoint not in IGNORED and (self.entrypoints is None or entrypoint in self.entrypoints)
+
+    def expired(self):
+        if self.seconds is not None and time.monotonic() - self.started >= self.seconds:
+            return True
+        return self.cycles is not None and self.cycles_done >= self.cycles
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            current = self.workers.get(origin)
+            if current is not None:
+                current[1].disable()
+            following = self.workers.get(target)
+            if following is not None:
+                following[1].enable()
+
+        if self.previous_trace is not None:
+            self.previous_trace(event, args)
+
+    def _sample(self, signum, frame):
+        current = self.workers.get(greenlet.getcurrent())
+        if current is not None:
+            name = current[0]
+        elif greenlet.getcurrent() is eventlet.hubs.get_hub().greenlet:
+            name = 'hub'
+        else:
+            name = 'other'
+
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+
+        self.samples[';'.join([name] + stack[::-1])] += 1
+
+    def start(self):
+        if self.mode == CPROFILE:
+            self.previous_trace = greenlet.settrace(self._trace)
+        else:
+            self.previous_handler = signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if self.stopped is not None:
+            return
+
+        if self.mode == CPROFILE:
+            greenlet.settrace(self.previous_trace)
+            for name, profile in self.workers.values():
+                profile.disable()
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+        self.stopped = time.monotonic()
+
+    def worker_setup(self, entrypoint):
+        if self.stopped is not None or not self.wants(entrypoint):
+            return
+
+        profile = cProfile.Profile() if self.mode == CPROFILE else None
+        self.workers[greenlet.getcurrent()] = (entrypoint, profile)
+        if profile is not None:
+            profile.enable()
+
+    def worker_result(self, entrypoint, task=False):
+        current = self.workers.pop(greenlet.getcurrent(), None)
+        if current is None:
+            return
+
+        name, profile = current
+        if profile is not None:
+            profile.disable()
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile)
+
+        if name == 'publish' and not task:
+            self.cycles_done += 1
+
+    def summary(self):
+        return {
+            'mode': self.mode,
+            'running': self.stopped is None,
+            'duration': (self.stopped or time.monotonic()) - self.started,
+            'cycles': self.cycles_done,
+            'entrypoints': sorted(self.stats) if self.mode == CPROFILE else sorted(
+                set(s.split(';', 1)[0] for s in self.samples)),
+            'samples': sum(self.samples.values()),
+            'files': self.files
+        }
+
+    def pstats_text(self, entrypoint, limit=50):
+        stream = io.StringIO()
+        stats = self.stats[entrypoint]
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def collapsed(self, entrypoint=None):
+        return '\n'.join(f'{stack} {count}' for stack, count in sorted(self.samples.items())
+                         if entrypoint is None or stack.split(';', 1)[0] == entrypoint)
+
+    def save(self, directory):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        paths = []
+        if self.mode == CPROFILE:
+            for name, stats in self.stats.items():
+                path = os.path.join(directory, f'{name}-{stamp}.pstats')
+                stats.dump_stats(path)
+                paths.append(path)
+        elif self.samples:
+            path = os.path.join(directory, f'profile-{stamp}.collapsed')
+            with open(path, 'w') as f:
+                f.write(self.collapsed() + '\n')
+            paths.append(path)
+        return paths
+
+
+class Profiler(DependencyProvider):
+    def __init__(self, **kwargs):
+        self.session = None
+        self.output_dir = None
+        self.timer = None
+        super(Profiler, self).__init__(**kwargs)
+
+    def setup(self):
+        self.output_dir = self.container.config.get('PROFILE_DIR')
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+    def start_profiling(self, mode=SAMPLING, seconds=None, cycles=None, entrypoints=None, interval=0.005):
+        if self.session is not None and self.session.stopped is None:
+            raise RuntimeError('A profiling session is already running')
+
+        if seconds is None and cycles is None:
+            seconds = 60
+
+        self.session = ProfilingSession(mode, seconds, cycles, entrypoints, interval)
+        self.session.start()
+        if seconds is not None:
+            self.timer = eventlet.spawn_after(seconds, self.stop_profiling)
+
+        _log.info(f'Profiling started: {self.session.summary()}')
+        return self.session.summary()
+
+    def stop_profiling(self):
+        session = self.session
+        if session is None:
+            return None
+
+        if session.stopped is None:
+            session.stop()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            if self.output_dir:
+                session.files = session.save(self.output_dir)
+            _log.info(f'Profiling stopped: {session.summary()}')
+
+        return session.summary()
+
+    def get_profile(self, format='pstats', entrypoint=None, limit=50):
+        session = self.session
+        if session is None:
+            return None
+
+        if format == 'collapsed' or session.mode == SAMPLING:
+            return session.collapsed(entrypoint)
+
+        names = [entrypoint] if entrypoint else sorted(session.stats)
+        return {name: session.pstats_text(name, limit) for name in names if name in session.stats}
+
+    def worker_setup(self, worker_ctx):
+        if self.session is not None:
+            self.session.worker_setup(worker_ctx.entrypoint.method_name)
+
+    def worker_result(self, worker_ctx, result=None, exc_info=None):
+        session = self.session
+        if session is None:
+            return
+
+        session.worker_result(worker_ctx.entrypoint.method_name)
+        if session.stopped is None and session.expired():
+            self.stop_profiling()
+
+    # Bulkhead tasks run in greenlets of their own: profile them under the entrypoint that submitted them
+    def task_setup(self, entrypoint):
+        if self.session is not None and entrypoint is not None:
+            self.session.worker_setup(entrypoint)
+
+    def task_result(self, entrypoint):
+        if self.session is not None:
+            self.session.worker_result(entrypoint, task=True)
+
+    def stop(self):
+        if self.session is not None:
+            self.session.stop()
+
+    kill = stop
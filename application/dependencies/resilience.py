@@ -0,0 +1,206 @@
+import time
+import bisect
+import collections
+
+import eventlet
+import eventlet.queue
+
+
+# Geometric bucket bounds from 5ms to ~2mn
+BOUNDS = [0.005 * 2 ** (i / 2) for i in range(30)]
+
+TIMEOUT_FACTOR = 1.5
+
+
+class LatencyHistogram(object):
+    def __init__(self, window=1000):
+        self.window = window
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+        # Halve every count once the window is full so old samples fade out
+        if self.count >= self.window:
+            self.counts = [c // 2 for c in self.counts]
+            self.count = sum(self.counts)
+            self.total /= 2
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+
+        target = q * self.count
+        cumulative = 0
+        for i, c in enumerate(self.counts):
+            cumulative += c
+            if cumulative >= target:
+                return BOUNDS[min(i, len(BOUNDS) - 1)]
+        return BOUNDS[-1]
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99)
+        }
+
+
+class LatencyTracker(object):
+    def __init__(self, timeout=30, min_timeout=2, min_samples=20):
+        self.default_timeout = timeout
+        self.min_timeout = min_timeout
+        self.min_samples = min_samples
+        self.histograms = collections.defaultdict(LatencyHistogram)
+        self.timeouts = collections.Counter()
+        self.hedges = collections.Counter()
+
+    def record(self, feed, seconds):
+        self.histograms[feed].record(seconds)
+
+    def timeout(self, feed):
+        histogram = self.histograms[feed]
+        if histogram.count < self.min_samples:
+            return self.default_timeout
+        p99 = histogram.percentile(0.99)
+        return min(max(p99 * TIMEOUT_FACTOR, self.min_timeout), self.default_timeout)
+
+    def hedge_after(self, feed):
+        histogram = self.histograms[feed]
+        if histogram.count < self.min_samples:
+            return None
+        return histogram.percentile(0.95)
+
+    def stats(self):
+        return {feed: {**h.snapshot(), 'timeout': self.timeout(feed), 'timeouts': self.timeouts[feed],
+                       'hedges': self.hedges[feed]}
+                for feed, h in self.histograms.items()}
+
+
+def hedged(fn, delay, on_hedge=None):
+    if delay is None:
+        return fn()
+
+    results = eventlet.queue.LightQueue()
+
+    def run():
+        try:
+            results.put((True, fn()))
+        except Exception as e:
+            results.put((False, e))
+
+    threads = [eventlet.spawn(run)]
+    try:
+        try:
+            ok, value = results.get(timeout=delay)
+        except eventlet.queue.Empty:
+            if on_hedge is not None:
+                on_hedge()
+            threads.append(eventlet.spawn(run))
+            ok, value = results.get()
+
+        # First success wins, an error only surfaces once every attempt failed
+        if not ok and len(threads) > 1:
+            ok, value = results.get()
+    finally:
+        for t in threads:
+            t.kill()
+
+    if not ok:
+        raise value
+    return value
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.waits = 0
+        self.waited = 0.
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        if not self.rate:
+            return 0.
+
+        waited = 0.
+        self._refill()
+        while self.tokens < 1:
+            delay = (1 - self.tokens) / self.rate
+            eventlet.sleep(delay)
+            waited += delay
+            self._refill()
+        self.tokens -= 1
+
+        if waited:
+            self.waits += 1
+            self.waited += waited
+        return waited
+
+    def stats(self):
+        return {'rate': self.rate, 'burst': self.burst, 'waits': self.waits, 'waited': self.waited}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        # Let one probe through per reset period, including when a previous probe never reported back
+        if self.state != self.CLOSED and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.opened_at = time.monotonic()
+            return
+
+        if self.state != self.CLOSED:
+            self.rejected += 1
+            raise CircuitOpenError(f'Circuit is {self.state}')
+
+    def success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.opened += 1
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures, 'opened': self.opened, 'rejected': self.rejected}
+
+
+def parse_rates(rates):
+    if not rates:
+        return {}
+    if isinstance(rates, dict):
+        return {k: float(v) for k, v in rates.items()}
+    return {k.strip(): float(v) for k, v in (r.split(':') for r in str(rates).split(',') if r.strip())}
+
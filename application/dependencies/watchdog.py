@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+import logging
+import datetime
+import collections
+
+import eventlet
+import eventlet.patcher
+from nameko.extensions import DependencyProvider
+
+from application.dependencies.metrics import COUNTER
+
+
+_log = logging.getLogger(__name__)
+
+_threading = eventlet.patcher.original('threading')
+_time = eventlet.patcher.original('time')
+
+APPLICATION = os.sep + 'application' + os.sep
+
+# Locals worth reporting when they are found in an application frame
+FEED_KEYS = ('match_id', 'game_id', 'content_id', 'season_id', 'competition_id')
+
+
+def _describe(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_firstlineno}:{code.co_name}'
+
+
+def inspect_stack(frame):
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+
+    entrypoint = None
+    feed = {}
+    source = None
+    for f in frames:
+        code = f.f_code
+        if code.co_name == '_run_worker' and 'worker_ctx' in code.co_varnames:
+            worker_ctx = f.f_locals.get('worker_ctx')
+            entrypoint = getattr(getattr(worker_ctx, 'entrypoint', None), 'method_name', None)
+        elif APPLICATION in code.co_filename:
+            source = _describe(f)
+            for k in FEED_KEYS:
+                if k in code.co_varnames and f.f_locals.get(k) is not None:
+                    feed[k] = str(f.f_locals[k])
+
+    return {
+        'source': source or (_describe(frames[-1]) if frames else None),
+        'entrypoint': entrypoint,
+        'feed': feed,
+        'stack': [_describe(f) for f in frames]
+    }
+
+
+class StallWatchdog(object):
+    def __init__(self, threshold=0.5, interval=0.1, history=50, clock=time.monotonic):
+        self.threshold = threshold
+        self.interval = interval
+        self.clock = clock
+        self.stalls = collections.deque(maxlen=history)
+        self.sources = collections.Counter()
+        self.count = 0
+        self.max_duration = 0.
+        self.last_beat = clock()
+        self.pending = None
+        self.running = False
+        self.main_ident = _threading.get_ident()
+        self.beat = None
+
+    def start(self):
+        self.running = True
+        self.main_ident = _threading.get_ident()
+        self.last_beat = self.clock()
+        self.beat = eventlet.spawn(self._beat)
+        _threading.Thread(target=self._watch, name='hub-watchdog', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.beat is not None:
+            self.beat.kill()
+
+    def _beat(self):
+        while self.running:
+            self.last_beat = self.clock()
+            eventlet.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        # Runs on the hub once it is responsive again, which is when the stall duration is known
+        pending = self.pending
+        if pending is not None:
+            self.pending = None
+            self._record(pending, self.clock() - pending['since'])
+
+    def _watch(self):
+        while self.running:
+            _time.sleep(self.interval / 2)
+            self.check()
+
+    def check(self):
+        beat = self.last_beat
+        blocked = self.clock() - beat - self.interval
+        if blocked < self.threshold or self.pending is not None:
+            return
+
+        frame = sys._current_frames().get(self.main_ident)
+        if frame is None:
+            return
+
+        stall = inspect_stack(frame)
+        del frame
+        stall['since'] = beat + self.interval
+        stall['started'] = datetime.datetime.utcnow() - datetime.timedelta(seconds=blocked)
+        self.pending = stall
+
+    def _record(self, stall, duration):
+        stall = {k: v for k, v in stall.items() if k != 'since'}
+        stall['duration'] = duration
+
+        self.count += 1
+        self.sources[stall['source']] += 1
+        self.max_duration = max(self.max_duration, duration)
+        self.stalls.append(stall)
+
+        _log.warning(f'Hub blocked for {duration:.3f}s in {stall["source"]} '
+                     f'(entrypoint: {stall["entrypoint"]}, feed: {stall["feed"]})')
+
+    def stats(self):
+        return {
+            'threshold': self.threshold,
+            'stalls': self.count,
+            'max_duration': self.max_duration,
+            'sources': dict(self.sources),
+            'recent': list(self.stalls)
+        }
+
+
+class Watchdog(DependencyProvider):
+    def start(self):
+        config = self.container.config
+        threshold = config.get('WATCHDOG_THRESHOLD', 0.5)
+
+        self.watchdog = StallWatchdog(threshold, config.get('WATCHDOG_INTERVAL', 0.1))
+        if threshold:
+            self.watchdog.start()
+
+    def get_dependency(self, worker_ctx):
+        return self.watchdog
+
+    def collect_metrics(self):
+        yield 'hub_stall_max_seconds', {}, self.watchdog.max_duration
+        for source, count in self.watchdog.sources.items():
+            yield 'hub_stalls', {'source': source}, count, COUNTER
+
+    def stop(self):
+        self.watchdog.stop()
+
+    kill = stop
@@ -0,0 +1,206 @@
+import os
+import sys
+import time
+import argparse
+import datetime
+import functools
+import tracemalloc
+import collections
+
+import pytz
+
+from application.dependencies import opta
+from application.services import columnar, wire
+from application.services.opta_collector import OptaCollectorService
+
+
+PARSERS = {
+    'F1': opta.OptaF1Parser,
+    'F9': opta.OptaF9Parser,
+    'F40': opta.OptaF40Parser,
+    'RU1': opta.OptaRU1Parser,
+    'RU7': opta.OptaRU7Parser
+}
+
+PARSE = 'parse'
+TRANSFORM = 'transform'
+
+
+def count_records(result):
+    if isinstance(result, list):
+        if result and all(isinstance(r, dict) and 'records' in r for r in result):
+            return sum(len(r['records']) for r in result)
+        return len(result)
+    if isinstance(result, dict):
+        return len(result['records']) if 'records' in result else 1
+    return None
+
+
+class FeedProfile(object):
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.rows = collections.OrderedDict()
+        self.peak = None
+
+    def _memory(self):
+        return tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+
+    def call(self, stage, name, fn, *args, **kwargs):
+        before = self._memory()
+        start = time.perf_counter()
+        try:
+            return_value = fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            row = self.rows.setdefault((stage, name), {'calls': 0, 'seconds': 0., 'allocated': 0, 'records': None})
+            row['calls'] += 1
+            row['seconds'] += elapsed
+            row['allocated'] += self._memory() - before
+
+        records = count_records(return_value)
+        if records is not None:
+            row['records'] = (row['records'] or 0) + records
+        return return_value
+
+    def instrument(self, cls):
+        originals = {name: fn for name, fn in vars(cls).items()
+                     if callable(fn) and (name.startswith('get_') or name == '__init__')}
+
+        def wrap(name, fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                return self.call(PARSE, f'{cls.__name__}.{name}', fn, *args, **kwargs)
+            return wrapper
+
+        for name, fn in originals.items():
+            setattr(cls, name, wrap(name, fn))
+
+        def restore():
+            for name, fn in originals.items():
+                setattr(cls, name, fn)
+        return restore
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+
+    def stop(self):
+        if self.trace_memory:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def report(self, out=None):
+        out = out or sys.stdout
+        out.write(f'{"stage":<10} {"method":<40} {"calls":>6} {"total ms":>10} {"allocated KiB":>14} {"records":>8}\n')
+        for (stage, name), row in self.rows.items():
+            records = '' if row['records'] is None else row['records']
+            out.write(f'{stage:<10} {name:<40} {row["calls"]:>6} {row["seconds"] * 1000:>10.2f} '
+                      f'{row["allocated"] / 1024:>14.1f} {records:>8}\n')
+        if self.peak is not None:
+            out.write(f'\npeak traced memory: {self.peak / 1024:.1f} KiB\n')
+        out.write('timings are inclusive: a method calling other parser methods also counts their time\n')
+
+
+def find_fixture(calendar, game_id):
+    for row in calendar:
+        if row['id'] == game_id:
+            return row
+
+    # Offline placeholder so the referential can still be built without the RU1 feed
+    return {
+        'id': game_id, 'date': datetime.datetime.now(pytz.utc), 'season_id': None, 'competition_id': None,
+        'competition_name': None, 'venue_id': None, 'venue': None, 'group_id': None, 'group_name': None,
+        'round': None, 'home_id': None, 'away_id': None, 'home_name': None, 'away_name': None
+    }
+
+
+def profile_feed(feed_type, content, profile, stats_layout='long', calendar=None, final_only=False,
+                 serializer=wire.JSON, payload_format='rows'):
+    webservice = opta.OptaWebService('', '', '', stats_layout=stats_layout)
+    service = OptaCollectorService
+    restore = profile.instrument(PARSERS[feed_type])
+
+    try:
+        if feed_type in ('F1', 'RU1'):
+            return profile.call(PARSE, 'total', lambda: PARSERS[feed_type](content).get_calendar())
+        if feed_type == 'F40':
+            squads = profile.call(PARSE, 'total', lambda: PARSERS[feed_type](content).get_squads())
+        elif feed_type == 'F9':
+            game = profile.call(PARSE, 'total', webservice.parse_soccer_game, content, final_only)
+        else:
+            game = profile.call(PARSE, 'total', webservice.parse_rugby_game, content, final_only)
+    finally:
+        restore()
+
+    if feed_type == 'F40':
+        profile.call(TRANSFORM, '_squads_checksum', service._squads_checksum, squads)
+        datastore = profile.call(TRANSFORM, '_build_f40_datastore', service._build_f40_datastore, squads)
+    elif game is None:
+        return None
+    elif feed_type == 'F9':
+        match_id = game['match_info']['id'][1:]
+        profile.call(TRANSFORM, '_checksum', service._checksum, game)
+        referential = profile.call(TRANSFORM, '_extract_referential_from_soccer_game',
+                                   service._extract_referential_from_soccer_game, game)
+        datastore = profile.call(TRANSFORM, '_build_f9_datastore', service._build_f9_datastore,
+                                 match_id, game, referential['labels'])
+    else:
+        match_id = game['rrml']['id']
+        ru1 = find_fixture(calendar or [], match_id)
+        profile.call(TRANSFORM, '_checksum', service._checksum, game)
+        referential = profile.call(TRANSFORM, '_extract_referential_from_rugby_game',
+                                   service._extract_referential_from_rugby_game, ru1, game)
+        datastore = profile.call(TRANSFORM, '_build_ru7_datastore', service._build_ru7_datastore,
+                                 match_id, game, ru1, referential['labels'])
+
+    # Encoded as _publish_input does, so the report shows what the service pays
+    payload = datastore
+    if payload_format == columnar.COLUMNAR:
+        payload = profile.call(TRANSFORM, 'columnar', columnar.encode_datastore, datastore)
+    profile.call(TRANSFORM, 'serialize', lambda: len(wire.encode_datastore(serializer, payload)))
+    return datastore
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Profile the parsing and transform of a saved Opta feed, without network or database.')
+    parser.add_argument('feed_type', choices=sorted(PARSERS), type=str.upper)
+    parser.add_argument('path', help='saved XML document')
+    parser.add_argument('--stats-layout', choices=['long', 'wide'], default='long')
+    parser.add_argument('--calendar', help='saved RU1 document holding the fixture of a RU7 game')
+    parser.add_argument('--final-only', action='store_true',
+                        help='skip games that are not final, as the collector does')
+    parser.add_argument('--serializer', choices=[wire.JSON, wire.BSON],
+                        default=os.environ.get('OPTA_WIRE_SERIALIZER') or wire.JSON)
+    parser.add_argument('--payload-format', choices=['rows', columnar.COLUMNAR],
+                        default=os.environ.get('OPTA_PAYLOAD_FORMAT') or 'rows')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='disable tracemalloc, which slows the parsers down noticeably')
+    args = parser.parse_args(argv)
+
+    with open(args.path, 'rb') as f:
+        content = f.read()
+
+    calendar = None
+    if args.calendar:
+        with open(args.calendar, 'rb') as f:
+            calendar = opta.OptaRU1Parser(f.read()).get_calendar()
+
+    profile = FeedProfile(trace_memory=not args.no_memory)
+    profile.start()
+    try:
+        for _ in range(args.repeat):
+            result = profile_feed(args.feed_type, content, profile, args.stats_layout, calendar, args.final_only,
+                                  args.serializer, args.payload_format)
+    finally:
+        profile.stop()
+
+    print(f'{args.feed_type} {args.path}: {len(content) / 1024:.1f} KiB')
+    if result is None and args.feed_type in ('F9', 'RU7'):
+        print('game is not final, the collector would skip it')
+    profile.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import re
+import time
+import uuid
+import datetime
+
+import bson
+import bson.json_util
+import gridfs
+
+from application.services import wire
+
+GRIDFS = 'gridfs'
+FILE = 'file'
+
+CONTENT_TYPE = 'application/json'
+
+
+class GridFSStore(object):
+    def __init__(self, database, collection='claim_check'):
+        self.fs = gridfs.GridFS(database, collection=collection)
+
+    def put(self, name, data, content_type=CONTENT_TYPE):
+        _id = self.fs.put(data, filename=name, content_type=content_type)
+        return {'store': GRIDFS, 'id': str(_id), 'name': name, 'size': len(data), 'content_type': content_type}
+
+    def get(self, ref):
+        return self.fs.get(bson.ObjectId(ref['id'])).read()
+
+    def delete(self, ref):
+        self.fs.delete(bson.ObjectId(ref['id']))
+
+    def sweep(self, max_age):
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+        expired = [f._id for f in self.fs.find({'uploadDate': {'$lt': cutoff}})]
+        for _id in expired:
+            self.fs.delete(_id)
+        return len(expired)
+
+
+class FileStore(object):
+    def __init__(self, path):
+        self.path = path
+
+    def put(self, name, data, content_type=CONTENT_TYPE):
+        os.makedirs(self.path, exist_ok=True)
+        _id = '{}-{}'.format(re.sub(r'[^\w.-]', '_', name), uuid.uuid4().hex)
+        tmp = os.path.join(self.path, '.' + _id)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, os.path.join(self.path, _id))
+        return {'store': FILE, 'id': _id, 'name': name, 'size': len(data), 'content_type': content_type}
+
+    def get(self, ref):
+        with open(os.path.join(self.path, ref['id']), 'rb') as f:
+            return f.read()
+
+    def delete(self, ref):
+        try:
+            os.remove(os.path.join(self.path, ref['id']))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, max_age):
+        if not os.path.isdir(self.path):
+            return 0
+
+        cutoff = time.time() - max_age
+        swept = 0
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                self.delete({'id': entry.name})
+                swept += 1
+        return swept
+
+
+def get_store(location, database):
+    if not location or location == GRIDFS:
+        return GridFSStore(database)
+
+    if location.startswith('file://'):
+        location = location[len('file://'):]
+    return FileStore(location)
+
+
+def load_datastore(store, ref):
+    data = store.get(ref)
+    if ref.get('content_type') == wire.BSON_CONTENT_TYPE:
+        return wire.decode_bson(data)['datastore']
+    return bson.json_util.loads(data.decode('utf-8'))
@@ -0,0 +1,100 @@
+COLUMNAR = 'columnar'
+
+
+def _columns(section):
+    columns = [c[0] for c in section['meta']]
+
+    known = set(columns)
+    for r in section['records']:
+        for k in r:
+            if k not in known:
+                known.add(k)
+                columns.append(k)
+
+    return columns
+
+
+def _encode_column(name, values):
+    if not values:
+        return {'name': name, 'values': []}
+
+    first = values[0]
+    if all(v == first and type(v) is type(first) for v in values):
+        return {'name': name, 'constant': first}
+
+    if all(v is None or isinstance(v, str) for v in values):
+        dictionary = []
+        positions = {}
+        indices = []
+        for v in values:
+            if v not in positions:
+                positions[v] = len(dictionary)
+                dictionary.append(v)
+            indices.append(positions[v])
+
+        if len(dictionary) * 2 <= len(values):
+            return {'name': name, 'dictionary': dictionary, 'indices': indices}
+
+    return {'name': name, 'values': values}
+
+
+def _decode_column(column, length):
+    if 'constant' in column:
+        return [column['constant']] * length
+
+    if 'dictionary' in column:
+        dictionary = column['dictionary']
+        return [dictionary[i] for i in column['indices']]
+
+    return column['values']
+
+
+def encode_section(section):
+    if 'records' not in section:
+        return section
+
+    records = section['records']
+    columns = [
+        _encode_column(c, [r.get(c) for r in records]) for c in _columns(section)
+    ]
+
+    encoded = {k: v for k, v in section.items() if k != 'records'}
+    encoded['format'] = COLUMNAR
+    encoded['length'] = len(records)
+    encoded['columns'] = columns
+
+    return encoded
+
+
+def decode_section(section):
+    if section.get('format') != COLUMNAR:
+        return section
+
+    length = section['length']
+    names = [c['name'] for c in section['columns']]
+    values = [_decode_column(c, length) for c in section['columns']]
+
+    decoded = {k: v for k, v in section.items() if k not in ('format', 'length', 'columns')}
+    decoded['records'] = [dict(zip(names, row)) for row in zip(*values)] if names else [{} for _ in range(length)]
+
+    return decoded
+
+
+def encode_datastore(datastore):
+    return [encode_section(s) for s in datastore]
+
+
+def decode_datastore(datastore):
+    return [decode_section(s) for s in datastore]
+
+
+def encode_feed(feed):
+    if 'datastore' not in feed:
+        return feed
+    return {**feed, 'datastore': encode_datastore(feed['datastore'])}
+
+
+def decode_feed(feed):
+    if 'datastore' not in feed:
+        return feed
+    return {**feed, 'datastore': decode_datastore(feed['datastore'])}
@@ -0,0 +1,57 @@
+import hashlib
+
+
+def record_hash(record):
+    concat = repr(sorted(record.items()))
+    return hashlib.md5(concat.encode('utf-8')).hexdigest()
+
+
+def _section_name(section):
+    return section['target_table']
+
+
+def fingerprint(datastore):
+    sections = {}
+
+    for section in datastore:
+        hashes = [record_hash(r) for r in section['records']]
+
+        fp = {'hash': hashlib.md5(''.join(sorted(hashes)).encode('utf-8')).hexdigest()}
+
+        key = section.get('upsert_key')
+        if key:
+            fp['records'] = {str(r[key]): h for r, h in zip(section['records'], hashes)}
+
+        sections[_section_name(section)] = fp
+
+    return sections
+
+
+def diff(datastore, previous, current=None):
+    if current is None:
+        current = fingerprint(datastore)
+
+    results = []
+
+    for section in datastore:
+        name = _section_name(section)
+        old = previous.get(name)
+        new = current[name]
+
+        if old is None:
+            results.append(section)
+            continue
+
+        if old['hash'] == new['hash']:
+            continue
+
+        key = section.get('upsert_key')
+        if not key or 'records' not in old:
+            results.append(section)
+            continue
+
+        records = [r for r in section['records'] if old['records'].get(str(r[key])) != new['records'][str(r[key])]]
+        if records:
+            results.append({**section, 'records': records})
+
+    return results
@@ -0,0 +1,153 @@
+import logging
+import datetime
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+
+_log = logging.getLogger(__name__)
+
+# Index already exists with different options (IndexOptionsConflict / IndexKeySpecsConflict)
+_CONFLICT_CODES = (85, 86)
+
+
+def _calendar_indexes():
+    return [
+        ([('id', ASCENDING)], {'unique': True}),
+        ([('season_id', ASCENDING), ('competition_id', ASCENDING), ('id', ASCENDING)], {}),
+        ([('date', ASCENDING), ('id', ASCENDING), ('competition_id', ASCENDING), ('season_id', ASCENDING)], {}),
+        ([('updated', ASCENDING)], {})
+    ]
+
+
+INDEXES = {
+    'f1': _calendar_indexes(),
+    'ru1': _calendar_indexes(),
+    'f9': [([('id', ASCENDING)], {'unique': True})],
+    'ru7': [([('id', ASCENDING)], {'unique': True})],
+    'f40': [([('id', ASCENDING)], {'unique': True})],
+    'seasons': [
+        ([('sport', ASCENDING), ('season_id', ASCENDING), ('competition_id', ASCENDING)], {'unique': True}),
+        ([('sport', ASCENDING), ('closed', ASCENDING)], {})
+    ],
+    'instances': [
+        ([('id', ASCENDING)], {'unique': True}),
+        ([('expires', ASCENDING)], {'expireAfterSeconds': 0})
+    ],
+    'cycles': [
+        ([('name', ASCENDING), ('scope', ASCENDING)], {'unique': True}),
+        ([('updated', ASCENDING)], {'expireAfterSeconds': 7*24*60*60})
+    ],
+    'locks': [([('name', ASCENDING), ('scope', ASCENDING)], {'unique': True})],
+    'freshness': [
+        ([('type', ASCENDING), ('id', ASCENDING)], {'unique': True}),
+        ([('final_seen', ASCENDING), ('sport', ASCENDING), ('competition_id', ASCENDING)], {})
+    ],
+    'pending': [([('type', ASCENDING), ('id', ASCENDING)], {'unique': True})],
+    'referential': [
+        ([('id', ASCENDING)], {'unique': True}),
+        ([('id', ASCENDING), ('hash', ASCENDING)], {})
+    ]
+}
+
+_START = datetime.datetime(2019, 1, 1)
+_END = datetime.datetime(2019, 1, 4)
+
+QUERIES = [
+    ('f1', 'ids_by_season_and_competition',
+     {'season_id': '2017', 'competition_id': '24'}, {'id': 1, '_id': 0}),
+    ('ru1', 'ids_by_season_and_competition',
+     {'season_id': '2018', 'competition_id': '203'}, {'id': 1, '_id': 0}),
+    ('f1', 'ids_by_dates',
+     {'date': {'$gte': _START, '$lt': _END}}, {'id': 1, 'competition_id': 1, 'season_id': 1, '_id': 0}),
+    ('ru1', 'ids_by_dates',
+     {'date': {'$gte': _START, '$lt': _END}}, {'id': 1, 'competition_id': 1, 'season_id': 1, '_id': 0}),
+    ('f1', 'calendar_refresh', {'updated': {'$gte': _START}}, {'_id': 0}),
+    ('ru1', 'calendar_refresh', {'updated': {'$gte': _START}}, {'_id': 0}),
+    ('f9', 'acked_version', {'id': '920533'}, {'checksum': 1, 'sections': 1, '_id': 0}),
+    ('ru7', 'acked_version', {'id': '318014'}, {'checksum': 1, 'sections': 1, '_id': 0}),
+    ('f40', 'acked_version', {'id': '2020,24'}, {'checksum': 1, 'sections': 1, '_id': 0}),
+    ('pending', 'pending_version', {'type': 'f9', 'id': '920533', 'checksum': ''}, None),
+    ('referential', 'entity_hashes', {'id': {'$in': ['p1', 't1']}}, {'id': 1, 'hash': 1, '_id': 0})
+]
+
+
+def _index_name(keys):
+    return '_'.join(f'{k}_{d}' for k, d in keys)
+
+
+def _has_duplicates(collection, keys):
+    group = {'_id': {k.replace('.', '_'): f'${k}' for k, _ in keys}, 'count': {'$sum': 1}}
+    return bool(list(collection.aggregate([
+        {'$group': group}, {'$match': {'count': {'$gt': 1}}}, {'$limit': 1}], allowDiskUse=True)))
+
+
+def _create_index(collection, keys, options):
+    try:
+        collection.create_index(keys, background=True, **options)
+    except OperationFailure as e:
+        if e.code not in _CONFLICT_CODES:
+            raise
+
+        # Mongo refuses two indexes on the same keys, so the old one has to go before the new one is built:
+        # keep it when the new one cannot be built, and put it back if the build fails anyway
+        name = options.get('name', _index_name(keys))
+        old = collection.index_information().get(name)
+
+        if options.get('unique') and _has_duplicates(collection, keys):
+            _log.error(f'Keeping index {name} on {collection.name}: duplicate values prevent making it unique')
+            return
+
+        _log.info(f'Replacing index {name} on {collection.name}')
+        collection.drop_index(name)
+        try:
+            collection.create_index(keys, background=True, **options)
+        except OperationFailure:
+            if old is not None:
+                restored = {k: v for k, v in old.items() if k not in ('key', 'v', 'ns', 'name', 'background')}
+                collection.create_index(old['key'], name=name, background=True, **restored)
+            raise
+
+
+def ensure_indexes(database):
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                _create_index(database[collection], keys, options)
+            except OperationFailure as e:
+                _log.error(f'Could not create index {keys} on {collection}: {str(e)}')
+
+
+def setup_indexes(provider):
+    ensure_indexes(provider.database)
+
+
+def _get_stages(plan):
+    stages = [plan['stage']] if 'stage' in plan else []
+
+    if 'inputStage' in plan:
+        stages.extend(_get_stages(plan['inputStage']))
+
+    for p in plan.get('inputStages', []):
+        stages.extend(_get_stages(p))
+
+    return stages
+
+
+def describe_plan(explain):
+    stages = _get_stages(explain['queryPlanner']['winningPlan'])
+    return {
+        'stages': stages,
+        'collscan': 'COLLSCAN' in stages,
+        'covered': 'COLLSCAN' not in stages and 'FETCH' not in stages
+    }
+
+
+def audit_queries(database):
+    results = []
+
+    for collection, name, query, projection in QUERIES:
+        explain = database[collection].find(query, projection).explain()
+        results.append({'collection': collection, 'query': name, **describe_plan(explain)})
+
+    return results
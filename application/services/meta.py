@@ -1,3 +1,132 @@
+# Stat columns of the wide tables. Stats outside these lists are dropped so that every game
+# publishes the same columns in the same order
+SOCCER_PLAYER_STATS = [
+    'accurate_back_zone_pass', 'accurate_chipped_pass', 'accurate_corners_intobox', 'accurate_cross',
+    'accurate_cross_nocorner', 'accurate_flick_on', 'accurate_freekick_cross', 'accurate_fwd_zone_pass',
+    'accurate_goal_kicks', 'accurate_keeper_sweeper', 'accurate_keeper_throws', 'accurate_launches',
+    'accurate_layoffs', 'accurate_long_balls', 'accurate_pass', 'accurate_throws', 'aerial_lost', 'aerial_won',
+    'att_assist_openplay', 'att_assist_setplay', 'att_bx_centre', 'att_bx_left', 'att_bx_right',
+    'att_cmiss_high', 'att_fastbreak', 'att_freekick_miss', 'att_freekick_target', 'att_freekick_total',
+    'att_goal_high_right', 'att_goal_low_left', 'att_goal_low_right', 'att_hd_goal', 'att_hd_miss',
+    'att_hd_target', 'att_hd_total', 'att_ibox_blocked', 'att_ibox_goal', 'att_ibox_miss', 'att_ibox_post',
+    'att_ibox_target', 'att_lf_goal', 'att_lf_miss', 'att_lf_target', 'att_lf_total', 'att_miss_high',
+    'att_miss_high_left', 'att_miss_left', 'att_miss_right', 'att_obox_blocked', 'att_obox_goal',
+    'att_obox_miss', 'att_obox_post', 'att_obox_target', 'att_obx_centre', 'att_openplay', 'att_pen_goal',
+    'att_pen_miss', 'att_pen_target', 'att_rf_goal', 'att_rf_miss', 'att_rf_target', 'att_rf_total',
+    'att_setpiece', 'att_sv_high_right', 'att_sv_low_centre', 'att_sv_low_left', 'attempted_tackle_foul',
+    'attempts_conceded_ibox', 'attempts_conceded_obox', 'attempts_ibox', 'attempts_obox', 'backward_pass',
+    'ball_recovery', 'big_chance_created', 'big_chance_missed', 'big_chance_scored', 'blocked_cross',
+    'blocked_pass', 'blocked_scoring_att', 'challenge_lost', 'clean_sheet', 'clearance_off_line',
+    'corner_taken', 'crosses_18yard', 'crosses_18yardplus', 'dispossessed', 'dive_save', 'diving_save',
+    'duel_lost', 'duel_won', 'effective_blocked_cross', 'effective_clearance', 'effective_head_clearance',
+    'error_lead_to_goal', 'error_lead_to_shot', 'final_third_entries', 'fouled_final_third', 'fouls',
+    'freekick_cross', 'fwd_pass', 'game_started', 'goal_assist', 'goal_assist_deadball',
+    'goal_assist_intentional', 'goal_assist_openplay', 'goal_assist_setplay', 'goal_fastbreak', 'goal_kicks',
+    'goals', 'goals_conceded', 'goals_conceded_ibox', 'goals_conceded_obox', 'goals_openplay',
+    'good_high_claim', 'hand_ball', 'head_clearance', 'head_pass', 'hit_woodwork', 'interception',
+    'interception_won', 'interceptions_in_box', 'keeper_pick_up', 'keeper_throws', 'last_man_tackle',
+    'leftside_pass', 'long_pass_own_to_opp', 'long_pass_own_to_opp_success', 'lost_corners', 'mins_played',
+    'offside_provoked', 'offtarget_att_assist', 'ontarget_att_assist', 'ontarget_scoring_att', 'open_play_pass',
+    'outfielder_block', 'overrun', 'own_goals', 'passes_left', 'passes_right', 'pen_area_entries',
+    'penalty_conceded', 'penalty_save', 'penalty_won', 'poss_lost_all', 'poss_lost_ctrl', 'poss_won_att_3rd',
+    'poss_won_def_3rd', 'poss_won_mid_3rd', 'punches', 'put_through', 'red_card', 'rightside_pass',
+    'saved_ibox', 'saved_obox', 'saves', 'second_goal_assist', 'second_yellow', 'shield_ball_oop',
+    'shot_fastbreak', 'shot_off_target', 'six_yard_block', 'successful_final_third_passes',
+    'successful_open_play_pass', 'successful_put_through', 'total_att_assist', 'total_back_zone_pass',
+    'total_chipped_pass', 'total_clearance', 'total_contest', 'total_corners_intobox', 'total_cross',
+    'total_cross_nocorner', 'total_fastbreak', 'total_final_third_passes', 'total_flick_on',
+    'total_fwd_zone_pass', 'total_high_claim', 'total_keeper_sweeper', 'total_launches', 'total_layoffs',
+    'total_long_balls', 'total_offside', 'total_pass', 'total_scoring_att', 'total_sub_off', 'total_sub_on',
+    'total_tackle', 'total_throws', 'touches', 'touches_in_opp_box', 'turnover', 'unsuccessful_touch',
+    'was_fouled', 'won_contest', 'won_corners', 'won_tackle', 'yellow_card'
+]
+
+RUGBY_TEAM_STATS = [
+    'attacking_events_zone_a', 'attacking_events_zone_b', 'attacking_events_zone_c', 'attacking_events_zone_d',
+    'ball_possession_last_10_mins', 'ball_won_zone_a', 'ball_won_zone_b', 'ball_won_zone_c', 'ball_won_zone_d',
+    'carries_crossed_gain_line', 'carries_metres', 'carries_not_made_gain_line', 'carries_support',
+    'clean_breaks', 'collection_failed', 'collection_from_kick', 'collection_interception',
+    'collection_loose_ball', 'collection_success', 'conversion_goals', 'defenders_beaten', 'drop_goal_missed',
+    'drop_goals_converted', 'free_kick_conceded', 'free_kick_conceded_at_lineout',
+    'free_kick_conceded_at_scrum', 'free_kick_conceded_in_general_play', 'free_kick_conceded_in_ruck_or_maul',
+    'goals', 'kick_charged_down', 'kick_from_hand_metres', 'kick_in_touch', 'kick_oppn_collection',
+    'kick_out_of_play', 'kick_penalty_bad', 'kick_penalty_good', 'kick_percent_success', 'kick_possession_lost',
+    'kick_possession_retained', 'kick_success', 'kick_touch_in_goal', 'kick_try_scored',
+    'kicking_competition_goals', 'kicks_from_hand', 'lineout_success', 'lineout_throw_lost_free_kick',
+    'lineout_throw_lost_handling_error', 'lineout_throw_lost_not_straight', 'lineout_throw_lost_outright',
+    'lineout_throw_lost_penalty', 'lineout_throw_not_straight', 'lineout_throw_won_clean',
+    'lineout_throw_won_free_kick', 'lineout_throw_won_penalty', 'lineout_throw_won_tap',
+    'lineout_won_own_throw', 'lineout_won_steal', 'lineouts_Lost', 'lineouts_infringe_opp',
+    'lineouts_infringe_own', 'lineouts_to_opp_player', 'lineouts_to_own_player', 'lineouts_won',
+    'mauling_metres', 'mauls_lost', 'mauls_lost_outright', 'mauls_lost_turnover', 'mauls_total', 'mauls_won',
+    'mauls_won_outright', 'mauls_won_penalty', 'mauls_won_penalty_try', 'mauls_won_try', 'metres',
+    'missed_conversion_goals', 'missed_goals', 'missed_penalty_goals', 'missed_tackles', 'offload', 'passes',
+    'pc_kick_percent', 'pc_possession_first', 'pc_possession_second', 'pc_territory_first',
+    'pc_territory_second', 'penalties_conceded', 'penalty_conceded_collapsing',
+    'penalty_conceded_collapsing_maul', 'penalty_conceded_collapsing_offence',
+    'penalty_conceded_delib_knock_on', 'penalty_conceded_dissent', 'penalty_conceded_early_tackle',
+    'penalty_conceded_foul_play', 'penalty_conceded_handling_in_ruck', 'penalty_conceded_high_tackle',
+    'penalty_conceded_killing_ruck', 'penalty_conceded_lineout_offence', 'penalty_conceded_obstruction',
+    'penalty_conceded_offside', 'penalty_conceded_opp_half', 'penalty_conceded_other',
+    'penalty_conceded_own_half', 'penalty_conceded_scrum_offence', 'penalty_conceded_stamping',
+    'penalty_conceded_wrong_side', 'penalty_goals', 'penalty_kick_for_touch_metres', 'penalty_tries', 'points',
+    'possession', 'red_card_second_yellow', 'red_cards', 'restart_22m', 'restart_error_not_ten',
+    'restart_error_out_of_play', 'restart_halfway', 'restart_opp_error', 'restart_opp_player',
+    'restart_own_player', 'restarts_lost', 'restarts_success', 'restarts_won', 'retained_kicks', 'ruck_success',
+    'rucks_lost', 'rucks_total', 'rucks_won', 'runs', 'scrums_lost', 'scrums_lost_free_kick',
+    'scrums_lost_outright', 'scrums_lost_penalty', 'scrums_lost_reversed', 'scrums_reset', 'scrums_success',
+    'scrums_total', 'scrums_won', 'scrums_won_free_kick', 'scrums_won_outright', 'scrums_won_penalty',
+    'scrums_won_penalty_try', 'scrums_won_pushover_try', 'set_piece_won', 'tackle_success', 'tackles',
+    'territory', 'territory_last_10_mins', 'total_free_kicks_conceded', 'total_kicks', 'total_kicks_succeeded',
+    'total_lineouts', 'tries', 'true_retained_kicks', 'try_assists', 'try_kicks', 'turnover_bad_pass',
+    'turnover_carried_in_touch', 'turnover_carried_over', 'turnover_forward_pass', 'turnover_kick_error',
+    'turnover_knock_on', 'turnover_lost_in_ruck_or_maul', 'turnover_opp_half', 'turnover_own_half',
+    'turnover_turnover_forward_pass', 'turnover_won', 'turnovers_conceded', 'turnovers_won', 'yellow_cards'
+]
+
+RUGBY_PLAYER_STATS = [
+    'bad_passes', 'ball_out_of_play', 'carries_crossed_gain_line', 'carries_metres',
+    'carries_not_made_gain_line', 'carries_support', 'catch_from_kick', 'clean_breaks', 'collection_failed',
+    'collection_from_kick', 'collection_interception', 'collection_loose_ball', 'collection_success',
+    'conversion_goals', 'defenders_beaten', 'drop_goal_missed', 'drop_goals_converted', 'dropped_catch',
+    'free_kick_conceded_at_lineout', 'free_kick_conceded_at_scrum', 'free_kick_conceded_in_general_play',
+    'free_kick_conceded_in_ruck_or_maul', 'gain_line', 'goals', 'handling_error', 'kick_charged_down',
+    'kick_from_hand_metres', 'kick_in_field', 'kick_in_touch', 'kick_metres', 'kick_oppn_collection',
+    'kick_out_of_play', 'kick_penalty_bad', 'kick_penalty_good', 'kick_percent_success', 'kick_possession_lost',
+    'kick_possession_retained', 'kick_touch_in_goal', 'kick_try_scored', 'kicking_competition_goals', 'kicks',
+    'kicks_from_hand', 'lineout_non_straight', 'lineout_success', 'lineout_throw_lost_free_kick',
+    'lineout_throw_lost_handling_error', 'lineout_throw_lost_not_straight', 'lineout_throw_lost_outright',
+    'lineout_throw_lost_penalty', 'lineout_throw_won_clean', 'lineout_throw_won_free_kick',
+    'lineout_throw_won_penalty', 'lineout_throw_won_tap', 'lineout_won_opp_throw', 'lineout_won_own_throw',
+    'lineout_won_steal', 'lineouts_infringe_opp', 'lineouts_lost', 'lineouts_to_own_player', 'lineouts_won',
+    'mauls_lost', 'mauls_lost_outright', 'mauls_lost_turnover', 'mauls_won', 'mauls_won_outright',
+    'mauls_won_penalty', 'mauls_won_penalty_try', 'mauls_won_try', 'metres', 'minutes_played_before_first_half',
+    'minutes_played_before_first_half_extra', 'minutes_played_before_penalty_shootOut',
+    'minutes_played_before_second_half', 'minutes_played_before_second_half_extra', 'minutes_played_first_half',
+    'minutes_played_first_half_extra', 'minutes_played_second_half', 'minutes_played_second_half_extra',
+    'minutes_played_total', 'missed_conversion_goals', 'missed_goals', 'missed_penalty_goals', 'missed_tackles',
+    'offload', 'passes', 'pc_kick_percent', 'pen_defs', 'pen_offs', 'penalties_conceded',
+    'penalty_conceded_collapsing_maul', 'penalty_conceded_collapsing_offence',
+    'penalty_conceded_delib_knock_on', 'penalty_conceded_dissent', 'penalty_conceded_early_tackle',
+    'penalty_conceded_foul_play', 'penalty_conceded_handling_in_ruck', 'penalty_conceded_high_tackle',
+    'penalty_conceded_killing_ruck', 'penalty_conceded_line_out_offence', 'penalty_conceded_lineout_offence',
+    'penalty_conceded_obstruction', 'penalty_conceded_offside', 'penalty_conceded_opp_half',
+    'penalty_conceded_other', 'penalty_conceded_own_half', 'penalty_conceded_scrum_offence',
+    'penalty_conceded_stamping', 'penalty_conceded_wrong_side', 'penalty_goals',
+    'penalty_kick_for_touch_metres', 'pickup', 'points', 'red_card_second_yellow', 'red_cards', 'restart_22m',
+    'restart_error_not_ten', 'restart_error_out_of_play', 'restart_halfway', 'restart_opp_error',
+    'restart_opp_player', 'restart_own_player', 'restarts_lost', 'restarts_success', 'restarts_won',
+    'retained_kicks', 'rucks_lost', 'rucks_won', 'runs', 'scrums_lost_free_kick', 'scrums_lost_outright',
+    'scrums_lost_penalty', 'scrums_lost_reversed', 'scrums_won_free_kick', 'scrums_won_outright',
+    'scrums_won_penalty', 'scrums_won_penalty_try', 'scrums_won_pushover_try', 'tackle_success', 'tackles',
+    'total_free_kicks_conceded', 'total_lineouts', 'tries', 'true_retained_kicks', 'try_assist', 'try_assists',
+    'try_kicks', 'turnover_bad_pass', 'turnover_carried_in_touch', 'turnover_carried_over',
+    'turnover_forward_pass', 'turnover_kick_error', 'turnover_knock_on', 'turnover_lost_in_ruck_or_maul',
+    'turnover_opp_half', 'turnover_own_half', 'turnover_turnover_forward_pass', 'turnover_won',
+    'turnovers_conceded', 'yellow_cards'
+]
+
+
 OPTA = {
     'f9': {
         'matchinfo': {
@@ -89,6 +218,32 @@ OPTA = {
             'delete_keys': {},
             'target_table': 'soccer_playerstat',
             'chunk_size': 500
+        },
+        'playerstat_wide': {
+            'write_policy': 'delete_bulk_insert',
+            'meta': [
+                ('player_id','VARCHAR(10)'),
+                ('competition_id','VARCHAR(10)'),
+                ('season_id','INTEGER'),
+                ('match_id','VARCHAR(10)'),
+                ('team_id','VARCHAR(10)'),
+                ('score','INTEGER'),
+                ('shootout_score','INTEGER'),
+                ('side','VARCHAR(10)'),
+                ('formation_used','VARCHAR(11)'),
+                ('official_id','VARCHAR(10)'),
+                ('main_position','VARCHAR(20)'),
+                ('sub_position','VARCHAR(20)'),
+                ('shirt_number','INTEGER'),
+                ('status','VARCHAR(20)'),
+                ('captain','VARCHAR(10)'),
+                ('formation_place','VARCHAR(11)')
+            ],
+            'pivot_type': 'FLOAT',
+            'pivot_columns': SOCCER_PLAYER_STATS,
+            'delete_keys': {},
+            'target_table': 'soccer_playerstat_wide',
+            'chunk_size': 500
         }
     },
     'f40': {
@@ -216,6 +371,35 @@ OPTA = {
             'delete_keys': {},
             'target_table': 'rugby_playerstat',
             'chunk_size': 500
+        },
+        'teamstat_wide': {
+            'write_policy': 'delete_bulk_insert',
+            'meta': [
+                ('match_id','VARCHAR(10)'),
+                ('team_id','VARCHAR(10)'),
+                ('side','VARCHAR(10)')
+            ],
+            'pivot_type': 'FLOAT',
+            'pivot_columns': RUGBY_TEAM_STATS,
+            'delete_keys': {},
+            'target_table': 'rugby_teamstat_wide',
+            'chunk_size': 500
+        },
+        'playerstat_wide': {
+            'write_policy': 'delete_bulk_insert',
+            'meta': [
+                ('match_id','VARCHAR(10)'),
+                ('team_id','VARCHAR(10)'),
+                ('player_id','VARCHAR(10)'),
+                ('position_name','VARCHAR(20)'),
+                ('position_id','VARCHAR(2)'),
+                ('side','VARCHAR(10)')
+            ],
+            'pivot_type': 'FLOAT',
+            'pivot_columns': RUGBY_PLAYER_STATS,
+            'delete_keys': {},
+            'target_table': 'rugby_playerstat_wide',
+            'chunk_size': 500
         }
     }
 }
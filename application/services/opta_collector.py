@@ -1,7 +1,9 @@
+import time
 import hashlib
 import logging
 import datetime
 import itertools
+import functools
 
 from nameko.rpc import rpc
 from nameko.timer import timer
@@ -10,16 +12,45 @@ from nameko_mongodb.database import MongoDatabase
 from nameko.messaging import Publisher
 from nameko.constants import PERSISTENT
 from kombu.messaging import Exchange
-from nameko.dependency_providers import DependencyProvider
+from nameko.dependency_providers import DependencyProvider, Config
 import bson.json_util
 import dateutil.parser
+import pytz
+from pymongo import UpdateOne
 
 from application.dependencies.opta import OptaDependency, OptaWebServiceError
+from application.dependencies.calendar import Calendar
+from application.dependencies.coordination import Coordination
+from application.dependencies.cycles import Cycles
+from application.dependencies.priority import FetchQueue
+from application.dependencies.bulkheads import Bulkheads, BulkheadFullError, FAILED
+from application.dependencies.metrics import Metrics, Stopwatch
+from application.dependencies.profiling import Profiler
+from application.dependencies.watchdog import Watchdog
 from application.services.meta import OPTA, LABEL
+from application.services import columnar, wire, claim_check, delta, schema, indexes
 
 
 _log = logging.getLogger(__name__)
 
+PUBLISH_INTERVAL = 5*60
+UPDATE_INTERVAL = 24*60*60
+CLAIM_CHECK_SWEEP_INTERVAL = 60*60
+FETCH_QUEUE_INTERVAL = 1
+SPORTS = ('soccer', 'rugby')
+
+SKIPPED = 'SKIPPED'
+
+
+@functools.lru_cache(maxsize=None)
+def _get_fields(opta_type, data_type):
+    return frozenset(m[0] for m in OPTA[opta_type][data_type]['meta'])
+
+
+@functools.lru_cache(maxsize=2**16)
+def _get_link_id(player_id, team_id, season_id, competition_id):
+    return hashlib.md5(''.join([player_id, team_id, season_id, competition_id]).encode('utf-8')).hexdigest()
+
 
 class ErrorHandler(DependencyProvider):
 
@@ -34,12 +65,30 @@ class ErrorHandler(DependencyProvider):
 class OptaCollectorService(object):
     name = 'opta_collector'
 
-    database = MongoDatabase(result_backend=False)
+    database = MongoDatabase(result_backend=False, on_after_setup=indexes.setup_indexes)
 
     opta = OptaDependency()
 
+    calendar = Calendar()
+
+    coordination = Coordination()
+
+    cycles = Cycles()
+
+    fetch_queue = FetchQueue()
+
+    bulkheads = Bulkheads()
+
+    metrics = Metrics()
+
+    profiler = Profiler()
+
+    watchdog = Watchdog()
+
     error = ErrorHandler()
 
+    config = Config()
+
     pub_input = Publisher(exchange=Exchange(
         name='all_inputs', type='topic', durable=True, auto_delete=True, delivery_mode=PERSISTENT))
     pub_notif = Publisher(exchange=Exchange(
@@ -47,11 +96,19 @@ class OptaCollectorService(object):
 
     @staticmethod
     def _checksum(game):
-        stats = sorted(game['player_stats'],
-                       key=lambda k: (k['player_id'], k['type']))
-        concat = ''.join(str(r['value']) for r in stats)
+        if game.get('stats_layout') == 'wide':
+            stats = sorted(game['player_stats'], key=lambda k: k['player_id'])
+            concat = ''.join(str(r[k]) for r in stats for k in sorted(r))
+        else:
+            stats = sorted(game['player_stats'],
+                           key=lambda k: (k['player_id'], k['type']))
+            concat = ''.join(str(r['value']) for r in stats)
         return hashlib.md5(concat.encode('utf-8')).hexdigest()
 
+    @staticmethod
+    def _get_stats_type(game, data_type):
+        return f'{data_type}_wide' if game.get('stats_layout') == 'wide' else data_type
+
     @staticmethod
     def _build_soccer_game_event_content(game):
         team_sides = list(set([(r['team_id'], r['side'])
@@ -210,91 +267,327 @@ class OptaCollectorService(object):
         return {'entities': entities, 'events': events, 'labels': labels}
 
     @staticmethod
-    def _get_opta_meta(opta_type, data_type, game_id):
-        meta = OPTA[opta_type][data_type].copy()
+    def _build_section(opta_type, data_type, game_id, records):
+        meta = OPTA[opta_type][data_type]
+        codec = schema.CODECS[(opta_type, data_type)]
+        section = {**meta, 'records': records}
+
+        if 'pivot_type' in meta:
+            section['meta'] = meta['meta'] + [(c.name, c.sql_type) for c in codec.pivot_columns]
+        codec.coerce(records)
+
         if 'delete_keys' in meta:
-            meta['delete_keys'] = {
+            section['delete_keys'] = {
                 'match_id': f'f{game_id}' if opta_type == 'f9' else game_id
             }
-        return meta
+        return section
+
+    @staticmethod
+    def _build_label_section(labels):
+        return {**LABEL, 'records': schema.CODECS['label'].coerce(labels)}
+
+    @staticmethod
+    def _build_f9_datastore(match_id, game, labels):
+        build = OptaCollectorService._build_section
+        return [
+            build('f9', OptaCollectorService._get_stats_type(game, 'playerstat'), match_id, game['player_stats']),
+            build('f9', 'teamstat', match_id, game['team_stats']),
+            build('f9', 'event', match_id, game['events']),
+            build('f9', 'matchinfo', match_id, [game['match_info']]),
+            OptaCollectorService._build_label_section(labels)
+        ]
+
+    @staticmethod
+    def _build_ru7_datastore(match_id, game, ru1, labels):
+        build = OptaCollectorService._build_section
+        return [
+            build('ru7', OptaCollectorService._get_stats_type(game, 'playerstat'), match_id, game['player_stats']),
+            build('ru7', OptaCollectorService._get_stats_type(game, 'teamstat'), match_id, game['team_stats']),
+            build('ru7', 'event', match_id, game['events']),
+            build('ru7', 'matchscore', match_id, [{
+                'id': game['rrml']['id'],
+                'attendance': game['rrml']['attendance'],
+                'away_ht_score': game['rrml']['away_ht_score'],
+                'away_score': game['rrml']['away_score'],
+                'home_ht_score': game['rrml']['home_ht_score'],
+                'home_score': game['rrml']['home_score']
+            }]),
+            build('ru7', 'matchinfo', match_id, [{
+                'venue_id': ru1['venue_id'],
+                'date': ru1['date'],
+                'season_id': ru1['season_id'],
+                'id': ru1['id'],
+                'group_name': ru1['group_name'],
+                'group_id': ru1['group_id'],
+                'round': ru1['round'],
+                'competition_id': ru1['competition_id']
+            }]),
+            OptaCollectorService._build_label_section(labels)
+        ]
+
+    @staticmethod
+    def _build_f40_datastore(squads):
+        playerinfo_fields = _get_fields('f40', 'playerinfo')
+        teaminfo_fields = _get_fields('f40', 'teaminfo')
+        build = OptaCollectorService._build_section
+
+        return [
+            build('f40', 'playerinfo', None, [
+                {k: v for k, v in p.items() if k in playerinfo_fields}
+                for t in squads for p in t['players']]),
+            build('f40', 'teaminfo', None, [
+                {k: v for k,v in t.items() if k in teaminfo_fields}
+                for t in squads]),
+            build('f40', 'link', None, [{
+                'id': _get_link_id(p['id'], t['id'], t['season_id'], t['competition_id']),
+                'competition_id': t['competition_id'],
+                'season_id': t['season_id'],
+                'player_id': p['id'],
+                'team_id': t['id'],
+                'join_date': p['join_date']
+            } for t in squads for p in t['players']])
+        ]
+
+    @staticmethod
+    def _squads_checksum(squads):
+        return hashlib.md5(bson.json_util.dumps(squads, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _get_acked_version(self, opta_type, match_id):
+        acked = self.database[opta_type].find_one(
+            {'id': match_id}, {'checksum': 1, 'sections': 1, '_id': 0})
+        pending = self.database.pending.find_one({'type': opta_type, 'id': match_id}, {'checksum': 1, '_id': 0})
+
+        # The loader may already hold an unacked newer version, so the acked fingerprint cannot be diffed against
+        if pending and (acked is None or pending['checksum'] != acked['checksum']):
+            return {'checksum': acked['checksum'] if acked else None, 'pending': True}
+        return acked
+
+    @staticmethod
+    def _get_status(previous, checksum):
+        if previous is None or previous['checksum'] is None:
+            return 'CREATED'
+        if previous.get('pending'):
+            return 'UPDATED'
+        if previous['checksum'] != checksum:
+            return 'UPDATED'
+        return 'UNCHANGED'
+
+    @staticmethod
+    def _entity_hash(entity):
+        concat = ''.join(str(entity.get(k)) for k in ('common_name', 'type'))
+        return hashlib.md5(concat.encode('utf-8')).hexdigest()
+
+    def _filter_referential(self, referential, status):
+        if status == 'UNCHANGED':
+            return referential, {}
+
+        hashes = {e['id']: self._entity_hash(e) for e in referential['entities']}
+
+        known = {r['id']: r['hash'] for r in self.database.referential.find(
+            {'id': {'$in': list(hashes)}}, {'id': 1, 'hash': 1, '_id': 0})}
+        changed = set(i for i, h in hashes.items() if known.get(i) != h)
+
+        return {
+            **referential,
+            'entities': [e for e in referential['entities'] if e['id'] in changed],
+            'labels': [l for l in referential['labels'] if l['id'] in changed or l['id'] not in hashes]
+        }, hashes
+
+    def _track_datastore(self, opta_type, match_id, checksum, status, previous, datastore, entities):
+        if status == 'UNCHANGED':
+            return datastore
+
+        sections = delta.fingerprint(datastore)
+        self.database.pending.update_one(
+            {'type': opta_type, 'id': match_id},
+            {'$set': {'checksum': checksum, 'sections': sections, 'entities': entities}}, upsert=True)
+
+        if status == 'UPDATED' and previous.get('sections'):
+            return delta.diff(datastore, previous['sections'], sections)
+
+        return datastore
+
+    def _ack_version(self, opta_type, match_id, checksum):
+        pending = self.database.pending.find_one_and_delete(
+            {'type': opta_type, 'id': match_id, 'checksum': checksum})
+
+        if pending:
+            update = {'$set': {'checksum': checksum, 'sections': pending['sections']}}
+            if pending.get('entities'):
+                self.database.referential.bulk_write([
+                    UpdateOne({'id': i}, {'$set': {'hash': h}}, upsert=True)
+                    for i, h in pending['entities'].items()], ordered=False)
+        else:
+            update = {'$set': {'checksum': checksum}, '$unset': {'sections': ''}}
+
+        self.database[opta_type].update_one({'id': match_id}, update, upsert=True)
+
+    def _claim_check_store(self):
+        return claim_check.get_store(self.config.get('OPTA_CLAIM_CHECK_STORE'), self.database)
+
+    def _claim_check(self, feed, datastore, content_type):
+        threshold = int(self.config.get('OPTA_CLAIM_CHECK_THRESHOLD') or 0)
+        if not threshold or datastore is None or len(datastore) <= threshold:
+            return feed, datastore
+
+        name = '{}-{}'.format(feed['meta']['type'], feed['id'])
+        ref = self._claim_check_store().put(name, datastore, content_type)
+        _log.info(f'Datastore of {name} ({len(datastore)} bytes) stored out of band')
+
+        return {**feed, 'datastore_ref': ref}, None
+
+    def _publish_input(self, feed):
+        if self.config.get('OPTA_PAYLOAD_FORMAT', 'rows') == columnar.COLUMNAR:
+            feed = columnar.encode_feed(feed)
+
+        serializer = self.config.get('OPTA_WIRE_SERIALIZER', wire.JSON)
+        compression = self.config.get('OPTA_WIRE_COMPRESSION') or None
+        if compression == 'none':
+            compression = None
+
+        if serializer == wire.BSON:
+            kwargs = {'content_type': wire.BSON_CONTENT_TYPE, 'content_encoding': 'binary'}
+        else:
+            kwargs = {}
+
+        feed_type = feed['meta']['type']
+        start = time.monotonic()
+        datastore = wire.encode_datastore(serializer, feed['datastore']) if 'datastore' in feed else None
+        feed, datastore = self._claim_check({k: v for k, v in feed.items() if k != 'datastore'}, datastore,
+                                            kwargs.get('content_type', claim_check.CONTENT_TYPE))
+        payload = wire.encode_feed(serializer, feed, datastore)
+        self.metrics.observe('serialize_seconds', time.monotonic() - start, feed=feed_type)
+        self.metrics.observe('serialized_bytes', len(payload), feed=feed_type)
+
+        with self.metrics.timer('publish_seconds', feed=feed_type):
+            self.pub_input(payload, compression=compression, **kwargs)
+
+    @timer(interval=CLAIM_CHECK_SWEEP_INTERVAL)
+    def sweep_claim_checks(self):
+        if not int(self.config.get('OPTA_CLAIM_CHECK_THRESHOLD') or 0):
+            return 0
+
+        max_age = int(self.config.get('OPTA_CLAIM_CHECK_TTL') or 7*24*60*60)
+        swept = self._claim_check_store().sweep(max_age)
+        if swept:
+            _log.warning(f'Removed {swept} claim checked datastores never acknowledged within {max_age}s')
+        return swept
+
+    def _track_season(self, sport, season_id, competition_id, calendar):
+        dates = [r['date'].astimezone(pytz.utc).replace(tzinfo=None) if r['date'].tzinfo else r['date']
+                 for r in calendar if r.get('date') is not None]
+        last_date = max(dates) if dates else None
+
+        grace = datetime.timedelta(days=float(self.config.get('OPTA_SEASON_GRACE_DAYS') or 30))
+        closed = last_date is not None and last_date + grace < datetime.datetime.utcnow()
+
+        self.database.seasons.update_one(
+            {'sport': sport, 'season_id': season_id, 'competition_id': competition_id},
+            {'$set': {'last_date': last_date, 'closed': closed, 'updated': datetime.datetime.utcnow()}},
+            upsert=True)
+
+        if closed:
+            _log.info(f'Season {competition_id}/{season_id} ({sport}) is closed')
+
+        return closed
+
+    def _get_closed_seasons(self, sport):
+        # Closed seasons are still polled now and then, in case later rounds get published (cups, play-offs)
+        recheck = datetime.timedelta(days=float(self.config.get('OPTA_SEASON_RECHECK_DAYS') or 7))
+        return set((r['season_id'], r['competition_id']) for r in self.database.seasons.find(
+            {'sport': sport, 'closed': True, 'updated': {'$gte': datetime.datetime.utcnow() - recheck}},
+            {'season_id': 1, 'competition_id': 1, '_id': 0}))
+
+    @rpc
+    def get_seasons(self, sport=None):
+        query = {'sport': sport} if sport else {}
+        return list(self.database.seasons.find(query, {'_id': 0}))
 
     @rpc
     def add_f1(self, season_id, competition_id):
 
         calendar = self.opta.get_soccer_calendar(season_id, competition_id)
 
-        self.database['f1'].create_index('id')
-        self.database['f1'].create_index('date')
+        self._save_calendar('f1', calendar)
 
-        for row in calendar:
-            self.database['f1'].update_one(
-                {'id': row['id']}, {'$set': row}, upsert=True)
+        self.calendar.upsert('f1', calendar)
+        self._track_season('soccer', season_id, competition_id, calendar)
 
     @rpc
     def add_ru1(self, season_id, competition_id):
         calendar = self.opta.get_rugby_calendar(season_id, competition_id)
 
-        self.database['ru1'].create_index('id')
-        self.database['ru1'].create_index('date')
+        self._save_calendar('ru1', calendar)
+
+        self.calendar.upsert('ru1', calendar)
+        self._track_season('rugby', season_id, competition_id, calendar)
 
+    def _save_calendar(self, name, calendar):
+        # The calendar index of every replica picks the rows up from their update date
+        updated = datetime.datetime.utcnow()
         for row in calendar:
-            self.database['ru1'].update_one(
-                {'id': row['id']}, {'$set': row}, upsert=True)
+            self.database[name].update_one(
+                {'id': row['id']}, {'$set': {**row, 'updated': updated}}, upsert=True)
 
-    @timer(interval=24*60*60)
-    @rpc
-    def update_all_f1(self):
-        _log.info('Updating all f1 files ...')
-        calendars = self.database.f1.aggregate([
-            {
-                "$group": {
-                    "_id": {"season_id": "$season_id", "competition_id": "$competition_id"},
+    def _update_all_calendars(self, sport, name, get_calendar):
+        with self.cycles.guard(f'update_all_{name}', UPDATE_INTERVAL,
+                               scope=self.coordination.replica) as cycle:
+            if cycle is None:
+                return
+
+            calendars = self.database[name].aggregate([
+                {
+                    "$group": {
+                        "_id": {"season_id": "$season_id", "competition_id": "$competition_id"},
+                    }
                 }
-            }
-        ])
+            ])
+            closed = self._get_closed_seasons(sport)
+            cursor = cycle.cursor()
 
-        for row in calendars:
-            try:
-                calendar = self.opta.get_soccer_calendar(
-                    row['_id']['season_id'], row['_id']['competition_id'])
-            except OptaWebServiceError:
-                continue
+            seasons = sorted((f'{sport}:{r["_id"]["season_id"]}:{r["_id"]["competition_id"]}',
+                              r['_id']['season_id'], r['_id']['competition_id']) for r in calendars)
+
+            for key, season_id, competition_id in seasons:
+                if cursor is not None and key <= cursor:
+                    continue
+
+                if (season_id, competition_id) in closed or not self.coordination.owns(key):
+                    continue
+
+                try:
+                    calendar = get_calendar(season_id, competition_id)
+                except OptaWebServiceError:
+                    continue
+
+                self._save_calendar(name, calendar)
+                self.calendar.upsert(name, calendar)
+                self._track_season(sport, season_id, competition_id, calendar)
 
-            for game in calendar:
-                self.database.f1.update_one({'id': game['id']},
-                                            {'$set': game}, upsert=True)
+                if not cycle.advance(key) or cycle.exceeded():
+                    _log.warning(f'Updating {name} files stopped, resuming after {key}')
+                    return
 
-    @timer(interval=24*60*60)
+            cycle.complete()
+
+    @timer(interval=UPDATE_INTERVAL)
+    @rpc
+    def update_all_f1(self):
+        _log.info('Updating all f1 files ...')
+        self._update_all_calendars('soccer', 'f1', self.opta.get_soccer_calendar)
+
+    @timer(interval=UPDATE_INTERVAL)
     @rpc
     def update_all_ru1(self):
         _log.info('Updating all RU1 files ...')
-        calendars = self.database.ru1.aggregate([
-            {
-                "$group": {
-                    "_id": {"season_id": "$season_id", "competition_id": "$competition_id"},
-                }
-            }
-        ])
-
-        for row in calendars:
-            try:
-                calendar = self.opta.get_rugby_calendar(
-                    row['_id']['season_id'], row['_id']['competition_id'])
-            except OptaWebServiceError:
-                continue
-
-            for game in calendar:
-                self.database.ru1.update_one({'id': game['id']},
-                                             {'$set': game}, upsert=True)
+        self._update_all_calendars('rugby', 'ru1', self.opta.get_rugby_calendar)
 
     def get_soccer_ids_by_dates(self, start_date, end_date):
         start = dateutil.parser.parse(start_date)
         end = dateutil.parser.parse(end_date)
-        ids = self.database.f1.find(
-            {'date': {'$gte': start, '$lt': end}},
-            {'id': 1, 'competition_id': 1, 'season_id': 1, '_id': 0})
+        games = self.calendar.between('f1', start, end)
 
-        return list(ids)
+        return [{k: g.get(k) for k in ('id', 'competition_id', 'season_id')} for g in games]
 
     def get_soccer_ids_by_season_and_competition(self, season_id, competition_id):
         ids = self.database.f1.find({'season_id': season_id, 'competition_id': competition_id},
@@ -303,17 +596,14 @@ class OptaCollectorService(object):
         return [r['id'] for r in ids]
 
     def get_f1(self, game_id):
-        game = self.database.f1.find_one({'id': game_id}, {'_id': 0})
-        return game
+        return self.calendar.get('f1', game_id)
 
     def get_rugby_ids_by_dates(self, start_date, end_date):
         start = dateutil.parser.parse(start_date)
         end = dateutil.parser.parse(end_date)
-        ids = self.database.ru1.find(
-            {'date': {'$gte': start, '$lt': end}},
-            {'id': 1, 'competition_id': 1, 'season_id': 1, '_id': 0})
+        games = self.calendar.between('ru1', start, end)
 
-        return list(ids)
+        return [{k: g.get(k) for k in ('id', 'competition_id', 'season_id')} for g in games]
 
     def get_rugby_ids_by_season_and_competition(self, season_id, competition_id):
         ids = self.database.ru1.find({'season_id': season_id, 'competition_id': competition_id},
@@ -322,137 +612,70 @@ class OptaCollectorService(object):
         return [r['id'] for r in ids]
 
     def get_ru1(self, game_id):
-        game = self.database.ru1.find_one({'id': game_id}, {'_id': 0})
-        return game
+        return self.calendar.get('ru1', game_id)
 
     def get_f9(self, match_id):
 
-        self.database.f9.create_index('id')
-
         game = self.opta.get_soccer_game(match_id)
 
         if not game:
             return None
 
-        checksum = self._checksum(game)
+        transform = Stopwatch()
+        with transform.running():
+            checksum = self._checksum(game)
+            extracted = self._extract_referential_from_soccer_game(game)
 
-        old_checksum = self.database.f9.find_one(
-            {'id': match_id}, {'checksum': 1, '_id': 0})
+        previous = self._get_acked_version('f9', match_id)
+        status = self._get_status(previous, checksum)
 
-        if old_checksum is None:
-            status = 'CREATED'
-        else:
-            if old_checksum['checksum'] != checksum:
-                status = 'UPDATED'
-            else:
-                status = 'UNCHANGED'
+        referential, entities = self._filter_referential(extracted, status)
+        with transform.running():
+            datastore = self._build_f9_datastore(match_id, game, referential['labels'])
 
-        referential = self._extract_referential_from_soccer_game(game)
-        datastore = [
-            {
-                **self._get_opta_meta('f9', 'playerstat', match_id),
-                'records': game['player_stats']
-            },
-            {
-                **self._get_opta_meta('f9', 'teamstat', match_id),
-                'records': game['team_stats']
-            },
-            {
-                **self._get_opta_meta('f9', 'event', match_id),
-                'records': game['events']
-            },
-            {
-                **self._get_opta_meta('f9', 'matchinfo', match_id),
-                'records': [game['match_info']]
-            },
-            {
-                **LABEL,
-                'records': referential['labels']
-            }
-        ]
+        full_datastore = datastore
+        datastore = self._track_datastore('f9', match_id, checksum, status, previous, datastore, entities)
+        self.metrics.observe('transform_seconds', transform.elapsed, feed='f9')
 
         return {
             'id': match_id,
             'status': status,
             'checksum': checksum,
+            'delta': datastore is not full_datastore,
             'referential': {k: referential[k] for k in ('entities', 'events') if k in referential},
             'datastore': datastore,
             'meta': {'type': 'f9', 'source': 'opta', 'content_id': f'f{match_id}'}
         }
 
     def get_ru7(self, match_id):
-        self.database.ru7.create_index('id')
-
         game = self.opta.get_rugby_game(match_id)
 
         if game:
-            checksum = self._checksum(game)
+            transform = Stopwatch()
+            with transform.running():
+                checksum = self._checksum(game)
 
-            old_checksum = self.database.ru7.find_one(
-                {'id': match_id}, {'checksum': 1, '_id': 0})
+            previous = self._get_acked_version('ru7', match_id)
+            status = self._get_status(previous, checksum)
 
-            if old_checksum is None:
-                status = 'CREATED'
-            else:
-                if old_checksum['checksum'] != checksum:
-                    status = 'UPDATED'
-                else:
-                    status = 'UNCHANGED'
+            ru1 = self.get_ru1(match_id)
 
-            ru1 = self.database.ru1.find_one({'id': match_id}, {'_id': 0})
+            with transform.running():
+                extracted = self._extract_referential_from_rugby_game(ru1=ru1, ru7=game)
+            referential, entities = self._filter_referential(extracted, status)
 
-            referential = self._extract_referential_from_rugby_game(
-                ru1=ru1, ru7=game)
+            with transform.running():
+                datastore = self._build_ru7_datastore(match_id, game, ru1, referential['labels'])
 
-            datastore = [
-                {
-                    **self._get_opta_meta('ru7', 'playerstat', match_id),
-                    'records': game['player_stats']
-                },
-                {
-                    **self._get_opta_meta('ru7', 'teamstat', match_id),
-                    'records': game['team_stats']
-                },
-                {
-                    **self._get_opta_meta('ru7', 'event', match_id),
-                    'records': game['events']
-                },
-                {
-                    **self._get_opta_meta('ru7', 'matchscore', match_id),
-                    'records': [{
-                        'id': game['rrml']['id'],
-                        'attendance': game['rrml']['attendance'],
-                        'away_ht_score': game['rrml']['away_ht_score'],
-                        'away_score': game['rrml']['away_score'],
-                        'home_ht_score': game['rrml']['home_ht_score'],
-                        'home_score': game['rrml']['home_score']
-                    }]
-                },
-                {
-                    **self._get_opta_meta('ru7', 'matchinfo', match_id),
-                    'records': [
-                        {
-                            'venue_id': ru1['venue_id'],
-                            'date': ru1['date'],
-                            'season_id': ru1['season_id'],
-                            'id': ru1['id'],
-                            'group_name': ru1['group_name'],
-                            'group_id': ru1['group_id'],
-                            'round': ru1['round'],
-                            'competition_id': ru1['competition_id']
-                        }
-                    ]
-                },
-                {
-                    **LABEL,
-                    'records': referential['labels']
-                }
-            ]
+            full_datastore = datastore
+            datastore = self._track_datastore('ru7', match_id, checksum, status, previous, datastore, entities)
+            self.metrics.observe('transform_seconds', transform.elapsed, feed='ru7')
 
             return {
                 'id': match_id,
                 'status': status,
                 'checksum': checksum,
+                'delta': datastore is not full_datastore,
                 'datastore': datastore,
                 'referential': {k: referential[k] for k in ('entities', 'events') if k in referential},
                 'meta': {'type': 'ru7', 'source': 'opta'}
@@ -460,75 +683,246 @@ class OptaCollectorService(object):
 
         return None
 
-    def get_f40(self, season_id, competition_id):
-        squads = self.opta.get_soccer_squads(season_id, competition_id)
+    def get_f40(self, season_id, competition_id, force=False):
+        squads = self.opta.get_soccer_squads(season_id, competition_id, force=force)
 
         if not squads:
             return None
 
-        meta = OPTA['f40']
+        transform = Stopwatch()
+        with transform.running():
+            datastore = self._build_f40_datastore(squads)
+            checksum = self._squads_checksum(squads)
 
-        def get_fields(k):
-            return set((m[0] for m in meta[k]['meta']))
+        content_id = ','.join([season_id, competition_id])
 
-        datastore = [
-            {
-                **meta['playerinfo'],
-                'records': [{k: v for k, v in p.items() if k in get_fields('playerinfo')}
-                for t in squads for p in t['players']]
-            },
-            {
-                **meta['teaminfo'],
-                'records': [{k: v for k,v in t.items() if k in get_fields('teaminfo')}
-                for t in squads]
-            },
-            {
-                **meta['link'],
-                'records': [{
-                    'id': hashlib.md5(
-                        ''.join([p['id'], t['id'], t['season_id'], t['competition_id']])\
-                            .encode('utf-8')).hexdigest(),
-                    'competition_id': t['competition_id'],
-                    'season_id': t['season_id'],
-                    'player_id': p['id'],
-                    'team_id': t['id'],
-                    'join_date': p['join_date']
-                } for t in squads for p in t['players']]
-            }
-        ]
+        previous = self._get_acked_version('f40', content_id)
+        status = self._get_status(previous, checksum)
+
+        full_datastore = datastore
+        datastore = self._track_datastore('f40', content_id, checksum, status, previous, datastore, {})
+
+        with transform.running():
+            changed_players = set(r['id'] for s in datastore if s['target_table'] == 'soccer_playerinfo'
+                                  for r in s['records'])
+            changed_teams = set(r['id'] for s in datastore if s['target_table'] == 'soccer_teaminfo'
+                                for r in s['records'])
+            teaminfo_fields = _get_fields('f40', 'teaminfo')
+        self.metrics.observe('transform_seconds', transform.elapsed, feed='f40')
 
-        content_id = ','.join([season_id, competition_id])
         return {
             'id': content_id,
-            'status': 'UPDATED',
-            'checksum': None,
+            'status': status,
+            'checksum': checksum,
+            'delta': datastore is not full_datastore,
             'referential': {
                 'informations': list(itertools.chain(
-                    datastore[0]['records'],
-                    [{k: v for k,v in t.items() if k in get_fields('teaminfo').union({'team_kits'})}
-                    for t in squads]))
+                    [r for r in full_datastore[0]['records'] if r['id'] in changed_players],
+                    [{k: v for k,v in t.items() if k in teaminfo_fields or k == 'team_kits'}
+                    for t in squads if t['id'] in changed_teams]))
             },
             'datastore': datastore,
             'meta': {'type': 'f40', 'source': 'opta', 'content_id': content_id}
         }
-        
+
     def ack_f9(self, match_id, checksum):
-        self.database.f9.update_one(
-            {'id': match_id}, {'$set': {'checksum': checksum}}, upsert=True)
+        self._ack_version('f9', match_id, checksum)
 
     @rpc
     def unack_f9(self, match_id):
         self.database.f9.delete_one({'id': match_id})
 
     def ack_ru7(self, match_id, checksum):
-        self.database.ru7.update_one(
-            {'id': match_id}, {'$set': {'checksum': checksum}}, upsert=True)
+        self._ack_version('ru7', match_id, checksum)
+
+    def ack_f40(self, content_id, checksum):
+        self._ack_version('f40', content_id, checksum)
 
     @rpc
     def unack_ru7(self, match_id):
         self.database.ru7.delete_one({'id': match_id})
 
-    @timer(interval=5*60)
+    @rpc
+    def refresh_f40(self, season_id, competition_id):
+        feed = self.get_f40(season_id, competition_id, force=True)
+
+        if feed and feed['status'] != 'UNCHANGED':
+            _log.info(f'Publishing {competition_id}/{season_id} files ...')
+            self._publish_input(feed)
+
+        return feed['status'] if feed else None
+
+    @rpc
+    def get_cycle_stats(self):
+        return self.cycles.get_stats()
+
+    @rpc
+    def get_f40_cache_stats(self):
+        return self.opta.squads_cache.stats()
+
+    @rpc
+    def get_coalescing_stats(self):
+        return self.opta.flights.stats()
+
+    @rpc
+    def get_latency_stats(self):
+        return self.opta.latencies.stats()
+
+    @rpc
+    def start_profiling(self, mode='sampling', seconds=None, cycles=None, entrypoints=None, interval=0.005):
+        return self.profiler.start_profiling(mode, seconds, cycles, entrypoints, interval)
+
+    @rpc
+    def stop_profiling(self):
+        return self.profiler.stop_profiling()
+
+    @rpc
+    def get_profile(self, format='pstats', entrypoint=None, limit=50):
+        return self.profiler.get_profile(format, entrypoint, limit)
+
+    @rpc
+    def get_stalls(self):
+        return self.watchdog.stats()
+
+    @rpc
+    def get_metrics(self, format='json'):
+        if format == 'prometheus':
+            return self.metrics.to_prometheus()
+        return self.metrics.snapshot()
+
+    @rpc
+    def get_bulkhead_stats(self):
+        return {name: b.stats() for name, b in self.bulkheads.items()}
+
+    @rpc
+    def get_upstream_stats(self):
+        return {
+            'limiters': {feed: l.stats() for feed, l in self.opta.limiters.items()},
+            'breakers': {feed: b.stats() for feed, b in self.opta.breakers.items()}
+        }
+
+    @rpc
+    def audit_indexes(self):
+        results = indexes.audit_queries(self.database)
+        for r in results:
+            if r['collscan']:
+                _log.warning(f'{r["query"]} on {r["collection"]} runs a collection scan')
+        return results
+
+    @rpc
+    def reset_referential_cache(self):
+        self.database.referential.delete_many({})
+
+    def _handle_game(self, sport, game_id):
+        feed_type = 'f9' if sport == 'soccer' else 'ru7'
+        try:
+            feed = self.get_f9(game_id) if sport == 'soccer' else self.get_ru7(game_id)
+        except OptaWebServiceError:
+            _log.warning(f'Game {game_id} could not be retrieved!')
+            self.metrics.inc('feeds_total', feed=feed_type, status='ERROR')
+            return None
+
+        if not feed:
+            self.metrics.inc('feeds_total', feed=feed_type, status='MISSING')
+            return None
+
+        self.metrics.inc('feeds_total', feed=feed_type, status=feed['status'])
+
+        # An unchanged game was tracked when it was first published, so it costs no write
+        if feed['status'] != 'UNCHANGED':
+            self._track_freshness(sport, feed_type, game_id)
+            _log.info(f'Publishing {sport} {game_id} files ...')
+            self._publish_input(feed)
+
+        return feed['status']
+
+    def _track_freshness(self, sport, feed_type, game_id):
+        now = datetime.datetime.utcnow()
+        row = (self.get_f1(game_id) if sport == 'soccer' else self.get_ru1(game_id)) or {}
+
+        kickoff = row.get('date')
+        if kickoff is not None and kickoff.tzinfo is not None:
+            kickoff = kickoff.astimezone(pytz.utc).replace(tzinfo=None)
+
+        update = {
+            '$setOnInsert': {
+                'sport': sport,
+                'kickoff': kickoff,
+                'competition_id': row.get('competition_id'),
+                'season_id': row.get('season_id')
+            },
+            '$min': {'final_seen': now, 'published': now}
+        }
+        self.database.freshness.update_one({'type': feed_type, 'id': game_id}, update, upsert=True)
+
+    def _track_loaded(self, feed_type, game_id):
+        self.database.freshness.update_one(
+            {'type': feed_type, 'id': game_id}, {'$min': {'loaded': datetime.datetime.utcnow()}})
+
+    @staticmethod
+    def _percentiles(values):
+        if not values:
+            return None
+        values = sorted(values)
+        return {
+            'count': len(values),
+            **{f'p{q}': values[min(len(values) - 1, int(q / 100 * len(values)))] for q in (50, 90, 99)}
+        }
+
+    @rpc
+    def get_freshness(self, sport=None, competition_id=None, days=30):
+        query = {'final_seen': {'$gte': datetime.datetime.utcnow() - datetime.timedelta(days=days)}}
+        if sport:
+            query['sport'] = sport
+        if competition_id:
+            query['competition_id'] = competition_id
+
+        stages = {
+            'detection': ('kickoff', 'final_seen'),
+            'publication': ('final_seen', 'published'),
+            'loading': ('published', 'loaded'),
+            'end_to_end': ('kickoff', 'loaded')
+        }
+
+        competitions = dict()
+        for doc in self.database.freshness.find(query, {'_id': 0}):
+            durations = competitions.setdefault((doc['sport'], doc.get('competition_id')), {k: [] for k in stages})
+            for stage, (start, end) in stages.items():
+                if doc.get(start) is not None and doc.get(end) is not None:
+                    durations[stage].append((doc[end] - doc[start]).total_seconds())
+
+        return [{
+            'sport': sport,
+            'competition_id': competition_id,
+            **{stage: self._percentiles(values) for stage, values in durations.items()}
+        } for (sport, competition_id), durations in sorted(competitions.items(), key=lambda c: str(c[0]))]
+
+    def _drain_fetch_queue(self):
+        for request in self.fetch_queue.drain():
+            status = None
+            try:
+                status = self._handle_game(request.sport, request.game_id)
+            finally:
+                request.done(status)
+
+    @timer(interval=FETCH_QUEUE_INTERVAL)
+    def process_fetch_queue(self):
+        self._drain_fetch_queue()
+
+    @rpc
+    def fetch_now(self, sport, game_id, priority=0):
+        if sport not in SPORTS:
+            raise ValueError(f'Unknown sport {sport}, expected one of {", ".join(SPORTS)}')
+
+        # Queued games are handled by process_fetch_queue and by publish between two games
+        request = self.fetch_queue.push(sport, game_id, priority)
+
+        result = request.wait(self.config.get('FETCH_NOW_TIMEOUT', 60))
+        _log.info(f'On-demand fetch of {sport} {game_id}: {result["status"]} '
+                  f'in {result["time_to_publish"]}s')
+        return result
+
+    @timer(interval=PUBLISH_INTERVAL)
     @rpc
     def publish(self, days_offset=3):
         _log.info(f'Loading opta games for the last {days_offset} days ...')
@@ -544,21 +938,14 @@ class OptaCollectorService(object):
             [('rugby', i) for i in self.get_rugby_ids_by_dates(
                 start.isoformat(), end.isoformat())]
         )
+        games = sorted((f'{t}:{i["id"]}', t, i) for t, i in games)
 
-        def handle_game(game):
-            t, i = game
-            try:
-                feed = self.get_f9(i['id']) if t == 'soccer' else self.get_ru7(i['id'])
-            except OptaWebServiceError:
-                _log.warning(f'Game {i["id"]} could not be retrieved!')
-                return False
-            
-            if feed and feed['status'] != 'UNCHANGED':
-                _log.info(f'Publishing {game} files ...')
-                self.pub_input(bson.json_util.dumps(feed))
-                return True
-            
-            return False
+        # Squads are partitioned apart from the games: one replica polls each active competition and the
+        # squads cache (OPTA_F40_TTL) bounds how often it reaches upstream
+        competitions = sorted(set(('soccer', i['competition_id'], i['season_id']) for _, t, i in games
+                                  if t == 'soccer' and self.coordination.owns(
+                                      f'f40:{i["season_id"]}:{i["competition_id"]}')))
+        games = [g for g in games if self.coordination.owns(g[0])]
 
         def handle_competition(competition):
             t, comp, season = competition
@@ -567,25 +954,69 @@ class OptaCollectorService(object):
                 feed = self.get_f40(season, comp) if t == 'soccer' else None
             except OptaWebServiceError:
                 _log.warning(f'Competition {comp}/{season} could not be retrieved!')
+                self.metrics.inc('feeds_total', feed='f40', status='ERROR')
                 return
 
-            if feed:
+            self.metrics.inc('feeds_total', feed='f40', status=feed['status'] if feed else 'MISSING')
+
+            if feed and feed['status'] != 'UNCHANGED':
                 _log.info(f'Publishing {comp}/{season} files ...')
-                self.pub_input(bson.json_util.dumps(feed))
-        
-        competitions = set()
-        for g in games:
-            handled = handle_game(g)
-            if handled:
-                competitions.add((g[0], g[1]['competition_id'], g[1]['season_id']))
+                self._publish_input(feed)
         
-        for c in competitions:
-            handle_competition(c)
+        with self.cycles.guard('publish', PUBLISH_INTERVAL, scope=self.coordination.replica) as cycle:
+            if cycle is None:
+                return
+
+            def handle_game(t, game_id):
+                self._drain_fetch_queue()
+                if cycle.stopped():
+                    return SKIPPED
+                return self._handle_game(t, game_id)
+
+            cursor = cycle.cursor()
+            tasks = []
+            for key, t, i in games:
+                if cursor is not None and key <= cursor:
+                    continue
+
+                try:
+                    task = self.bulkheads[t].submit(handle_game, t, i['id'])
+                except BulkheadFullError as e:
+                    _log.warning(f'Game {i["id"]} postponed: {str(e)}')
+                    task = None
+                tasks.append((key, t, i, task))
+
+            resumable = True
+            for key, t, i, task in tasks:
+                status = task.wait() if task is not None else SKIPPED
+                if status == FAILED:
+                    _log.error(f'Game {i["id"]} failed, it will be retried on the next cycle')
+                if status in (SKIPPED, FAILED):
+                    resumable = False
+                    continue
+
+                if resumable:
+                    resumable = cycle.advance(key)
+
+            if resumable:
+                cycle.complete()
+            else:
+                _log.warning('Publishing stopped before its last game, resuming from the last completed one')
+
+            squads = []
+            for c in competitions:
+                try:
+                    squads.append(self.bulkheads['squads'].submit(handle_competition, c))
+                except BulkheadFullError as e:
+                    _log.warning(f'Competition {c[1]}/{c[2]} postponed: {str(e)}')
+
+            for task in squads:
+                task.wait()
 
     @event_handler(
         'loader', 'input_loaded', handler_type=BROADCAST, reliable_delivery=False)
     def ack(self, payload):
-        msg = bson.json_util.loads(payload)
+        msg = wire.loads(payload)
         meta = msg.get('meta', None)
         if not meta:
             return
@@ -595,6 +1026,9 @@ class OptaCollectorService(object):
             return
         t = meta['type']
 
+        if msg.get('datastore_ref'):
+            self._claim_check_store().delete(msg['datastore_ref'])
+
         def publish_notification(t, game, id_):
             _log.info(f'Publishing notification for {id_}')
             self.pub_notif(bson.json_util.dumps({
@@ -607,6 +1041,7 @@ class OptaCollectorService(object):
             if checksum:
                 _log.info(f'Acknowledging {t} file: {msg["id"]}')
                 self.ack_f9(msg['id'], checksum)
+                self._track_loaded('f9', msg['id'])
                 game = self.get_f1(msg['id'])
                 publish_notification(t, game, msg['id'])
             else:
@@ -615,12 +1050,15 @@ class OptaCollectorService(object):
             if checksum:
                 _log.info(f'Acknowledging {t} file: {msg["id"]}')
                 self.ack_ru7(msg['id'], checksum)
+                self._track_loaded('ru7', msg['id'])
                 game = self.get_ru1(msg['id'])
                 publish_notification(t, game, msg['id'])
             else:
                 _log.warning(f'Received an event {t} {msg["id"]} without checksum')
         elif t == 'f40':
             _log.info(f'Acknowledging {t} file: {msg["id"]}')
+            if checksum:
+                self.ack_f40(msg['id'], checksum)
             self.pub_notif(bson.json_util.dumps({
                 'id': msg['id'],
                 'source': 'opta',
@@ -0,0 +1,165 @@
+import re
+import logging
+import datetime
+import itertools
+
+import dateutil.parser
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from application.services.meta import OPTA, LABEL
+
+
+_log = logging.getLogger(__name__)
+
+VECTORIZE_THRESHOLD = 512
+
+_VARCHAR = re.compile(r'VARCHAR\((\d+)\)')
+
+
+def _to_int(v):
+    if isinstance(v, int) and not isinstance(v, bool):
+        return v
+    return int(float(v))
+
+
+def _to_float(v):
+    return float(v)
+
+
+def _to_timestamp(v):
+    if isinstance(v, datetime.datetime):
+        return v
+    return dateutil.parser.parse(v)
+
+
+def _to_str(v):
+    return v if isinstance(v, str) else str(v)
+
+
+class Column(object):
+    def __init__(self, name, sql_type):
+        self.name = name
+        self.sql_type = sql_type
+        self.length = None
+        self.dtype = None
+
+        match = _VARCHAR.match(sql_type)
+        if match:
+            self.length = int(match.group(1))
+            self.convert = _to_str
+        elif sql_type == 'INTEGER':
+            self.convert = _to_int
+            self.dtype = 'int64'
+        elif sql_type == 'FLOAT':
+            self.convert = _to_float
+            self.dtype = 'float64'
+        elif sql_type == 'TIMESTAMP':
+            self.convert = _to_timestamp
+        else:
+            self.convert = None
+
+    def _vectorized(self, values):
+        # Same results as the scalar loop, or None to let it handle the batch (and count invalid values)
+        arr = np.array(values, dtype=object)
+        mask = np.not_equal(arr, None) & np.not_equal(arr, '')
+        try:
+            converted = arr[mask].astype('float64')
+        except (ValueError, TypeError, OverflowError):
+            return None
+        if self.dtype == 'int64':
+            if not np.all(np.abs(converted) < 2 ** 63):
+                return None
+            converted = np.trunc(converted).astype('int64')
+
+        results = np.full(len(values), None, dtype=object)
+        results[mask] = converted.tolist()
+        return results.tolist(), 0
+
+    def coerce(self, values):
+        if self.convert is None:
+            return values, 0
+
+        if self.dtype is not None and np is not None and len(values) >= VECTORIZE_THRESHOLD:
+            result = self._vectorized(values)
+            if result is not None:
+                return result
+
+        invalid = 0
+        results = []
+        for v in values:
+            if v is None or v == '':
+                results.append(None)
+                continue
+            try:
+                v = self.convert(v)
+            except (ValueError, TypeError, OverflowError):
+                invalid += 1
+                v = None
+            else:
+                if self.length is not None and len(v) > self.length:
+                    invalid += 1
+            results.append(v)
+
+        return results, invalid
+
+
+class RecordCodec(object):
+    def __init__(self, table, meta, pivot_type=None, pivot_columns=()):
+        self.table = table
+        self.columns = [Column(name, sql_type) for name, sql_type in meta]
+        self.pivot_columns = [Column(name, pivot_type) for name in pivot_columns]
+
+    def pin(self, records):
+        # Wide records carry whatever stats the feed sent: keep exactly the declared pivot columns
+        known = set(c.name for c in itertools.chain(self.columns, self.pivot_columns))
+        dropped = set()
+
+        for r in records:
+            for k in [k for k in r if k not in known]:
+                dropped.add(k)
+                del r[k]
+            for column in self.pivot_columns:
+                r.setdefault(column.name, None)
+
+        if dropped:
+            _log.warning(f'Undeclared columns dropped from {self.table}: {", ".join(sorted(dropped))}')
+
+        return records
+
+    def coerce(self, records):
+        if self.pivot_columns:
+            self.pin(records)
+
+        for column in itertools.chain(self.columns, self.pivot_columns):
+            if column.convert is None:
+                continue
+
+            present = [r for r in records if column.name in r]
+            if not present:
+                continue
+
+            values, invalid = column.coerce([r[column.name] for r in present])
+            for r, v in zip(present, values):
+                r[column.name] = v
+
+            if invalid:
+                _log.warning(f'{invalid} invalid values for {self.table}.{column.name} ({column.sql_type})')
+
+        return records
+
+
+def compile_codecs(opta, label):
+    codecs = {
+        (opta_type, data_type): RecordCodec(meta['target_table'], meta['meta'], meta.get('pivot_type'),
+                                            meta.get('pivot_columns', ()))
+        for opta_type, tables in opta.items() for data_type, meta in tables.items()
+    }
+    codecs['label'] = RecordCodec(label['target_table'], label['meta'])
+    return codecs
+
+
+CODECS = compile_codecs(OPTA, LABEL)
@@ -0,0 +1,49 @@
+import struct
+
+import bson
+import bson.json_util
+
+JSON = 'json'
+BSON = 'bson'
+BSON_CONTENT_TYPE = 'application/bson'
+
+
+def encode_bson(obj):
+    return bson.BSON.encode(obj)
+
+
+def decode_bson(data):
+    return bson.BSON(data).decode()
+
+
+def encode_datastore(serializer, datastore):
+    # BSON needs a document at the top level, the datastore travels as its only field
+    if serializer == BSON:
+        return encode_bson({'datastore': datastore})
+    return bson.json_util.dumps(datastore).encode('utf-8')
+
+
+def encode_feed(serializer, feed, datastore=None):
+    # datastore is the output of encode_datastore, spliced in as is so it is never encoded twice
+    if serializer == BSON:
+        envelope = encode_bson(feed)
+        if datastore is None:
+            return envelope
+        body = envelope[4:-1] + datastore[4:-1]
+        return struct.pack('<i', len(body) + 5) + body + b'\x00'
+
+    envelope = bson.json_util.dumps(feed)
+    if datastore is None:
+        return envelope
+    separator = ', ' if feed else ''
+    return envelope[:-1] + separator + '"datastore": ' + datastore.decode('utf-8') + '}'
+
+
+def loads(payload):
+    if isinstance(payload, dict):
+        return payload
+
+    if isinstance(payload, (bytes, bytearray)):
+        return decode_bson(bytes(payload))
+
+    return bson.json_util.loads(payload)
@@ -1,7 +1,16 @@
+import time
+from unittest import mock
+
+import eventlet
+import pytest
 import vcr
 from nameko.testing.services import dummy, entrypoint_hook
+from pymongo import MongoClient
 
+from application.dependencies import opta, resilience, metrics, profiling, watchdog, bulkheads
+from application.dependencies.coordination import Coordinator
 from application.dependencies.opta import OptaDependency
+from application.benchmarks import generator, suite
 
 
 class DummyService(object):
@@ -129,3 +138,442 @@ def test_f40(container_factory):
             assert p['name']
             assert p['position']
             assert p['join_date']
+
+
+F40_XML = b"""<SoccerFeed><SoccerDocument competition_id="24" competition_name="Ligue 1" season_id="2020"
+season_name="Season 2020/2021"><Team uID="t1" country="France" short_club_name="Club"><Name>Club</Name>
+<SYMID>CLU</SYMID><Player uID="p1"><Name>Player</Name><Position>Forward</Position>
+<Stat Type="join_date">2020-07-01</Stat></Player></Team></SoccerDocument></SoccerFeed>"""
+
+
+def test_squads_cache():
+    webservice = opta.OptaWebService('http://opta', 'user', 'password', squads_ttl=60)
+
+    with mock.patch.object(opta.requests, 'get', return_value=mock.Mock(content=F40_XML)) as get:
+        squads = webservice.get_soccer_squads('2020', '24')
+        assert squads[0]['players'][0]['id'] == 'p1'
+        assert webservice.get_soccer_squads('2020', '24') is squads
+        assert get.call_count == 1
+
+        webservice.get_soccer_squads('2020', '24', force=True)
+        assert get.call_count == 2
+
+        webservice.get_soccer_squads('2021', '24')
+        assert get.call_count == 3
+
+    assert webservice.squads_cache.stats() == {'ttl': 60, 'size': 2, 'hits': 1, 'misses': 2}
+
+    webservice.squads_cache.ttl = 0
+    assert webservice.squads_cache.get(('2020', '24')) is None
+
+
+def test_coalescing():
+    webservice = opta.OptaWebService('http://opta', 'user', 'password')
+
+    def get(*args, **kwargs):
+        eventlet.sleep(0.01)
+        return mock.Mock(content=F40_XML)
+
+    with mock.patch.object(opta.requests, 'get', side_effect=get) as patched:
+        threads = [eventlet.spawn(webservice.get_soccer_squads, '2020', '24') for _ in range(3)]
+        results = [t.wait() for t in threads]
+
+        assert patched.call_count == 1
+        assert results[0] == results[1] == results[2]
+        assert results[1] is not results[0]
+
+        webservice.get_soccer_squads('2020', '24')
+        assert patched.call_count == 2
+
+    def fail(*args, **kwargs):
+        eventlet.sleep(0.01)
+        return mock.Mock(content=b'<SoccerFeed/>')
+
+    with mock.patch.object(opta.requests, 'get', side_effect=fail):
+        threads = [eventlet.spawn(webservice.get_soccer_squads, '2020', '24') for _ in range(2)]
+        for t in threads:
+            with pytest.raises(opta.OptaWebServiceError):
+                t.wait()
+
+    assert webservice.flights.stats() == {'in_flight': 0, 'upstream_calls': 3, 'saved_calls': 3}
+
+    flights = opta.SingleFlight()
+    leader = eventlet.spawn(flights.do, 'key', lambda: eventlet.sleep(1))
+    eventlet.sleep(0)
+    follower = eventlet.spawn(flights.do, 'key', lambda: None)
+    eventlet.sleep(0)
+    leader.kill()
+
+    with eventlet.Timeout(1):
+        with pytest.raises(opta.OptaWebServiceError):
+            follower.wait()
+    assert flights.stats()['in_flight'] == 0
+
+
+def test_adaptive_timeout():
+    tracker = resilience.LatencyTracker(timeout=30, min_timeout=0.01)
+    assert tracker.timeout('F9') == 30
+    assert tracker.hedge_after('F9') is None
+
+    for i in range(100):
+        tracker.record('F9', 0.1 if i < 96 else 1.)
+
+    assert 0.1 <= tracker.hedge_after('F9') < 0.2
+    assert 1. <= tracker.timeout('F9') < 3.
+    assert tracker.stats()['F9']['count'] == 100
+
+    webservice = opta.OptaWebService('http://opta', 'user', 'password', timeout=0.05)
+
+    def slow(*args, **kwargs):
+        eventlet.sleep(1)
+
+    with mock.patch.object(opta.requests, 'get', side_effect=slow):
+        with pytest.raises(opta.OptaWebServiceError):
+            webservice.get_soccer_squads('2020', '24')
+
+    assert webservice.latencies.timeouts['F40'] == 1
+
+
+def test_hedged_requests():
+    calls = []
+
+    def fn():
+        calls.append(1)
+        eventlet.sleep(1 if len(calls) == 1 else 0)
+        return len(calls)
+
+    hedges = []
+    assert resilience.hedged(fn, 0.01, lambda: hedges.append(1)) == 2
+    assert hedges == [1]
+
+    assert resilience.hedged(lambda: 'fast', 0.5) == 'fast'
+    with pytest.raises(ValueError):
+        resilience.hedged(mock.Mock(side_effect=ValueError), 0.01)
+
+
+def test_circuit_breaker():
+    webservice = opta.OptaWebService('http://opta', 'user', 'password', breaker_threshold=2, breaker_reset=0.05)
+
+    with mock.patch.object(opta.requests, 'get', return_value=mock.Mock(status_code=503, content=b'')) as get:
+        for _ in range(3):
+            with pytest.raises(opta.OptaWebServiceError):
+                webservice.get_soccer_squads('2020', '24')
+
+        assert get.call_count == 2
+        assert webservice.breakers['F40'].stats() == {'state': 'open', 'failures': 2, 'opened': 1, 'rejected': 1}
+
+    eventlet.sleep(0.06)
+    with mock.patch.object(opta.requests, 'get', return_value=mock.Mock(status_code=200, content=F40_XML)):
+        webservice.get_soccer_squads('2020', '24')
+
+    assert webservice.breakers['F40'].state == 'closed'
+
+    not_played = b'<?xml version="1.0"?>\n<response><error>No data available for this game</error></response>'
+    with mock.patch.object(opta.requests, 'get', return_value=mock.Mock(
+            status_code=200, content=not_played, text=not_played.decode())):
+        for game_id in range(3):
+            assert webservice.get_soccer_game(str(game_id)) is None
+
+    assert webservice.breakers['F9'].stats()['state'] == 'closed'
+
+    envelope = b'<?xml version="1.0"?>\n<response><error>Invalid game</error></response>'
+    with mock.patch.object(opta.requests, 'get', return_value=mock.Mock(
+            status_code=200, content=envelope, text=envelope.decode())):
+        assert webservice.get_soccer_game('1') is None
+        assert webservice.get_soccer_game('2') is None
+
+    assert webservice.breakers['F9'].stats()['state'] == 'open'
+
+
+class BulkheadService(object):
+    name = 'bulkhead_service'
+
+    bulkheads = bulkheads.Bulkheads()
+
+    @dummy
+    def submit(self, fn):
+        return self.bulkheads['soccer'].submit(fn)
+
+
+def test_bulkheads(container_factory, caplog):
+    container = container_factory(BulkheadService, {})
+    container.start()
+
+    def fail():
+        raise ValueError('boom')
+
+    with entrypoint_hook(container, 'submit') as submit:
+        assert submit(fail).wait() == bulkheads.FAILED
+        assert 'of submit failed in soccer bulkhead' in caplog.text
+
+        task = submit(lambda: eventlet.sleep(10))
+
+    assert task in container._managed_threads
+    container.kill()
+    assert task.dead
+
+
+def test_token_bucket():
+    bucket = resilience.TokenBucket(rate=100, burst=2)
+
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() > 0
+    assert bucket.stats()['waits'] == 1
+
+    assert resilience.TokenBucket(rate=0).acquire() == 0
+    assert resilience.parse_rates('F9:5, RU7:0.5') == {'F9': 5., 'RU7': 0.5}
+    assert resilience.parse_rates(None) == {}
+
+
+def test_metrics(tmp_path):
+    registry = metrics.Registry()
+    registry.inc('feeds_total', feed='f9', status='CREATED')
+    registry.inc('feeds_total', feed='f9', status='CREATED')
+    registry.observe('serialized_bytes', 3000, feed='f9')
+    with registry.timer('publish_seconds', feed='f9'):
+        pass
+    registry.register(lambda: [('breaker_state', {'feed': 'F9'}, 2), ('cycle_last_duration', {}, None),
+                               ('breaker_opened', {'feed': 'F9'}, 3, metrics.COUNTER)])
+
+    snapshot = registry.snapshot()
+    assert snapshot['counters']['feeds_total'] == [{'labels': {'feed': 'f9', 'status': 'CREATED'}, 'value': 2}]
+    assert snapshot['histograms']['serialized_bytes'][0]['count'] == 1
+    assert snapshot['histograms']['serialized_bytes'][0]['p50'] == 4096
+    assert snapshot['gauges']['breaker_state'][0]['value'] == 2
+    assert snapshot['counters']['breaker_opened'] == [{'labels': {'feed': 'F9'}, 'value': 3}]
+
+    text = registry.to_prometheus()
+    assert '# TYPE opta_collector_feeds_total counter' in text
+    assert 'opta_collector_feeds_total{feed="f9",status="CREATED"} 2' in text
+    assert 'opta_collector_serialized_bytes_bucket{feed="f9",le="4096"} 1' in text
+    assert 'opta_collector_serialized_bytes_bucket{feed="f9",le="+Inf"} 1' in text
+    assert 'opta_collector_publish_seconds_count{feed="f9"} 1' in text
+    assert '# TYPE opta_collector_breaker_state gauge' in text
+    assert 'opta_collector_breaker_state{feed="F9"} 2.0' in text
+    assert '# TYPE opta_collector_breaker_opened counter' in text
+    assert 'cycle_last_duration' not in text
+
+    path = tmp_path / 'opta_collector.prom'
+    registry.write_textfile(str(path))
+    assert path.read_text() == text
+
+
+def test_fetch_metrics():
+    metrics.REGISTRY.reset()
+    webservice = opta.OptaWebService('http://opta', 'user', 'password')
+
+    with mock.patch.object(opta.requests, 'get', return_value=mock.Mock(status_code=200, content=F40_XML)):
+        webservice.get_soccer_squads('2020', '24')
+
+    histograms = metrics.REGISTRY.snapshot()['histograms']
+    assert histograms['fetch_seconds'][0]['labels'] == {'feed': 'F40'}
+    assert histograms['response_bytes'][0]['count'] == 1
+    assert histograms['parse_seconds'][0]['count'] == 1
+
+
+def _busy(seconds):
+    start = time.process_time()
+    while time.process_time() - start < seconds:
+        sum(range(1000))
+
+
+def test_profiler(tmp_path):
+    profiler = profiling.Profiler()
+    profiler.output_dir = str(tmp_path)
+    publish = mock.Mock(entrypoint=mock.Mock(method_name='publish'))
+    ack = mock.Mock(entrypoint=mock.Mock(method_name='ack'))
+
+    profiler.worker_setup(publish)
+    profiler.worker_result(publish)
+    assert profiler.session is None
+
+    profiler.start_profiling('cprofile', cycles=1)
+
+    def worker(ctx, seconds):
+        profiler.worker_setup(ctx)
+        _busy(seconds)
+        eventlet.sleep(0)
+        profiler.worker_result(ctx)
+
+    eventlet.spawn(worker, ack, 0.01).wait()
+    eventlet.spawn(worker, publish, 0.01).wait()
+
+    summary = profiler.session.summary()
+    assert summary['running'] is False
+    assert summary['entrypoints'] == ['ack', 'publish']
+    assert len(summary['files']) == 2
+    assert '_busy' in profiler.get_profile(entrypoint='publish')['publish']
+
+    profiler.start_profiling('sampling', seconds=10, entrypoints=['publish'], interval=0.001)
+    eventlet.spawn(worker, publish, 0.05).wait()
+    eventlet.spawn(worker, ack, 0.05).wait()
+    summary = profiler.stop_profiling()
+
+    collapsed = profiler.get_profile('collapsed', entrypoint='publish')
+    assert summary['samples'] > 0
+    assert 'publish' in summary['entrypoints']
+    assert collapsed.startswith('publish;')
+    assert '_busy (test_dependencies.py' in collapsed
+
+
+def test_profile_bulkhead_tasks():
+    profiler = profiling.Profiler()
+    publish = mock.Mock(entrypoint=mock.Mock(method_name='publish'))
+    pools = bulkheads.create_bulkheads(hooks=[profiler])
+    content = generator.generate_f9(players=30, stats=100)
+
+    def parse():
+        for _ in range(5):
+            opta.OptaF9Parser(content).get_player_stats()
+
+    def worker():
+        profiler.worker_setup(publish)
+        tasks = [pools['soccer'].submit(parse, entrypoint='publish') for _ in range(2)]
+        assert [t.wait() for t in tasks] == [None, None]
+        profiler.worker_result(publish)
+
+    profiler.start_profiling('cprofile', cycles=1)
+    eventlet.spawn(worker).wait()
+    assert profiler.session.summary()['running'] is False
+    assert 'get_player_stats' in profiler.get_profile(entrypoint='publish')['publish']
+
+    profiler.start_profiling('sampling', seconds=10, interval=0.001)
+    eventlet.spawn(worker).wait()
+    profiler.stop_profiling()
+
+    assert 'get_player_stats' in profiler.get_profile('collapsed', entrypoint='publish')
+    assert 'get_player_stats' not in profiler.get_profile('collapsed', entrypoint='other')
+
+
+def test_stall_watchdog():
+    now = [0.]
+    stalls = watchdog.StallWatchdog(threshold=0.5, interval=0.1, clock=lambda: now[0])
+
+    def check():
+        # Runs while the main thread is blocked, as the watchdog thread would
+        checker = watchdog._threading.Thread(target=stalls.check)
+        checker.start()
+        checker.join()
+
+    def parse(game_id):
+        now[0] += 0.3
+        check()
+        assert stalls.pending is None
+
+        now[0] += 0.7
+        check()
+
+    parse('920533')
+    now[0] += 0.2
+    stalls.flush()
+    stalls.flush()
+
+    stats = stalls.stats()
+    assert stats['stalls'] == 1
+    [stall] = stats['recent']
+    assert stall['source'].endswith(':check')
+    callers = [f.rsplit(':', 1)[-1] for f in stall['stack']]
+    assert callers[callers.index('parse') + 1] == 'check'
+    assert stall['feed'] == {'game_id': '920533'}
+    assert stall['duration'] == pytest.approx(1.1)
+    assert stats['sources'] == {stall['source']: 1}
+
+
+RU7_XML = b"""<RRML id="318014" status="Result"><TeamDetail>
+<Team team_id="t1" team_name="Home" home_or_away="home"><TeamStats>
+<TeamStat id="s1" game_id="318014" team_id="t1" tackles="110" carries="95"/></TeamStats>
+<Player id="p1" player_name="Player 1" position="Prop" position_id="1"><PlayerStats>
+<PlayerStat id="s2" game_id="318014" team_id="t1" player_id="p1" tackles="12" carries="n/a"/></PlayerStats></Player>
+<Player id="p2" player_name="Player 2" position="Hooker" position_id="2"><PlayerStats>
+<PlayerStat id="s3" game_id="318014" team_id="t1" player_id="p2" tackles="8" carries="4"/></PlayerStats></Player>
+</Team></TeamDetail></RRML>"""
+
+
+def test_rugby_wide_stats():
+    parser = opta.OptaRU7Parser(RU7_XML)
+
+    assert len(parser.get_player_stats()) == 4
+    assert parser.get_player_stats(wide=True) == [
+        {'match_id': '318014', 'team_id': 't1', 'side': 'home', 'player_id': 'p1', 'position_name': 'Prop',
+         'position_id': '1', 'tackles': 12.0, 'carries': None},
+        {'match_id': '318014', 'team_id': 't1', 'side': 'home', 'player_id': 'p2', 'position_name': 'Hooker',
+         'position_id': '2', 'tackles': 8.0, 'carries': 4.0}
+    ]
+
+    assert len(parser.get_team_stats()) == 2
+    assert parser.get_team_stats(wide=True) == [
+        {'match_id': '318014', 'team_id': 't1', 'side': 'home', 'tackles': 110.0, 'carries': 95.0}
+    ]
+
+
+def test_coordination():
+    client = MongoClient()
+    database = client['test_db']
+
+    try:
+        a = Coordinator(database, 'a')
+        b = Coordinator(database, 'b')
+        a.heartbeat()
+        b.heartbeat()
+        a.refresh()
+
+        keys = [f'soccer:{i}' for i in range(1000)]
+        owned_a = set(k for k in keys if a.owns(k))
+        owned_b = set(k for k in keys if b.owns(k))
+
+        assert a.members() == b.members() == ['a', 'b']
+        assert owned_a.isdisjoint(owned_b)
+        assert owned_a | owned_b == set(keys)
+        assert 300 < len(owned_a) < 700
+
+        b.leave()
+        a.refresh()
+        assert all(a.owns(k) for k in keys)
+    finally:
+        client.drop_database('test_db')
+        client.close()
+
+
+def test_generated_documents():
+    scale = {'teams': 6, 'players': 15, 'stats': 20, 'fixtures': 12, 'events': 9}
+    documents = {t: generator.generate(t, **scale) for t in generator.GENERATORS}
+    webservice = opta.OptaWebService('url', 'user', 'password')
+
+    assert len(opta.OptaF1Parser(documents['F1']).get_calendar()) == 12
+    assert len(opta.OptaRU1Parser(documents['RU1']).get_calendar()) == 12
+
+    squads = opta.OptaF40Parser(documents['F40']).get_squads()
+    assert len(squads) == 6
+    assert all(len(t['players']) == 15 and t['players'][0]['join_date'] for t in squads)
+
+    game = webservice.parse_soccer_game(documents['F9'])
+    assert len(game['player_stats']) == 2 * 15 * 20
+    assert len(game['events']) == 2 * (3 * 2 + 3 + 3 * 2)
+    assert {t['id'] for t in game['teams']} == {'t1', 't2'}
+
+    game = webservice.parse_rugby_game(documents['RU7'])
+    assert len(game['player_stats']) == 2 * 15 * 20
+    assert len(game['events']) == 9
+
+    assert webservice.parse_soccer_game(generator.generate_f9(period='FirstHalf')) is None
+    assert webservice.parse_rugby_game(generator.generate_ru7(status='Fixture')) is None
+
+
+def test_benchmarks():
+    benchmarks = suite.build_benchmarks(teams=4, players=5, stats=5, fixtures=6, events=3)
+    names = [b.name for b in benchmarks]
+
+    assert 'F9.get_player_stats[wide]' in names
+    assert 'transform.f40._build_f40_datastore' in names
+    assert all(f'{t}.parse_xml' in names for t in generator.GENERATORS)
+
+    results = suite.run(benchmarks, pattern=r'^(F1\.|transform\.f9\._build)', min_time=0)
+    assert set(results) == {'F1.parse_xml', 'F1.get_calendar', 'transform.f9._build_f9_datastore[long]',
+                            'transform.f9._build_f9_datastore[wide]'}
+    assert results['F1.get_calendar']['records'] == 6
+    assert all(r['median'] > 0 and r['peak_bytes'] > 0 for r in results.values())
+
+    baseline = {name: {**r, 'median': r['median'] / 10} for name, r in results.items()}
+    assert suite.compare(results, baseline, 0.5) == list(results)
+    assert suite.compare(results, {}, 0.5) == []
@@ -3,13 +3,24 @@ import eventlet
 eventlet.monkey_patch()
 
 import datetime
+from unittest import mock
 
+import pytz
 import pytest
 from nameko.testing.services import worker_factory
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 import bson.json_util
 
+from application.dependencies.calendar import CalendarIndex
+from application.dependencies.cycles import CycleRegistry
+from application.dependencies.coordination import Coordinator
+from application.dependencies.priority import PriorityQueue
+from application.dependencies.bulkheads import create_bulkheads
 from application.services.opta_collector import OptaCollectorService
+from application.services import columnar, wire, claim_check, schema, indexes
+from application.services.meta import OPTA, SOCCER_PLAYER_STATS
+from application import profile_feed
 
 
 @pytest.fixture
@@ -22,6 +33,21 @@ def database():
     client.close()
 
 
+@pytest.fixture
+def calendar(database):
+    return CalendarIndex(database)
+
+
+@pytest.fixture
+def cycles(database):
+    return CycleRegistry(database)
+
+
+@pytest.fixture
+def coordinator(database):
+    return Coordinator(database, 'i_1')
+
+
 def test_add_f1(database):
     service = worker_factory(OptaCollectorService, database=database)
     service.opta.get_soccer_calendar.side_effect = lambda season_id, competition_id: [{
@@ -58,8 +84,9 @@ def test_add_ru1(database):
     assert service.database.ru1.find_one({'id': 'g_id'})['competition_id'] == 'c_id'
 
 
-def test_update_all_f1(database):
-    service = worker_factory(OptaCollectorService, database=database)
+def test_update_all_f1(database, cycles, coordinator):
+    service = worker_factory(OptaCollectorService, database=database, cycles=cycles,
+                             coordination=coordinator)
     service.opta.get_soccer_calendar.side_effect = lambda season_id, competition_id: [{
         'competition_id': competition_id,
         'season_id': season_id,
@@ -85,8 +112,9 @@ def test_update_all_f1(database):
     assert service.database.f1.find_one({'id': 'g_id'})['competition_id'] == 'c_id'
 
 
-def test_update_all_ru1(database):
-    service = worker_factory(OptaCollectorService, database=database)
+def test_update_all_ru1(database, cycles, coordinator):
+    service = worker_factory(OptaCollectorService, database=database, cycles=cycles,
+                             coordination=coordinator)
     service.opta.get_rugby_calendar.side_effect = lambda season_id, competition_id: [{
         'competition_id': competition_id,
         'season_id': season_id,
@@ -112,8 +140,254 @@ def test_update_all_ru1(database):
     assert service.database.ru1.find_one({'id': 'g_id'})['competition_id'] == 'c_id'
 
 
-def test_get_soccer_ids_by_dates(database):
-    service = worker_factory(OptaCollectorService, database=database)
+def test_season_lifecycle(database, cycles, coordinator):
+    service = worker_factory(OptaCollectorService, database=database, cycles=cycles,
+                             coordination=coordinator, config={'OPTA_SEASON_GRACE_DAYS': 30})
+    last_date = {'old': datetime.datetime(2015, 5, 30), 'current': datetime.datetime.utcnow(),
+                 'aware': datetime.datetime(2019, 5, 1, 1, tzinfo=pytz.FixedOffset(120))}
+    service.opta.get_soccer_calendar.side_effect = lambda season_id, competition_id: [{
+        'competition_id': competition_id,
+        'season_id': season_id,
+        'date': last_date[season_id],
+        'id': season_id
+    }]
+
+    service.add_f1('old', 'c_id')
+    service.add_f1('current', 'c_id')
+    service.add_f1('aware', 'c_id')
+
+    seasons = {s['season_id']: s for s in service.get_seasons('soccer')}
+    assert seasons['aware']['last_date'] == datetime.datetime(2019, 4, 30, 23)
+    assert seasons['old']['closed'] is True
+    assert seasons['current']['closed'] is False
+
+    service.opta.get_soccer_calendar.reset_mock()
+    service.update_all_f1()
+
+    service.opta.get_soccer_calendar.assert_called_once_with('current', 'c_id')
+
+    # A week later the closed season is polled again, and reopens when a later round shows up
+    service.database.seasons.update_one({'season_id': 'old'}, {'$set': {
+        'updated': datetime.datetime.utcnow() - datetime.timedelta(days=8)}})
+    last_date['old'] = datetime.datetime.utcnow()
+    service.opta.get_soccer_calendar.reset_mock()
+    service.update_all_f1()
+
+    assert sorted(c[0][0] for c in service.opta.get_soccer_calendar.call_args_list) == ['current', 'old']
+    assert {s['season_id']: s['closed'] for s in service.get_seasons('soccer')} == \
+        {'old': False, 'current': False, 'aware': True}
+
+
+def test_cycles(database, cycles, coordinator):
+    service = worker_factory(OptaCollectorService, database=database, cycles=cycles,
+                             coordination=coordinator)
+    for i in range(3):
+        service.database.f1.insert_one({'id': f'g_{i}', 'season_id': 's_id', 'competition_id': f'c_{i}'})
+    service.opta.get_soccer_calendar.return_value = []
+
+    with cycles.guard('update_all_f1', scope='i_1') as cycle:
+        assert cycle is not None
+        cycle.advance('soccer:s_id:c_0')
+
+        with cycles.guard('update_all_f1', scope='i_1') as overlapping:
+            assert overlapping is None
+
+    service.update_all_f1()
+    assert [c[0][1] for c in service.opta.get_soccer_calendar.call_args_list] == ['c_1', 'c_2']
+
+    service.opta.get_soccer_calendar.reset_mock()
+    service.update_all_f1()
+    assert service.opta.get_soccer_calendar.call_count == 3
+
+    stats = service.get_cycle_stats()['update_all_f1']
+    assert stats['runs'] == 3
+    assert stats['completed'] == 2
+    assert stats['overlaps'] == 1
+    assert stats['running'] is False
+
+
+def test_cycles_restart(database):
+    for i in range(3):
+        database.f1.insert_one({'id': f'g_{i}', 'season_id': 's_id', 'competition_id': f'c_{i}'})
+
+    # The first process dies halfway through its cycle
+    crashed = CycleRegistry(database, owner='host-1')
+    cycle = crashed.guard('update_all_f1', scope='replica').__enter__()
+    cycle.advance('soccer:s_id:c_0')
+
+    # Its replacement runs under a new instance id but the same replica name
+    service = worker_factory(OptaCollectorService, database=database, cycles=CycleRegistry(database, owner='host-2'),
+                             coordination=Coordinator(database, 'host-2-uuid', replica='replica'))
+    service.opta.get_soccer_calendar.return_value = []
+
+    service.update_all_f1()
+    assert [c[0][1] for c in service.opta.get_soccer_calendar.call_args_list] == ['c_1', 'c_2']
+    assert database.cycles.count_documents({}) == 0
+
+
+def test_cycles_replicas(database):
+    coordinators = [Coordinator(database, i) for i in ('a', 'b')]
+    for c in coordinators:
+        c.heartbeat()
+    for c in coordinators:
+        c.refresh()
+
+    registries = [CycleRegistry(database, owner=i, lock_ttl=60) for i in ('a', 'b')]
+    replicas = [worker_factory(OptaCollectorService, database=database, cycles=r, coordination=c)
+                for r, c in zip(registries, coordinators)]
+
+    keys = []
+    for i in range(20):
+        database.f1.insert_one({'id': f'g_{i}', 'season_id': 's_id', 'competition_id': f'c_{i:02d}'})
+        keys.append(f'soccer:s_id:c_{i:02d}')
+    owned = [[k for k in keys if c.owns(k)] for c in coordinators]
+    assert owned[0] and owned[1]
+
+    for service in replicas:
+        service.opta.get_soccer_calendar.return_value = []
+
+    # Replica a is halfway through its partition while b runs all of its own
+    with registries[0].guard('update_all_f1', scope='a') as cycle:
+        cycle.advance(owned[0][0])
+
+        replicas[1].update_all_f1()
+        assert [f'soccer:{c[0][0]}:{c[0][1]}' for c in replicas[1].opta.get_soccer_calendar.call_args_list] == \
+            owned[1]
+
+        assert cycle.cursor() == owned[0][0]
+
+    replicas[0].update_all_f1()
+    assert [f'soccer:{c[0][0]}:{c[0][1]}' for c in replicas[0].opta.get_soccer_calendar.call_args_list] == \
+        owned[0][1:]
+
+    # A replica that loses its lock stops instead of moving the cursor on
+    with registries[0].guard('update_all_f1', scope='a') as cycle, \
+            mock.patch.object(registries[0], '_lock', return_value=False):
+        assert cycle.advance(owned[0][0]) is False
+        assert cycle.stopped()
+        assert cycle.cursor() is None
+
+
+def test_fetch_now(database, calendar):
+    queue = PriorityQueue()
+    assert queue.push('rugby', 'r_id', priority=1) is queue.push('rugby', 'r_id', priority=1)
+    queue.push('soccer', 's_id')
+    # Asking again with a higher priority promotes a game the timer queued earlier
+    late = queue.push('soccer', 'late_id', priority=2)
+    assert queue.push('soccer', 'late_id', priority=-2) is late
+
+    service = worker_factory(OptaCollectorService, database=database, calendar=calendar, fetch_queue=queue,
+                             config={})
+    service.get_f9 = lambda game_id: {'id': game_id, 'status': 'CREATED'}
+    service.get_ru7 = lambda game_id: {'id': game_id, 'status': 'UNCHANGED'}
+    published = []
+    service._publish_input = lambda feed: published.append(feed['id'])
+
+    with pytest.raises(ValueError):
+        service.fetch_now('cricket', 'g_id')
+
+    thread = eventlet.spawn(service.fetch_now, 'soccer', 'g_id', priority=-1)
+    eventlet.sleep(0)
+    assert len(queue) == 4
+    assert published == []
+
+    service.process_fetch_queue()
+    result = thread.wait()
+
+    assert published == ['late_id', 'g_id', 's_id']
+    assert result['status'] == 'CREATED'
+    assert result['published'] is True
+    assert result['time_to_publish'] >= 0
+    assert len(queue) == 0
+
+    service._publish_input = lambda feed: pytest.fail('unchanged game published')
+    thread = eventlet.spawn(service.fetch_now, 'rugby', 'r_id')
+    eventlet.sleep(0)
+    service.process_fetch_queue()
+    assert thread.wait()['published'] is False
+
+
+def test_publish_bulkheads(database, calendar, cycles, coordinator):
+    now = datetime.datetime.utcnow()
+    for i in range(3):
+        database.f1.insert_one({'id': f's_{i}', 'season_id': '2017', 'competition_id': '24', 'date': now})
+    database.ru1.insert_one({'id': 'r_0', 'season_id': '2018', 'competition_id': '203', 'date': now})
+
+    bulkheads = create_bulkheads({'soccer': {'size': 2}})
+    service = worker_factory(OptaCollectorService, database=database, calendar=calendar, cycles=cycles,
+                             coordination=coordinator, fetch_queue=PriorityQueue(), bulkheads=bulkheads,
+                             config={})
+
+    handled = []
+
+    def handle_game(sport, game_id):
+        eventlet.sleep(0.1 if sport == 'rugby' else 0.01)
+        handled.append(game_id)
+        return 'CREATED'
+
+    service._handle_game = handle_game
+    service.get_f40 = lambda season_id, competition_id: None
+
+    service.publish()
+
+    assert handled == ['s_0', 's_1', 's_2', 'r_0']
+    assert cycles.get_stats()['publish']['completed'] == 1
+
+    stats = service.get_bulkhead_stats()
+    assert stats['soccer']['completed'] == 3
+    assert stats['soccer']['max_running'] == 2
+    assert stats['rugby']['completed'] == 1
+    assert stats['squads']['completed'] == 1
+    assert stats['soccer']['waiting'] == stats['soccer']['running'] == 0
+
+    def fail_game(sport, game_id):
+        if game_id == 's_1':
+            raise ValueError('boom')
+        return 'UNCHANGED'
+
+    service._handle_game = fail_game
+    service.publish()
+
+    assert service.get_bulkhead_stats()['soccer']['failed'] == 1
+    assert cycles.get_stats()['publish']['completed'] == 1
+    assert database.cycles.find_one({'name': 'publish', 'scope': 'i_1'})['cursor'] == 'soccer:s_0'
+
+
+def test_freshness(database, calendar):
+    kickoff = datetime.datetime.utcnow().replace(microsecond=0) - datetime.timedelta(hours=2)
+    database.f1.insert_one({'id': 'g_id', 'competition_id': '24', 'season_id': '2017', 'date': kickoff,
+                            'home_name': 'h', 'away_name': 'a'})
+
+    service = worker_factory(OptaCollectorService, database=database, calendar=calendar, config={})
+    service.get_f9 = lambda game_id: {'id': game_id, 'status': 'CREATED'}
+    service._publish_input = lambda feed: None
+
+    service._handle_game('soccer', 'g_id')
+    service.ack({'id': 'g_id', 'checksum': 'toto', 'meta': {'type': 'f9', 'source': 'opta'}})
+
+    doc = database.freshness.find_one({'type': 'f9', 'id': 'g_id'})
+    assert doc['kickoff'] == kickoff
+    assert doc['competition_id'] == '24'
+    assert kickoff < doc['final_seen'] <= doc['published'] <= doc['loaded']
+
+    first_seen = doc['final_seen']
+    service.get_f9 = lambda game_id: {'id': game_id, 'status': 'UNCHANGED'}
+    service._handle_game('soccer', 'g_id')
+    assert database.freshness.find_one({'id': 'g_id'})['final_seen'] == first_seen
+
+    with mock.patch.object(service, '_track_freshness') as track:
+        service._handle_game('soccer', 'g_id')
+        track.assert_not_called()
+
+    [freshness] = service.get_freshness(sport='soccer')
+    assert freshness['competition_id'] == '24'
+    assert freshness['end_to_end']['count'] == 1
+    assert 7199 < freshness['detection']['p50'] < 7300
+    assert service.get_freshness(competition_id='8') == []
+
+
+def test_get_soccer_ids_by_dates(database, calendar):
+    service = worker_factory(OptaCollectorService, database=database, calendar=calendar)
     service.database.f1.insert_one({
         'competition_id': 'c_id',
         'season_id': 's_id',
@@ -128,7 +402,77 @@ def test_get_soccer_ids_by_dates(database):
 
     ids = service.get_soccer_ids_by_dates(start_date.isoformat(), end_date.isoformat())
 
-    assert 'g_id' in ids
+    assert 'g_id' in [r['id'] for r in ids]
+
+
+def test_calendar_index(database, calendar):
+    service = worker_factory(OptaCollectorService, database=database, calendar=calendar)
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    service.opta.get_soccer_calendar.side_effect = lambda season_id, competition_id: [{
+        'competition_id': competition_id,
+        'season_id': season_id,
+        'date': now + datetime.timedelta(days=i),
+        'home_id': 'h_id',
+        'away_id': 'a_id',
+        'home_name': 'h',
+        'away_name': 'a',
+        'id': f'g_{i}'
+    } for i in range(5)]
+
+    assert service.get_soccer_ids_by_dates(now.isoformat(), (now + datetime.timedelta(days=5)).isoformat()) == []
+
+    service.add_f1('s_id', 'c_id')
+    ids = service.get_soccer_ids_by_dates(
+        (now + datetime.timedelta(days=1)).isoformat(), (now + datetime.timedelta(days=3)).isoformat())
+    assert ids == [{'id': 'g_1', 'competition_id': 'c_id', 'season_id': 's_id'},
+                   {'id': 'g_2', 'competition_id': 'c_id', 'season_id': 's_id'}]
+
+    service.database.f1.delete_many({})
+    service.opta.get_soccer_calendar.side_effect = lambda season_id, competition_id: [{
+        'competition_id': competition_id, 'season_id': season_id, 'id': 'g_1',
+        'date': now + datetime.timedelta(days=10)
+    }]
+    service.add_f1('s_id', 'c_id')
+    assert service.get_f1('g_1')['date'] == now + datetime.timedelta(days=10)
+    assert service.get_f1('g_1')['home_name'] == 'h'
+    assert [r['id'] for r in service.get_soccer_ids_by_dates(
+        now.isoformat(), (now + datetime.timedelta(days=5)).isoformat())] == ['g_0', 'g_2', 'g_3', 'g_4']
+
+
+def test_calendar_index_replicas(database, cycles, coordinator):
+    clock = [0.]
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    calendars = [CalendarIndex(database, refresh=60, days=30, clock=lambda: clock[0]) for _ in range(2)]
+    replicas = [worker_factory(OptaCollectorService, database=database, cycles=cycles, coordination=coordinator,
+                               calendar=c) for c in calendars]
+    for service in replicas:
+        service.opta.get_soccer_calendar.side_effect = lambda season_id, competition_id: [{
+            'competition_id': competition_id, 'season_id': season_id, 'id': 'g_1',
+            'date': now + datetime.timedelta(days=1)
+        }]
+    database.f1.insert_one({'id': 'g_0', 'competition_id': 'c_id', 'season_id': 'old',
+                            'date': datetime.datetime(2019, 5, 1)})
+
+    def recent(service):
+        return [r['id'] for r in service.get_soccer_ids_by_dates(now.isoformat(),
+                                                                 (now + datetime.timedelta(days=2)).isoformat())]
+
+    assert recent(replicas[1]) == []
+    assert 'g_0' not in calendars[1].calendars['f1']['rows']
+
+    replicas[0].add_f1('s_id', 'c_id')
+    assert recent(replicas[0]) == ['g_1']
+    assert recent(replicas[1]) == []
+
+    clock[0] += 61
+    with mock.patch.object(calendars[1], 'load') as load:
+        assert recent(replicas[1]) == ['g_1']
+        load.assert_not_called()
+
+    # Games older than the window are read from the database
+    assert replicas[1].get_f1('g_0')['season_id'] == 'old'
+    assert [r['id'] for r in replicas[1].get_soccer_ids_by_dates(
+        '2019-04-30', (now + datetime.timedelta(days=2)).isoformat())] == ['g_0', 'g_1']
 
 
 def test_get_soccer_ids_by_season_and_competition(database):
@@ -147,8 +491,8 @@ def test_get_soccer_ids_by_season_and_competition(database):
     assert 'g_id' in ids
 
 
-def test_get_rugby_ids_by_dates(database):
-    service = worker_factory(OptaCollectorService, database=database)
+def test_get_rugby_ids_by_dates(database, calendar):
+    service = worker_factory(OptaCollectorService, database=database, calendar=calendar)
     service.database.ru1.insert_one({
         'competition_id': 'c_id',
         'season_id': 's_id',
@@ -163,11 +507,11 @@ def test_get_rugby_ids_by_dates(database):
 
     ids = service.get_rugby_ids_by_dates(start_date.isoformat(), end_date.isoformat())
 
-    assert 'g_id' in ids
+    assert 'g_id' in [r['id'] for r in ids]
 
 
-def test_get_f1(database):
-    service = worker_factory(OptaCollectorService, database=database)
+def test_get_f1(database, calendar):
+    service = worker_factory(OptaCollectorService, database=database, calendar=calendar)
     service.database.f1.insert_one({
         'competition_id': 'c_id',
         'season_id': 's_id',
@@ -242,9 +586,130 @@ def test_get_f9(database):
     assert game['status'] == 'UPDATED'
 
 
+def test_get_f9_delta(database):
+    service = worker_factory(OptaCollectorService, database=database)
+
+    def get_soccer_game(game_id, team_name='T2', value=5):
+        return {
+            'season': {'id': 's_id', 'name': 'Season'},
+            'competition': {'id': 'c_id', 'name': 'Competition'},
+            'venue': {'id': 'v_id', 'name': 'Venue', 'country': 'Country'},
+            'teams': [{'id': 't_1', 'name': 'T1'}, {'id': 't_2', 'name': team_name}],
+            'persons': [{'id': 'p_1', 'type': 'player', 'first_name': 'f', 'last_name': 'l', 'known': None}],
+            'match_info': {'id': game_id, 'period': 'FullTime', 'date': datetime.datetime(2019, 5, 1)},
+            'events': [{'id': 'e_1'}, {'id': 'e_2'}],
+            'team_stats': [{'team_id': 't_1', 'side': 'Home'}, {'team_id': 't_2', 'side': 'Away'}],
+            'player_stats': [{'player_id': 'p_1', 'type': 'ps1', 'value': 10},
+                             {'player_id': 'p_1', 'type': 'ps2', 'value': value}]
+        }
+
+    service.opta.get_soccer_game.side_effect = get_soccer_game
+    game = service.get_f9('g_id')
+    assert game['status'] == 'CREATED'
+    assert not game['delta']
+    service.ack_f9('g_id', game['checksum'])
+    assert service.database.f9.find_one({'id': 'g_id'})['sections']
+
+    service.opta.get_soccer_game.side_effect = lambda game_id: get_soccer_game(game_id, 'T2 FC', 6)
+    game = service.get_f9('g_id')
+    assert game['status'] == 'UPDATED'
+    assert game['delta']
+
+    sections = {s['target_table']: s for s in game['datastore']}
+    assert set(sections) == {'soccer_playerstat', 'label'}
+    assert len(sections['soccer_playerstat']['records']) == 2
+    assert sections['label']['records'] == [{'id': 'g_id', 'label': 'T1 - T2 FC'}, {'id': 't_2', 'label': 'T2 FC'}]
+
+    # Back to the acked version while the update is still pending: the loader holds the update, send it all
+    service.opta.get_soccer_game.side_effect = get_soccer_game
+    game = service.get_f9('g_id')
+    assert game['status'] == 'UPDATED'
+    assert not game['delta']
+    assert len(game['datastore']) == 5
+
+    service.ack_f9('g_id', 'unknown')
+    assert 'sections' not in service.database.f9.find_one({'id': 'g_id'})
+
+
+def test_referential_cache(database):
+    service = worker_factory(OptaCollectorService, database=database)
+
+    def get_soccer_game(game_id, persons):
+        return {
+            'season': {'id': 's_id', 'name': 'Season'},
+            'competition': {'id': 'c_id', 'name': 'Competition'},
+            'venue': {'id': 'v_id', 'name': 'Venue', 'country': 'Country'},
+            'teams': [{'id': 't_1', 'name': 'T1'}, {'id': 't_2', 'name': 'T2'}],
+            'persons': persons,
+            'match_info': {'id': game_id, 'period': 'FullTime', 'date': datetime.datetime(2019, 5, 1)},
+            'events': [],
+            'team_stats': [{'team_id': 't_1', 'side': 'Home'}, {'team_id': 't_2', 'side': 'Away'}],
+            'player_stats': [{'player_id': 'p_1', 'type': 'ps1', 'value': 10}]
+        }
+
+    p_1 = {'id': 'p_1', 'type': 'player', 'first_name': 'f', 'last_name': 'l', 'known': None}
+    p_2 = {'id': 'p_2', 'type': 'player', 'first_name': 'i', 'last_name': 'a', 'known': 'ia'}
+
+    service.opta.get_soccer_game.side_effect = lambda game_id: get_soccer_game(game_id, [p_1])
+    game = service.get_f9('g_1')
+    assert len(game['referential']['entities']) == 6
+    service.ack_f9('g_1', game['checksum'])
+
+    service.opta.get_soccer_game.side_effect = lambda game_id: get_soccer_game(game_id, [p_1, p_2])
+    game = service.get_f9('g_2')
+    assert [e['id'] for e in game['referential']['entities']] == ['p_2']
+    assert len(game['referential']['events'][0]['entities']) == 7
+    labels = [s for s in game['datastore'] if s['target_table'] == 'label'][0]['records']
+    assert [l['id'] for l in labels] == ['g_2', 'p_2']
+
+    service.reset_referential_cache()
+    game = service.get_f9('g_2')
+    assert len(game['referential']['entities']) == 7
+
+
+def test_get_f9_wide_stats(database):
+    service = worker_factory(OptaCollectorService, database=database)
+    service.opta.get_soccer_game.side_effect = lambda game_id: {
+        'season': {'id': 's_id', 'name': 'Season'},
+        'competition': {'id': 'c_id', 'name': 'Competition'},
+        'venue': {'id': 'v_id', 'name': 'Venue', 'country': 'Country'},
+        'teams': [{'id': 't_1', 'name': 'T1'}, {'id': 't_2', 'name': 'T2'}],
+        'persons': [{'id': 'p_1', 'type': 'player', 'first_name': 'f', 'last_name': 'l', 'known': None}],
+        'match_info': {'id': game_id, 'period': 'FullTime', 'date': datetime.datetime(2019, 5, 1)},
+        'events': [],
+        'team_stats': [{'team_id': 't_1', 'side': 'Home'}, {'team_id': 't_2', 'side': 'Away'}],
+        'player_stats': [{'player_id': 'p_1', 'team_id': 't_1', 'mins_played': '90', 'goals': '1', 'new_stat': '2'}],
+        'stats_layout': 'wide'
+    }
+
+    acked_version = service._get_acked_version
+
+    def slow_acked_version(*args):
+        eventlet.sleep(0.2)
+        return acked_version(*args)
+
+    service._get_acked_version = slow_acked_version
+
+    game = service.get_f9('g_id')
+    assert game['checksum']
+
+    [transform] = [c for c in service.metrics.observe.call_args_list if c[0][0] == 'transform_seconds']
+    assert transform[0][1] < 0.2
+
+    section = game['datastore'][0]
+    assert section['target_table'] == 'soccer_playerstat_wide'
+    stats = [c for c, _ in section['meta'][-len(SOCCER_PLAYER_STATS):]]
+    assert stats == SOCCER_PLAYER_STATS
+    record = section['records'][0]
+    assert 'new_stat' not in record
+    assert (record['player_id'], record['mins_played'], record['goals'], record['saves']) == ('p_1', 90.0, 1.0, None)
+    assert set(record) == {'player_id', 'team_id', *SOCCER_PLAYER_STATS}
+    assert section['delete_keys'] == {'match_id': 'fg_id'}
+
+
 def test_get_f40(database):
     service = worker_factory(OptaCollectorService, database=database)
-    service.opta.get_soccer_squads.side_effect = lambda season_id, competition_id: [{
+    service.opta.get_soccer_squads.side_effect = lambda season_id, competition_id, force=False: [{
         'competition_id': competition_id,
         'competition_name': 'competition_name',
         'season_id': season_id,
@@ -281,12 +746,280 @@ def test_get_f40(database):
     }]
 
     game = service.get_f40('s_id', 'c_id')
-    assert game['status'] == 'UPDATED'
-    assert not game['checksum']
+    assert game['status'] == 'CREATED'
+    assert game['checksum']
     assert game['id']
     assert game['referential']
     assert game['datastore']
 
+    service.ack_f40(game['id'], game['checksum'])
+    game = service.get_f40('s_id', 'c_id')
+    assert game['status'] == 'UNCHANGED'
+
+    squads = service.opta.get_soccer_squads.side_effect('s_id', 'c_id')
+    squads[0]['players'][0]['weight'] = '75'
+    service.opta.get_soccer_squads.side_effect = lambda season_id, competition_id, force=False: squads
+    game = service.get_f40('s_id', 'c_id')
+    assert game['status'] == 'UPDATED'
+    assert [s['target_table'] for s in game['datastore']] == ['soccer_playerinfo']
+    assert game['datastore'][0]['records'][0]['weight'] == 75
+    assert len(game['referential']['informations']) == 1
+
+
+def test_columnar_encoding():
+    section = {
+        **OPTA['f9']['teamstat'],
+        'records': [{
+            'competition_id': 'c_id', 'season_id': 's_id', 'match_id': 'm_id', 'team_id': t, 'score': '1',
+            'shootout_score': None, 'side': s, 'formation_used': '442', 'official_id': 'o_id', 'type': _type,
+            'fh': None, 'sh': None, 'efh': None, 'esh': None, 'value': v
+        } for t, s in (('t_1', 'Home'), ('t_2', 'Away')) for _type, v in (('goals', '1'), ('shots', '12'))]
+    }
+
+    feed = columnar.encode_feed({'id': 'm_id', 'datastore': [section]})
+    encoded = feed['datastore'][0]
+    assert encoded['format'] == columnar.COLUMNAR
+    assert 'records' not in encoded
+    assert encoded['target_table'] == 'soccer_teamstat'
+    columns = {c['name']: c for c in encoded['columns']}
+    assert columns['match_id']['constant'] == 'm_id'
+    assert columns['side']['dictionary'] == ['Home', 'Away']
+
+    decoded = columnar.decode_feed(bson.json_util.loads(bson.json_util.dumps(feed)))
+    assert decoded['datastore'][0]['records'] == section['records']
+    assert decoded['datastore'][0]['target_table'] == 'soccer_teamstat'
+
+
+def test_publish_f40_partition(database, calendar, cycles):
+    coordinators = [Coordinator(database, i) for i in ('a', 'b')]
+    for c in coordinators:
+        c.heartbeat()
+    for c in coordinators:
+        c.refresh()
+
+    now = datetime.datetime.utcnow()
+    competitions = [f'c_{i:02d}' for i in range(10)]
+    for i, competition_id in enumerate(competitions):
+        database.f1.insert_one({'id': f's_{i}', 'season_id': '2017', 'competition_id': competition_id, 'date': now})
+
+    polled = []
+    for c in coordinators:
+        service = worker_factory(OptaCollectorService, database=database, calendar=calendar, cycles=cycles,
+                                 coordination=c, fetch_queue=PriorityQueue(), bulkheads=create_bulkheads(),
+                                 config={})
+        service._handle_game = lambda sport, game_id: 'CREATED'
+        service.get_f40 = mock.Mock(return_value=None)
+        service.publish()
+        polled.append(sorted(call[0][1] for call in service.get_f40.call_args_list))
+
+    assert polled[0] and polled[1]
+    assert sorted(polled[0] + polled[1]) == competitions
+
+
+def test_publish_input_wire_format(database):
+    feed = {'id': 'g_id', 'checksum': 'toto', 'datastore': [], 'meta': {'type': 'f9', 'source': 'opta'}}
+
+    service = worker_factory(OptaCollectorService, database=database, config={})
+    service._publish_input(feed)
+    args, kwargs = service.pub_input.call_args
+    assert bson.json_util.loads(args[0]) == feed
+    assert kwargs['compression'] is None
+
+    service = worker_factory(OptaCollectorService, database=database, config={
+        'OPTA_WIRE_SERIALIZER': 'bson', 'OPTA_WIRE_COMPRESSION': 'zlib'})
+    service._publish_input(feed)
+    args, kwargs = service.pub_input.call_args
+    assert kwargs['content_type'] == wire.BSON_CONTENT_TYPE
+    assert kwargs['compression'] == 'zlib'
+    assert wire.decode_bson(args[0]) == feed
+
+
+def test_ack_bson_payload(database, calendar):
+    service = worker_factory(OptaCollectorService, database=database, calendar=calendar)
+    service.database.f1.insert_one({'id': 'g_id', 'home_name': 'h', 'away_name': 'a'})
+
+    service.ack({'id': 'g_id', 'checksum': 'toto', 'meta': {'type': 'f9', 'source': 'opta'}})
+    assert service.database.f9.find_one({'id': 'g_id'})['checksum'] == 'toto'
+
+    service.ack(wire.encode_bson({'id': 'g_id', 'checksum': 'titi', 'meta': {'type': 'f9', 'source': 'opta'}}))
+    assert service.database.f9.find_one({'id': 'g_id'})['checksum'] == 'titi'
+
+
+def test_claim_check(database, calendar, tmp_path):
+    feed = {'id': 'g_id', 'checksum': 'toto', 'meta': {'type': 'f9', 'source': 'opta'},
+            'datastore': [{'target_table': 'soccer_event', 'records': [{'event_id': str(i)} for i in range(100)]}]}
+
+    config = {'OPTA_CLAIM_CHECK_THRESHOLD': 1024, 'OPTA_CLAIM_CHECK_STORE': str(tmp_path)}
+    service = worker_factory(OptaCollectorService, database=database, calendar=calendar, config=config)
+    service._publish_input(feed)
+
+    msg = bson.json_util.loads(service.pub_input.call_args[0][0])
+    assert 'datastore' not in msg
+    assert msg['meta'] == feed['meta']
+    ref = msg['datastore_ref']
+    assert ref['size'] > 1024
+
+    store = claim_check.get_store(str(tmp_path), database)
+    assert claim_check.load_datastore(store, ref) == feed['datastore']
+
+    service.database.f1.insert_one({'id': 'g_id', 'home_name': 'h', 'away_name': 'a'})
+    service.ack(bson.json_util.dumps(msg))
+    assert not list(tmp_path.iterdir())
+
+    small = {**feed, 'datastore': []}
+    service._publish_input(small)
+    assert bson.json_util.loads(service.pub_input.call_args[0][0]) == small
+
+    service.config['OPTA_WIRE_SERIALIZER'] = wire.BSON
+    service._publish_input(small)
+    assert wire.decode_bson(service.pub_input.call_args[0][0]) == small
+
+    service._publish_input(feed)
+    ref = wire.decode_bson(service.pub_input.call_args[0][0])['datastore_ref']
+    assert ref['content_type'] == wire.BSON_CONTENT_TYPE
+    assert claim_check.load_datastore(store, ref) == feed['datastore']
+
+    assert service.sweep_claim_checks() == 0
+    service.config['OPTA_CLAIM_CHECK_TTL'] = -1
+    assert service.sweep_claim_checks() == 1
+    assert not list(tmp_path.iterdir())
+
+
+
+def test_refresh_f40(database):
+    service = worker_factory(OptaCollectorService, database=database, config={})
+    service.opta.get_soccer_squads.side_effect = lambda season_id, competition_id, force=False: [{
+        'competition_id': competition_id, 'season_id': season_id, 'id': 't_id', 'name': 'Team',
+        'team_kits': {}, 'officials': [], 'players': [{'id': 'p_id', 'join_date': '2020-07-01'}]
+    }]
+
+    assert service.refresh_f40('s_id', 'c_id') == 'CREATED'
+    service.opta.get_soccer_squads.assert_called_with('s_id', 'c_id', force=True)
+    assert service.pub_input.call_count == 1
+
+
+F40_DOCUMENT = b"""<SoccerFeed><SoccerDocument competition_id="24" competition_name="Ligue 1" season_id="2020"
+season_name="Season 2020/2021"><Team uID="t1" short_club_name="One"><Name>One</Name><SYMID>ONE</SYMID>
+<Player uID="p1"><Name>Player One</Name><Position>Forward</Position><Stat Type="join_date">2020-07-01</Stat></Player>
+<Player uID="p2"><Name>Player Two</Name><Position>Goalkeeper</Position><Stat Type="join_date">Unknown</Stat></Player>
+</Team></SoccerDocument></SoccerFeed>"""
+
+
+def test_profile_feed(tmpdir, capsys):
+    path = tmpdir.join('f40.xml')
+    path.write_binary(F40_DOCUMENT)
+
+    profile = profile_feed.FeedProfile()
+    profile.start()
+    datastore = profile_feed.profile_feed('F40', F40_DOCUMENT, profile)
+    profile.stop()
+
+    assert [len(s['records']) for s in datastore] == [2, 1, 2]
+    assert profile.rows[('parse', 'OptaF40Parser.get_squads')]['records'] == 1
+    assert profile.rows[('transform', '_build_f40_datastore')]['records'] == 5
+    assert profile.peak > 0
+    assert not hasattr(profile_feed.opta.OptaF40Parser.get_squads, '__wrapped__')
+
+    profile_feed.main(['f40', str(path), '--repeat', '2'])
+    out = capsys.readouterr().out
+    assert 'OptaF40Parser.get_squads' in out
+    assert '_build_f40_datastore' in out
+
+    with mock.patch.object(profile_feed.wire, 'encode_datastore', wraps=wire.encode_datastore) as encode:
+        profile_feed.main(['f40', str(path), '--serializer', 'bson', '--payload-format', 'columnar'])
+    assert encode.call_args[0][0] == wire.BSON
+    assert encode.call_args[0][1][0]['format'] == columnar.COLUMNAR
+    out = capsys.readouterr().out
+    assert 'serialize' in out
+
+
+def test_schema_codecs():
+    codec = schema.CODECS[('f9', 'playerstat')]
+
+    for n in (2, schema.VECTORIZE_THRESHOLD):
+        records = [{'player_id': 'p_1', 'season_id': '2017', 'shirt_number': '10', 'value': '1.5', 'captain': None}
+                   for _ in range(n)]
+        records[0]['value'] = 'n/a'
+        records[1]['shirt_number'] = ''
+
+        codec.coerce(records)
+
+        assert records[0] == {'player_id': 'p_1', 'season_id': 2017, 'shirt_number': 10, 'value': None,
+                              'captain': None}
+        assert records[1]['shirt_number'] is None
+        assert records[-1]['value'] == 1.5
+        assert isinstance(records[-1]['season_id'], int)
+
+    records = schema.CODECS[('ru7', 'matchinfo')].coerce([{'id': 318014, 'date': '2019-05-01T15:00:00'}])
+    assert records == [{'id': '318014', 'date': datetime.datetime(2019, 5, 1, 15)}]
+
+
+@pytest.mark.skipif(schema.np is None, reason='numpy is not installed')
+@pytest.mark.parametrize('sql_type', ['INTEGER', 'FLOAT'])
+@pytest.mark.parametrize('values', [
+    ['1', '', None, '2.7', -3, '-1.9', 4.5, ' 6 '],
+    ['1', '', None, 'n/a', '2'],
+    ['1', 'nan', 'inf', '1e30']
+])
+def test_schema_vectorized_matches_scalar(monkeypatch, sql_type, values):
+    column = schema.Column('value', sql_type)
+    original = list(values)
+
+    monkeypatch.setattr(schema, 'VECTORIZE_THRESHOLD', 0)
+    vectorized = column.coerce(values)
+    monkeypatch.setattr(schema, 'np', None)
+    scalar = column.coerce(values)
+
+    # repr also tells ints from floats and compares nan
+    assert repr(vectorized) == repr(scalar)
+    assert values == original
+
+
+def test_ensure_indexes(database):
+    indexes.ensure_indexes(database)
+    indexes.ensure_indexes(database)
+
+    info = database.f1.index_information()
+    assert info['id_1'].get('unique') is True
+    assert [('date', 1), ('id', 1), ('competition_id', 1), ('season_id', 1)] in [i['key'] for i in info.values()]
+    assert database.pending.index_information()['type_1_id_1'].get('unique') is True
+
+
+def test_replace_conflicting_index():
+    conflict = OperationFailure('IndexOptionsConflict', 85)
+    collection = mock.Mock()
+    collection.index_information.return_value = {'id_1': {'key': [('id', 1)], 'v': 2, 'ns': 'test_db.f9'}}
+
+    collection.aggregate.return_value = [{'_id': {'id': 'g_1'}, 'count': 2}]
+    collection.create_index.side_effect = [conflict]
+    indexes._create_index(collection, [('id', 1)], {'unique': True})
+    collection.drop_index.assert_not_called()
+
+    collection.aggregate.return_value = []
+    collection.create_index.side_effect = [conflict, OperationFailure('E11000 duplicate key', 11000), None]
+    with pytest.raises(OperationFailure):
+        indexes._create_index(collection, [('id', 1)], {'unique': True})
+    collection.drop_index.assert_called_once_with('id_1')
+    assert collection.create_index.call_args == mock.call([('id', 1)], name='id_1', background=True)
+
+    collection.create_index.side_effect = [conflict, None]
+    indexes._create_index(collection, [('id', 1)], {'unique': True})
+    assert collection.create_index.call_args == mock.call([('id', 1)], background=True, unique=True)
+
+
+def test_describe_plan():
+    collscan = {'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}
+    assert indexes.describe_plan(collscan) == {'stages': ['COLLSCAN'], 'collscan': True, 'covered': False}
+
+    fetch = {'queryPlanner': {'winningPlan': {'stage': 'PROJECTION', 'inputStage': {
+        'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}}}}
+    assert indexes.describe_plan(fetch)['covered'] is False
+
+    covered = {'queryPlanner': {'winningPlan': {'stage': 'PROJECTION_COVERED', 'inputStage': {'stage': 'IXSCAN'}}}}
+    assert indexes.describe_plan(covered) == {
+        'stages': ['PROJECTION_COVERED', 'IXSCAN'], 'collscan': False, 'covered': True}
+
+
 def test_ack_f9(database):
     service = worker_factory(OptaCollectorService, database=database)
     service.ack_f9('g_id', 'toto')